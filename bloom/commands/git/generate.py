@@ -47,6 +47,7 @@ from bloom.generators import load_generator
 from bloom.git import ensure_clean_working_env
 from bloom.git import ensure_git_root
 from bloom.git import GitClone
+from bloom.git import ref_cache
 
 from bloom.logging import debug
 from bloom.logging import error
@@ -247,7 +248,8 @@ def main(sysargs=None):
     # Run the generator that was selected in a clone
     # The clone protects the release repo state from mid change errors
     with log_prefix('[git-bloom-generate {0}]: '.format(generator.title)):
-        git_clone = GitClone()
+        git_clone = GitClone(shared=True)
         with git_clone:
-            run_generator(generator, args)
+            with ref_cache():
+                run_generator(generator, args)
         git_clone.commit()
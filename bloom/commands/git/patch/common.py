@@ -4,13 +4,11 @@ import os
 import subprocess
 import traceback
 
-from bloom.git import has_changes
-from bloom.git import inbranch
+from bloom.git import commit_files
 from bloom.git import show
 
 from bloom.logging import error
 
-from bloom.util import execute_command
 from bloom.util import print_exc
 
 _patch_config_keys = [
@@ -51,30 +49,19 @@ def get_patch_config(patches_branch, directory=None):
 
 
 def set_patch_config(patches_branch, config, directory=None):
-    @inbranch(patches_branch, directory=directory)
-    def fn(config):
-        global _patch_config_keys
-        conf_path = 'patches.conf'
-        if directory is not None:
-            conf_path = os.path.join(directory, conf_path)
-        config_keys = list(config.keys())
-        config_keys.sort()
-        if _patch_config_keys != config_keys:
-            raise RuntimeError("Invalid config passed to set_patch_config")
-        cmd = 'git config -f {0} patches.'.format(conf_path)
-        try:
-            for key in config:
-                _cmd = cmd + key + ' "' + config[key] + '"'
-                execute_command(_cmd, cwd=directory)
-            # Stage the patches.conf file
-            cmd = 'git add ' + conf_path
-            execute_command(cmd, cwd=directory)
-            if has_changes(directory):
-                # Commit the changed config file
-                cmd = 'git commit -m "Updated patches.conf"'
-                execute_command(cmd, cwd=directory)
-        except subprocess.CalledProcessError as err:
-            print_exc(traceback.format_exc())
-            error("Failed to set patches info: " + str(err))
-            raise
-    return fn(config)
+    global _patch_config_keys
+    config_keys = list(config.keys())
+    config_keys.sort()
+    if _patch_config_keys != config_keys:
+        raise RuntimeError("Invalid config passed to set_patch_config")
+    # Keep the order of the keys in the existing file, like 'git config -f' would
+    config_str = show(patches_branch, 'patches.conf', directory=directory) or ''
+    keys = [line.split('=', 1)[0].strip() for line in config_str.splitlines() if '=' in line]
+    keys = [k for k in keys if k in config] + [k for k in config if k not in keys]
+    config_str = '[patches]\n' + ''.join('\t{0} = {1}\n'.format(k, config[k]) for k in keys)
+    try:
+        commit_files(patches_branch, {'patches.conf': config_str}, 'Updated patches.conf', directory=directory)
+    except subprocess.CalledProcessError as err:
+        print_exc(traceback.format_exc())
+        error("Failed to set patches info: " + str(err))
+        raise
@@ -21,6 +21,7 @@ from bloom.logging import warning
 from bloom.util import add_global_arguments
 from bloom.util import execute_command
 from bloom.util import handle_global_arguments
+from bloom.util import invalidate_git_state
 
 from bloom.commands.git.patch.common import get_patch_config
 from bloom.commands.git.patch.common import list_patches
@@ -47,7 +48,8 @@ def import_patches(directory=None):
         # Get parent branch and base commit from patches branch
         config = get_patch_config(patches_branch, directory)
         parent_branch, commit = config['parent'], config['base']
-        if commit != get_commit_hash(current_branch, directory):
+        # Older versions of bloom stored abbreviated commit hashes
+        if not commit or not get_commit_hash(current_branch, directory).startswith(commit):
             debug(
                 "commit != get_commit_hash(current_branch, directory)"
             )
@@ -115,6 +117,8 @@ if [ -f ~/.bashrc ]; then source ~/.bashrc; fi;PS1='(bloom)$PS1'") -i"""
                 ])
             else:
                 ret = subprocess.call("$SHELL", shell=True)
+            # The user may have changed anything in the repository
+            invalidate_git_state()
             if ret != 0:
                 error("User failed to resolve patch conflicts, exiting.")
                 sys.exit("'git-bloom-patch import' aborted.")
@@ -2,15 +2,16 @@ from __future__ import print_function
 
 import os
 import argparse
-import shutil
-from tempfile import mkdtemp
+import tempfile
 
+from subprocess import CalledProcessError
+
+from bloom.git import commit_tree
 from bloom.git import ensure_clean_working_env
 from bloom.git import get_commit_hash
 from bloom.git import get_current_branch
+from bloom.git import get_object_reader
 from bloom.git import get_root
-from bloom.git import has_changes
-from bloom.git import inbranch
 
 from bloom.logging import ansi
 from bloom.logging import debug
@@ -21,65 +22,70 @@ from bloom.commands.git.patch.common import get_patch_config
 from bloom.commands.git.patch.common import set_patch_config
 
 from bloom.util import add_global_arguments
+from bloom.util import check_output
 from bloom.util import execute_command
 from bloom.util import handle_global_arguments
-from bloom.util import my_copytree
 
 
-def non_git_rebase(upstream_branch, directory=None):
-    # Create a temporary storage directory
-    tmp_dir = mkdtemp()
-    # Get the root of the git repository
+def _get_exclude_files(git_root):
+    """Returns the repository's info/exclude and the user's global excludes file, if they exist"""
+    files = [check_output(['git', 'rev-parse', '--git-path', 'info/exclude'], cwd=git_root).strip()]
+    try:
+        files.append(check_output(['git', 'config', '--path', 'core.excludesFile'], cwd=git_root).strip())
+    except CalledProcessError:
+        config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+        files.append(os.path.join(config_home, 'git', 'ignore'))
+    return [f for f in [os.path.join(git_root, f) for f in files] if os.path.isfile(f)]
+
+
+def _write_source_tree(upstream_branch, ignores, directory=None):
+    """
+    Writes the tree of upstream_branch as the copy based rebase committed it.
+
+    Left out are entries named in ignores, at any depth, submodules, and
+    files matched by the repository's info/exclude or the global excludes
+    file, which 'git add' skipped when the source was copied.
+    """
     git_root = get_root(directory)
+    fd, index_file = tempfile.mkstemp(prefix='bloom_index_')
+    os.close(fd)
+    env = {'GIT_INDEX_FILE': index_file}
     try:
-        # Copy the new upstream source into the temporary directory
-        with inbranch(upstream_branch):
-            ignores = ('.git', '.gitignore', '.svn', '.hgignore', '.hg', 'CVS')
-            parent_source = os.path.join(tmp_dir, 'parent_source')
-            my_copytree(git_root, parent_source, ignores)
-        # Clear out any untracked files
-        execute_command('git clean -fdx', cwd=directory)  # for good measure?
-        # Collect files (excluding .git)
-        items = []
-        for item in os.listdir(git_root):
-            if item in ['.git', '..', '.']:
+        check_output(['git', 'read-tree', get_commit_hash(upstream_branch, directory)], cwd=git_root, env=env)
+        removed = set()
+        for entry in check_output(['git', 'ls-files', '-z', '--stage'], cwd=git_root, env=env).split('\0'):
+            if not entry:
                 continue
-            items.append(item)
-        # Remove all files
-        if len(items) > 0:
-            execute_command('git rm -rf ' + ' '.join(['"%s"' % i for i in items if i]), cwd=directory)
-
-        # Copy the parent source into the newly cleaned directory
-        my_copytree(parent_source, git_root)
-
-        # Commit changes to the repository
-        execute_command('git add ./*', cwd=directory)
-        # Collect .* files
-        dot_items = []
-        for item in os.listdir(git_root):
-            if item in ['.git', '..', '.']:
-                continue
-            if item.startswith('.'):
-                dot_items.append(item)
-        # Add any .* files missed by 'git add ./*'
-        if len(dot_items) > 0:
-            execute_command('git add ' + ' '.join(dot_items), cwd=directory)
-        # Remove any straggling untracked files
-        execute_command('git clean -dXf', cwd=directory)
-        # Only if we have local changes commit
-        # (not true if the upstream didn't change any files)
-        cmd = 'git commit '
-        if not has_changes(directory):
-            cmd += '--allow-empty '
-        cmd += '-m "Rebase from \'' + upstream_branch + "'"
-        if not has_changes(directory):
-            cmd += " (no changes)"
-        cmd += '"'
-        execute_command(cmd, cwd=directory)
+            info, path = entry.split('\t', 1)
+            if info.startswith('160000 ') or set(path.split('/')).intersection(ignores):
+                removed.add(path)
+        exclude_args = ['--exclude-from=' + f for f in _get_exclude_files(git_root)]
+        if exclude_args:
+            cmd = ['git', 'ls-files', '-z', '--cached', '--ignored'] + exclude_args
+            removed.update(p for p in check_output(cmd, cwd=git_root, env=env).split('\0') if p)
+        if removed:
+            check_output(['git', 'update-index', '--force-remove', '-z', '--stdin'], cwd=git_root, env=env,
+                         input='\0'.join(sorted(removed)) + '\0')
+        return check_output(['git', 'write-tree'], cwd=git_root, env=env).strip()
     finally:
-        # Clean up
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
+        os.remove(index_file)
+
+
+def non_git_rebase(upstream_branch, directory=None):
+    # Commit the tree of the upstream branch on top of the current branch
+    current_branch = get_current_branch(directory)
+    if current_branch is None:
+        error("Could not determine current branch.", exit=True)
+    ignores = ('.git', '.gitignore', '.svn', '.hgignore', '.hg', 'CVS')
+    tree = _write_source_tree(upstream_branch, ignores, directory)
+    # Clear out any untracked files
+    execute_command('git clean -fdx', cwd=directory)  # for good measure?
+    # Only if the upstream changed any files is the commit not empty
+    parent = get_commit_hash(current_branch, directory)
+    message = "Rebase from '" + upstream_branch + "'"
+    if tree == get_object_reader(directory).info(parent + '^{tree}')[0]:
+        message += ' (no changes)'
+    commit_tree(current_branch, tree, message, parent=parent, allow_empty=True, directory=directory)
 
 
 def git_rebase(upstream_branch, directory=None):
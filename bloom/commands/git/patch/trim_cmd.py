@@ -2,13 +2,15 @@ from __future__ import print_function
 
 import sys
 import os
-import tempfile
 import shutil
+import tempfile
 
 from bloom.git import branch_exists
 from bloom.git import checkout
+from bloom.git import commit_tree
 from bloom.git import get_commit_hash
 from bloom.git import get_current_branch
+from bloom.git import get_object_reader
 from bloom.git import get_root
 from bloom.git import track_branches
 
@@ -18,6 +20,7 @@ from bloom.logging import error
 from bloom.logging import warning
 
 from bloom.util import add_global_arguments
+from bloom.util import check_output
 from bloom.util import execute_command
 from bloom.util import handle_global_arguments
 
@@ -72,6 +75,39 @@ def _undo(config, directory):
     return config
 
 
+def _write_trimmed_tree(sub_tree, directory=None):
+    """
+    Writes sub_tree without the files git ignores once it is the root.
+
+    The copy based trim dropped those files when it added the sub directory
+    back with 'git add', so the .gitignore files of the sub directory, the
+    repository's info/exclude and the global excludes file are applied.
+    """
+    git_root = get_root(directory)
+    fd, index_file = tempfile.mkstemp(prefix='bloom_index_')
+    os.close(fd)
+    work_tree = tempfile.mkdtemp(prefix='bloom_trim_')
+    env = {'GIT_INDEX_FILE': index_file}
+    try:
+        check_output(['git', 'read-tree', sub_tree], cwd=git_root, env=env)
+        # Only the .gitignore files are checked out, for git to read the patterns from
+        gitignores = check_output(['git', 'ls-files', '-z', '--', '.gitignore', '*/.gitignore'],
+                                  cwd=git_root, env=env)
+        git = ['git', '--work-tree=' + work_tree]
+        if gitignores:
+            check_output(git + ['checkout-index', '-z', '--stdin'], cwd=git_root, env=env, input=gitignores)
+        cmd = git + ['ls-files', '-z', '--cached', '--ignored', '--exclude-standard']
+        removed = [p for p in check_output(cmd, cwd=git_root, env=env).split('\0') if p]
+        if not removed:
+            return sub_tree
+        check_output(['git', 'update-index', '--force-remove', '-z', '--stdin'], cwd=git_root, env=env,
+                     input='\0'.join(removed) + '\0')
+        return check_output(['git', 'write-tree'], cwd=git_root, env=env).strip()
+    finally:
+        os.remove(index_file)
+        shutil.rmtree(work_tree, ignore_errors=True)
+
+
 def _trim(config, force, directory):
     debug("_trim(" + str(config) + ", " + str(force) + ", " +
           str(directory) + ")")
@@ -86,59 +122,20 @@ def _trim(config, force, directory):
     current_branch = get_current_branch(directory)
     if current_branch is None:
         error("Could not determine current branch.", exit=True)
-    config['trimbase'] = get_commit_hash(current_branch)
-    tmp_dir = tempfile.mkdtemp()
-    try:
-        # Buckup trim sub directory
-        git_root = get_root()
-        sub_dir = os.path.join(git_root, config['trim'])
-        storage = os.path.join(tmp_dir, config['trim'])
-        shutil.copytree(sub_dir, storage)
-        # Clear out any untracked files
-        execute_command('git clean -fdx', cwd=directory)
-        # Collect al files (excluding .git)
-        items = []
-        for item in os.listdir(git_root):
-            if item in ['.git', '..', '.']:
-                continue
-            items.append(item)
-        # Remove and .* files missed by 'git rm -rf *'
-        if len(items) > 0:
-            execute_command('git rm -rf ' + ' '.join(["'{}'".format(i) for i in items if i]), cwd=directory)
-        # Copy the sub directory back
-        for item in os.listdir(storage):
-            src = os.path.join(storage, item)
-            dst = os.path.join(git_root, item)
-            if os.path.isdir(src):
-                shutil.copytree(src, dst)
-            else:
-                shutil.copy(src, dst)
-        # Stage
-        execute_command('git add ./*', cwd=directory)
-        # Collect .* files
-        dot_items = []
-        for item in os.listdir(git_root):
-            if item in ['.git', '..', '.']:
-                continue
-            if item.startswith('.'):
-                dot_items.append(item)
-        # Add any .* files missed by 'git add ./*'
-        if len(dot_items) > 0:
-            execute_command('git add ' + ' '.join(dot_items), cwd=directory)
-        # Remove any straggling untracked files
-        execute_command('git clean -dXf', cwd=directory)
-        # Commit
-        cmd = 'git commit -m "Trimmed the branch to only the ' + \
-              config['trim'] + ' sub directory"'
-        execute_command(cmd, cwd=directory)
-        # Update the patch base to be this commit
-        current_branch = get_current_branch(directory)
-        if current_branch is None:
-            error("Could not determine current branch.", exit=True)
-        config['base'] = get_commit_hash(current_branch)
-    finally:
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
+    config['trimbase'] = get_commit_hash(current_branch, directory)
+    # Commit the tree of the sub directory, as it is in the current commit, as the new root
+    sub_dir = config['trim'].strip('/')
+    obj = get_object_reader(directory).info(config['trimbase'] + ':' + sub_dir)
+    if obj is None or obj[1] != 'tree':
+        error("The trim sub directory, (" + sub_dir + ") is not a directory "
+              "in the current commit.", exit=True)
+    message = 'Trimmed the branch to only the ' + config['trim'] + ' sub directory'
+    # Clear out any untracked files, they would be left behind in the new root
+    execute_command('git clean -fdx', cwd=directory)
+    tree = _write_trimmed_tree(obj[0], directory)
+    commit = commit_tree(current_branch, tree, message, parent=config['trimbase'], directory=directory)
+    # Update the patch base to be this commit
+    config['base'] = commit or config['trimbase']
     return config
 
 
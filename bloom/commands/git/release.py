@@ -355,7 +355,7 @@ def main(sysargs=None):
 
     verify_track(args.track, tracks_dict['tracks'][args.track])
 
-    git_clone = GitClone()
+    git_clone = GitClone(shared=True)
     with git_clone:
         quiet_git_clone_warning(True)
         disable_git_clone(True)
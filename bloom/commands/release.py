@@ -70,6 +70,7 @@ from bloom.git import get_branches
 from bloom.git import get_current_branch
 from bloom.git import inbranch
 from bloom.git import ls_tree
+from bloom.git import show
 
 from bloom.github import GithubException
 from bloom.github import get_gh_info
@@ -84,6 +85,7 @@ from bloom.logging import info
 from bloom.logging import sanitize
 from bloom.logging import warning
 
+from bloom.packages import get_changelog_entries
 from bloom.packages import get_package_data
 from bloom.packages import get_ignored_packages
 
@@ -136,7 +138,7 @@ except ImportError:
     error("catkin_pkg was not detected, please install it.",
           file=sys.stderr, exit=True)
 
-from catkin_pkg.changelog import get_changelog_from_path
+from catkin_pkg.changelog import CHANGELOG_FILENAME
 
 if sys.version_info[0:2] < (3, 10):
     import importlib_metadata
@@ -588,27 +590,26 @@ def get_changelog_summary(release_tag):
         release_branch = '/'.join(release_tag.split('/')[:-1]).format(package=package.name)
         if not branch_exists(release_branch):
             continue
-        with inbranch(release_branch):
-            changelog = get_changelog_from_path(os.getcwd())
-            if changelog is None:
-                continue
-            for version, date, changes in changelog.foreach_version():
-                if version == package.version:
-                    msgs = []
-                    for change in changes:
-                        msgs.extend([i for i in to_unicode(change).splitlines()])
-                    msg = '\n'.join(msgs)
-                    summary += u"""
+        changelog = show(release_branch, CHANGELOG_FILENAME)
+        if not isinstance(changelog, str):
+            continue
+        for version, date, changes in get_changelog_entries(changelog):
+            if version == package.version:
+                msgs = []
+                for change in changes:
+                    msgs.extend([i for i in to_unicode(change).splitlines()])
+                msg = '\n'.join(msgs)
+                summary += u"""
 ## {package.name}
 """.format(**locals())
-                    if msg:
-                        summary += u"""
+                if msg:
+                    summary += u"""
 ```
 {msg}
 ```
 """.format(**locals())
-                    else:
-                        summary += u"""
+                else:
+                    summary += u"""
 - No changes
 """
     return summary
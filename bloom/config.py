@@ -44,7 +44,8 @@ from bloom.git import branch_exists
 from bloom.git import create_branch
 from bloom.git import has_changes
 from bloom.git import get_remotes
-from bloom.git import get_root
+from bloom.git import Repository
+from bloom.git import commit_files
 from bloom.git import inbranch
 from bloom.git import show
 from bloom.git import track_branches
@@ -305,12 +306,8 @@ def template_str(line, settings):
 def write_tracks_dict_raw(tracks_dict, cmt_msg=None, directory=None):
     upconvert_bloom_to_config_branch()
     cmt_msg = cmt_msg if cmt_msg is not None else 'Modified tracks.yaml'
-    with inbranch(BLOOM_CONFIG_BRANCH):
-        with open('tracks.yaml', 'w') as f:
-            f.write(yaml.safe_dump(tracks_dict, indent=2, default_flow_style=False))
-        execute_command('git add tracks.yaml', cwd=directory)
-        execute_command('git commit --allow-empty -m "{0}"'.format(cmt_msg),
-                        cwd=directory)
+    tracks_yaml = yaml.safe_dump(tracks_dict, indent=2, default_flow_style=False)
+    commit_files(BLOOM_CONFIG_BRANCH, {'tracks.yaml': tracks_yaml}, cmt_msg, directory=directory)
 
 version_regex = re.compile(r'^\d+\.\d+\.\d+$')
 
@@ -345,10 +342,11 @@ def get_tracks_dict_raw(directory=None):
 _has_checked_bloom_branch = False
 
 
-def check_for_multiple_remotes():
-    if get_root() is None:
+def check_for_multiple_remotes(repository=None):
+    repository = repository if repository is not None else Repository()
+    if repository.root is None:
         return
-    remotes = get_remotes()
+    remotes = get_remotes(repository)
     if len(remotes) < 0:
         error("Current git repository has no remotes. "
               "If you are running bloom-release, please change directories.",
@@ -363,9 +361,10 @@ def upconvert_bloom_to_config_branch():
     global _has_checked_bloom_branch
     if _has_checked_bloom_branch:
         return
+    repository = Repository()
     # Assert that this repository does not have multiple remotes
-    check_for_multiple_remotes()
-    if get_root() is None:
+    check_for_multiple_remotes(repository)
+    if repository.root is None:
         # Not a git repository
         return
     track_branches(['bloom', BLOOM_CONFIG_BRANCH])
@@ -380,7 +379,7 @@ def upconvert_bloom_to_config_branch():
     info("Moving configurations from deprecated 'bloom' branch "
          "to the '{0}' branch.".format(BLOOM_CONFIG_BRANCH))
     tmp_dir = mkdtemp()
-    git_root = get_root()
+    git_root = repository.root
     try:
         # Copy the new upstream source into the temporary directory
         with inbranch('bloom'):
@@ -32,15 +32,21 @@
 
 from __future__ import print_function
 
+from .common import add_template_manifest
 from .common import BloomGenerator
+from .common import expand_template_folder
 from .common import GeneratorError
 from .common import list_generators
 from .common import load_generator
 from .common import resolve_dependencies
+from .common import TemplateExpansion
 from .common import update_rosdep
+from .common import write_template_manifest
 
 __all__ = [
-    'BloomGenerator', 'GeneratorError',
+    'add_template_manifest', 'BloomGenerator',
+    'expand_template_folder', 'GeneratorError',
     'list_generators', 'load_generator',
-    'resolve_dependencies', 'update_rosdep'
+    'resolve_dependencies', 'TemplateExpansion',
+    'update_rosdep', 'write_template_manifest'
 ]
@@ -32,7 +32,17 @@
 
 from __future__ import print_function
 
+import atexit
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import stat
 import sys
+import threading
+import time
 import traceback
 
 from bloom.logging import debug
@@ -44,6 +54,7 @@ from bloom.rosdistro_api import get_index
 from bloom.rosdistro_api import get_python_version
 
 from bloom.util import code
+from bloom.util import expand_template_em
 from bloom.util import maybe_continue
 from bloom.util import print_exc
 
@@ -51,6 +62,8 @@ try:
     from rosdep2 import create_default_installer_context
     from rosdep2.catkin_support import get_catkin_view
     from rosdep2.lookup import ResolutionError
+    from rosdep2.sources_list import get_sources_cache_dir
+    from rosdep2.sources_list import get_sources_list_dir
     import rosdep2.catkin_support
 except ImportError as err:
     debug(traceback.format_exc())
@@ -62,6 +75,7 @@ else:
     from importlib.metadata import entry_points
 
 BLOOM_GROUP = 'bloom.generators'
+TEMPLATE_EXTENSION = '.em'
 DEFAULT_ROS_DISTRO = 'indigo'
 
 
@@ -80,6 +94,115 @@ def load_generator(generator_name):
 view_cache = {}
 
 
+class ResolutionCache(object):
+    """
+    On disk cache of rosdep key resolutions.
+
+    Resolutions are stored by key, os name, os version and ROS distro in a
+    JSON file named after a fingerprint of the rosdep sources, so that the
+    processes of one release share them and they are dropped as soon as
+    ``rosdep update`` changes the sources.
+
+    :param path: the JSON file to use
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.resolutions = {}
+        try:
+            with open(self.path) as f:
+                self.resolutions = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    @staticmethod
+    def _key(key, os_name, os_version, ros_distro):
+        return '\n'.join([key, os_name, os_version, ros_distro])
+
+    def get(self, key, os_name, os_version, ros_distro):
+        result = self.resolutions.get(self._key(key, os_name, os_version, ros_distro))
+        return None if result is None else tuple(result)
+
+    def set(self, key, os_name, os_version, ros_distro, result):
+        resolved, installer_key, default_installer_key = result
+        # Only plain package lists can be stored
+        if not isinstance(resolved, list) or not all(isinstance(r, str) for r in resolved):
+            return
+        with self.lock:
+            self.resolutions[self._key(key, os_name, os_version, ros_distro)] = \
+                [resolved, installer_key, default_installer_key]
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.resolutions, f)
+                os.rename(tmp_path, self.path)
+                self.dirty = False
+            except (IOError, OSError) as exc:
+                debug("Failed to write the rosdep resolution cache: {0}".format(exc))
+
+
+_resolution_cache = None
+
+
+def _get_resolution_cache_dir():
+    return os.path.join(os.path.dirname(get_sources_cache_dir()), 'bloom_resolution_cache')
+
+
+def get_resolution_cache():
+    """
+    Returns the :class:`ResolutionCache` for the current rosdep sources.
+
+    Returns None if ``BLOOM_NO_ROSDEP_CACHE`` is set or rosdep has no sources cache.
+    """
+    global _resolution_cache
+    if 'BLOOM_NO_ROSDEP_CACHE' in os.environ:
+        return None
+    if _resolution_cache is None:
+        sources_cache_dir = get_sources_cache_dir()
+        if not os.path.isdir(sources_cache_dir):
+            return None
+        fingerprint = hashlib.sha1()
+        for directory in [sources_cache_dir, get_sources_list_dir()]:
+            if not os.path.isdir(directory):
+                continue
+            for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+                if entry.is_file():
+                    stat = entry.stat()
+                    fingerprint.update('{0} {1} {2}\n'.format(entry.path, stat.st_size, stat.st_mtime).encode())
+        cache_dir = _get_resolution_cache_dir()
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+        except OSError:
+            return None
+        _resolution_cache = ResolutionCache(os.path.join(cache_dir, fingerprint.hexdigest() + '.json'))
+    return _resolution_cache
+
+
+@atexit.register
+def save_resolution_cache():
+    if _resolution_cache is not None:
+        _resolution_cache.save()
+
+
+def clear_resolution_cache():
+    """
+    Forgets all cached resolutions, e.g. because the rosdep sources were updated.
+    """
+    global _resolution_cache
+    _resolution_cache = None
+    cache_dir = _get_resolution_cache_dir()
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
 def get_view(os_name, os_version, ros_distro):
     global view_cache
     key = os_name + os_version + ros_distro
@@ -89,12 +212,86 @@ def get_view(os_name, os_version, ros_distro):
     return view_cache[key]
 
 
+_view_loading_jobs = 4
+
+
+def load_views(targets, ros_distro):
+    """
+    Loads the views of several platforms concurrently, see :func:`get_view`.
+
+    Views are loaded by a bounded pool of threads. The error of the first
+    failing target, in the order given, is raised like :func:`get_view` would.
+
+    :param targets: iterable of ``(os_name, os_version)`` tuples
+    :param ros_distro: ROS distribution the views are for
+    :returns: dict of targets to views
+    """
+    targets = list(collections.OrderedDict.fromkeys(targets))
+    missing = [t for t in targets if t[0] + t[1] + ros_distro not in view_cache]
+    if len(missing) > 1:
+        workers = min(len(missing), _view_loading_jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(get_view, os_name, os_version, ros_distro) for os_name, os_version in missing]
+            for future in futures:
+                if future.exception() is not None:
+                    debug("Failed to load view: {0}".format(future.exception()))
+    # Views which failed to load are loaded again, raising the error in order
+    return dict((t, get_view(t[0], t[1], ros_distro)) for t in targets)
+
+
 def invalidate_view_cache():
-    global view_cache
+    global view_cache, _resolution_cache
     view_cache = {}
+    _resolution_cache = None
+
+
+# A stamp from the same bloom command is only trusted for this many seconds
+ROSDEP_UPDATE_COMMAND_MAX_AGE = 24 * 60 * 60
 
 
-def update_rosdep():
+def _get_rosdep_update_stamp_path():
+    return os.path.join(os.path.dirname(get_sources_cache_dir()), 'bloom_update_stamp')
+
+
+def rosdep_update_is_fresh():
+    """
+    Returns True if 'rosdep update' already ran in this release.
+
+    That is the case if the last update bloom ran was from a process with the
+    same ``BLOOM_COMMAND_ID``, which is unique to one bloom command and shared
+    by all of its processes, less than a day ago, or if it is younger than
+    ``BLOOM_ROSDEP_UPDATE_MAX_AGE`` seconds, if that is set.
+    """
+    try:
+        with open(_get_rosdep_update_stamp_path()) as f:
+            stamp = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    if not isinstance(stamp, dict):
+        return False
+    age = time.time() - stamp.get('time', 0)
+    if age < 0:
+        # The clock went back, do not trust the stamp
+        return False
+    command_id = os.environ.get('BLOOM_COMMAND_ID')
+    if command_id is not None and stamp.get('command_id') == command_id and age < ROSDEP_UPDATE_COMMAND_MAX_AGE:
+        return True
+    try:
+        max_age = float(os.environ.get('BLOOM_ROSDEP_UPDATE_MAX_AGE', 0))
+    except ValueError:
+        max_age = 0
+    return age < max_age
+
+
+def update_rosdep(force=True):
+    """
+    Runs 'rosdep update'.
+
+    :param force: if False, skip the update if :func:`rosdep_update_is_fresh`
+    """
+    if not force and rosdep_update_is_fresh():
+        info("Skipping 'rosdep update', it already ran for this release.")
+        return
     info("Running 'rosdep update'...")
     try:
         rosdep2.catkin_support.update_rosdep()
@@ -102,6 +299,25 @@ def update_rosdep():
         print_exc(traceback.format_exc())
         error("Failed to update rosdep, did you run 'rosdep init' first?",
               exit=True)
+    clear_resolution_cache()
+    try:
+        with open(_get_rosdep_update_stamp_path(), 'w') as f:
+            json.dump({'command_id': os.environ.get('BLOOM_COMMAND_ID'), 'time': time.time()}, f)
+    except (IOError, OSError) as exc:
+        debug("Failed to write the rosdep update stamp: {0}".format(exc))
+
+
+_installer_context = None
+
+
+def get_installer_context():
+    """
+    Returns the default rosdep installer context, which is created once.
+    """
+    global _installer_context
+    if _installer_context is None:
+        _installer_context = create_default_installer_context()
+    return _installer_context
 
 
 def resolve_more_for_os(rosdep_key, view, installer, os_name, os_version):
@@ -115,7 +331,19 @@ def resolve_more_for_os(rosdep_key, view, installer, os_name, os_version):
     :raises: :exc:`rosdep2.ResolutionError`
     """
     d = view.lookup(rosdep_key)
-    ctx = create_default_installer_context()
+    return resolve_definition_for_os(d, installer, os_name, os_version)
+
+
+def resolve_definition_for_os(d, installer, os_name, os_version):
+    """
+    Resolve an already looked up rosdep definition for a platform.
+
+    :param d: rosdep definition, as returned by the view's lookup
+    :returns: resolved key, resolved installer key, and default installer key
+
+    :raises: :exc:`rosdep2.ResolutionError`
+    """
+    ctx = get_installer_context()
     os_installers = ctx.get_os_installer_keys(os_name)
     default_os_installer = ctx.get_default_os_installer_key(os_name)
     inst_key, rule = d.get_rule_for_platform(os_name, os_version,
@@ -189,7 +417,7 @@ def resolve_rosdep_key(
     retry=True
 ):
     ignored = ignored or []
-    ctx = create_default_installer_context()
+    ctx = get_installer_context()
     try:
         installer_key = ctx.get_default_os_installer_key(os_name)
     except KeyError:
@@ -197,21 +425,21 @@ def resolve_rosdep_key(
                             .format(os_name))
     installer = ctx.get_installer(installer_key)
     ros_distro = ros_distro or DEFAULT_ROS_DISTRO
+    cache = get_resolution_cache()
+    result = cache and cache.get(key, os_name, os_version, ros_distro)
+    if result:
+        return result
     view = get_view(os_name, os_version, ros_distro)
     try:
-        return resolve_more_for_os(key, view, installer, os_name, os_version)
+        result = resolve_more_for_os(key, view, installer, os_name, os_version)
+        if cache is not None:
+            cache.set(key, os_name, os_version, ros_distro, result)
+        return result
     except (KeyError, ResolutionError) as exc:
         debug(traceback.format_exc())
         if key in ignored:
             return None, None, None
-        if isinstance(exc, KeyError):
-            error("Could not resolve rosdep key '{0}'".format(key))
-            returncode = code.GENERATOR_NO_SUCH_ROSDEP_KEY
-        else:
-            error("Could not resolve rosdep key '{0}' for distro '{1}':"
-                  .format(key, os_version))
-            info(str(exc), use_prefix=False)
-            returncode = code.GENERATOR_NO_ROSDEP_KEY_FOR_DISTRO
+        returncode = report_rosdep_key_error(key, os_version, exc)
         if retry:
             error("Try to resolve the problem with rosdep and then continue.")
             if maybe_continue():
@@ -223,6 +451,118 @@ def resolve_rosdep_key(
                             .format(key), returncode=returncode)
 
 
+def report_rosdep_key_error(key, os_version, exc):
+    """
+    Reports why a rosdep key could not be resolved.
+
+    :param exc: the KeyError or :exc:`rosdep2.ResolutionError` which was raised
+    :returns: the matching generator return code
+    """
+    if isinstance(exc, KeyError):
+        error("Could not resolve rosdep key '{0}'".format(key))
+        return code.GENERATOR_NO_SUCH_ROSDEP_KEY
+    error("Could not resolve rosdep key '{0}' for distro '{1}':"
+          .format(key, os_version))
+    info(str(exc), use_prefix=False)
+    return code.GENERATOR_NO_ROSDEP_KEY_FOR_DISTRO
+
+
+class ResolutionMatrix(dict):
+    """
+    Results of :func:`resolve_rosdep_keys`.
+
+    Maps each key to a dict of ``(os_name, os_version)`` targets to either a
+    tuple of the resolved key, installer key and default installer key, or to
+    the exception raised while resolving it.
+    """
+    def __init__(self, ros_distro):
+        super(ResolutionMatrix, self).__init__()
+        self.ros_distro = ros_distro
+
+    def resolve(self, key, os_name, os_version):
+        """
+        Returns the resolution of a key like :func:`resolve_rosdep_key` with ``retry=False``.
+
+        :returns: resolved key, resolved installer key, and default installer key
+        :raises: :exc:`GeneratorError` if the key could not be resolved
+        """
+        result = self[key][(os_name, os_version)]
+        if isinstance(result, GeneratorError):
+            raise result
+        if isinstance(result, Exception):
+            returncode = report_rosdep_key_error(key, os_version, result)
+            BloomGenerator.exit("Failed to resolve rosdep key '{0}', aborting."
+                                .format(key), returncode=returncode)
+        return result
+
+
+def resolve_rosdep_keys(keys, targets, ros_distro=None, ignored=None):
+    """
+    Resolves many rosdep keys for many platforms at once.
+
+    The installer context, the installers and the view of each platform are
+    created once, and each key is looked up once per view. Keys found in
+    the :class:`ResolutionCache` are not looked up at all, and only the views
+    for which some key is missing from the cache are loaded, concurrently,
+    see :func:`load_views`.
+    Failures are stored in the matrix rather than reported.
+
+    :param keys: iterable of rosdep key names
+    :param targets: iterable of ``(os_name, os_version)`` tuples
+    :param ros_distro: ROS distribution the views are for
+    :param ignored: keys which resolve to ``(None, None, None)`` if they fail
+    :returns: :class:`ResolutionMatrix`
+    """
+    ignored = ignored or []
+    ros_distro = ros_distro or DEFAULT_ROS_DISTRO
+    ctx = get_installer_context()
+    cache = get_resolution_cache()
+    installers = {}
+    targets = list(targets)
+    for os_name, os_version in targets:
+        if os_name not in installers:
+            try:
+                installers[os_name] = ctx.get_installer(ctx.get_default_os_installer_key(os_name))
+            except KeyError:
+                installers[os_name] = GeneratorError("Could not determine the installer for '{0}'".format(os_name))
+    matrix = ResolutionMatrix(ros_distro)
+    unresolved = []
+    for key in keys:
+        matrix[key] = {}
+        for target in targets:
+            installer = installers[target[0]]
+            if isinstance(installer, GeneratorError):
+                matrix[key][target] = installer
+                continue
+            result = cache and cache.get(key, target[0], target[1], ros_distro)
+            if result:
+                matrix[key][target] = result
+            else:
+                unresolved.append((key, target))
+    views = load_views(sorted(set(target for _, target in unresolved)), ros_distro)
+    definitions = {}
+    for key, target in unresolved:
+        view = views[target]
+        try:
+            if (key, id(view)) not in definitions:
+                try:
+                    definitions[(key, id(view))] = view.lookup(key)
+                except KeyError as exc:
+                    definitions[(key, id(view))] = exc
+            definition = definitions[(key, id(view))]
+            if isinstance(definition, KeyError):
+                raise definition
+            matrix[key][target] = resolve_definition_for_os(definition, installers[target[0]], *target)
+            if cache is not None:
+                cache.set(key, target[0], target[1], ros_distro, matrix[key][target])
+        except (KeyError, ResolutionError) as exc:
+            debug(traceback.format_exc())
+            matrix[key][target] = (None, None, None) if key in ignored else exc
+    if cache is not None:
+        cache.save()
+    return matrix
+
+
 def default_fallback_resolver(key, peer_packages):
     BloomGenerator.exit("Failed to resolve rosdep key '{0}', aborting."
                         .format(key), returncode=code.GENERATOR_NO_SUCH_ROSDEP_KEY)
@@ -234,15 +574,29 @@ def resolve_dependencies(
     os_version,
     ros_distro=None,
     peer_packages=None,
-    fallback_resolver=None
+    fallback_resolver=None,
+    resolutions=None
 ):
+    """
+    Resolves the given dependencies for one platform.
+
+    :param resolutions: optional :class:`ResolutionMatrix` from an earlier
+        :func:`resolve_rosdep_keys` call, keys it resolved are not resolved again
+    :returns: dict of key names to resolved keys
+    """
     ros_distro = ros_distro or DEFAULT_ROS_DISTRO
     peer_packages = peer_packages or []
     fallback_resolver = fallback_resolver or default_fallback_resolver
+    if resolutions is not None and resolutions.ros_distro != ros_distro:
+        resolutions = None
 
     resolved_keys = {}
     keys = [k.name for k in keys]
     for key in keys:
+        result = resolutions.get(key, {}).get((os_name, os_version)) if resolutions is not None else None
+        if isinstance(result, tuple) and result[0] is not None:
+            resolved_keys[key] = result[0]
+            continue
         resolved_key, installer_key, default_installer_key = \
             resolve_rosdep_key(key, os_name, os_version, ros_distro,
                                peer_packages, retry=True)
@@ -254,6 +608,90 @@ def resolve_dependencies(
     return resolved_keys
 
 
+TemplateExpansion = collections.namedtuple('TemplateExpansion', ['source', 'output', 'mode', 'data'])
+TemplateExpansion.__doc__ = """\
+Entry of a template manifest, see :func:`expand_template_folder`.
+
+:ivar source: path of the template
+:ivar output: path of the expanded file, the template path without extension
+:ivar mode: permission bits of the template
+:ivar data: expanded template as utf-8 bytes, or None if it is not to be written
+"""
+
+
+def expand_template_folder(path, subs, skip_empty=()):
+    """
+    Expands the EmPy templates in a folder and its sub folders.
+
+    Nothing is written, the results are returned as a manifest which can be
+    written to the working tree with :func:`write_template_manifest` or
+    committed directly with a :class:`bloom.git.CommitBuilder`.
+
+    :param path: folder containing the templates
+    :param subs: substitutions for the templates
+    :param skip_empty: names of outputs which should not be written if empty
+    :returns: list of :class:`TemplateExpansion`, sorted by source path
+    """
+    manifest = []
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.name in ['.git', '.svn']:
+            continue
+        source = os.path.normpath(os.path.join(path, entry.name))
+        if entry.is_dir():
+            manifest.extend(expand_template_folder(source, subs, skip_empty))
+            continue
+        if not entry.name.endswith(TEMPLATE_EXTENSION):
+            continue
+        with open(source, 'r') as f:
+            template = f.read()
+        # Remove extension
+        output = source[:-len(TEMPLATE_EXTENSION)]
+        # Expand template
+        info("Expanding '{0}' -> '{1}'".format(os.path.relpath(source), os.path.relpath(output)))
+        result = expand_template_em(template, subs)
+        data = result.encode('utf-8')
+        # Don't write an empty file
+        if not data and os.path.basename(output) in skip_empty:
+            data = None
+        manifest.append(TemplateExpansion(source, output, stat.S_IMODE(entry.stat().st_mode), data))
+    return manifest
+
+
+def write_template_manifest(manifest):
+    """
+    Writes the expanded templates of a manifest next to their templates.
+
+    :param manifest: list of :class:`TemplateExpansion`
+    :returns: list of the template paths
+    """
+    for expansion in manifest:
+        if expansion.data is None:
+            continue
+        with open(expansion.output, 'wb') as f:
+            f.write(expansion.data)
+        # Copy the permissions
+        os.chmod(expansion.output, expansion.mode)
+    return [expansion.source for expansion in manifest]
+
+
+def add_template_manifest(builder, manifest):
+    """
+    Stages a manifest in a :class:`bloom.git.CommitBuilder`.
+
+    The templates are removed and the expanded templates are added.
+
+    :param builder: :class:`bloom.git.CommitBuilder` to stage the files in
+    :param manifest: list of :class:`TemplateExpansion`, with paths relative
+        to the repository root
+    """
+    for expansion in manifest:
+        builder.remove(expansion.source)
+        if expansion.data is not None:
+            builder.add(expansion.output, expansion.data, executable=bool(expansion.mode & stat.S_IXUSR))
+
+
 class GeneratorError(Exception):
     def __init__(self, msg, returncode=code.UNKNOWN):
         super(GeneratorError, self).__init__("Error running generator: " + msg)
@@ -33,9 +33,8 @@
 from __future__ import print_function
 
 import collections
+import concurrent.futures
 import datetime
-import io
-import json
 import os
 import re
 import shutil
@@ -59,13 +58,20 @@ from bloom.generators.common import default_fallback_resolver
 from bloom.generators.common import invalidate_view_cache
 from bloom.generators.common import evaluate_package_conditions
 from bloom.generators.common import resolve_rosdep_key
+from bloom.generators.common import resolve_rosdep_keys
+
+from bloom.generators.packaging import convert_to_unicode
+from bloom.generators.packaging import get_package_from_branch
+from bloom.generators.packaging import match_branches_with_prefix
+from bloom.generators.packaging import PackagingGenerator
+from bloom.generators.packaging import place_template_folder
+from bloom.generators.packaging import process_template_folder
 
 from bloom.git import inbranch
 from bloom.git import get_branches
 from bloom.git import get_commit_hash
 from bloom.git import get_current_branch
-from bloom.git import has_changes
-from bloom.git import show
+from bloom.git import get_object_reader
 from bloom.git import tag_exists
 
 from bloom.logging import ansi
@@ -77,12 +83,12 @@ from bloom.logging import info
 from bloom.logging import is_debug
 from bloom.logging import warning
 
-from bloom.util import expand_template_em
 
 from bloom.commands.git.patch.common import get_patch_config
 from bloom.commands.git.patch.common import set_patch_config
 
-from bloom.packages import get_package_data
+from bloom.packages import get_changelog_entries_from_path
+from bloom.packages import get_packages_from_references
 
 from bloom.util import code
 from bloom.util import to_unicode
@@ -90,14 +96,7 @@ from bloom.util import execute_command
 from bloom.util import get_rfc_2822_date
 from bloom.util import maybe_continue
 
-if sys.version_info[0:2] < (3, 10):
-    import importlib_resources
-else:
-    import importlib.resources as importlib_resources
-
-
 try:
-    from catkin_pkg.changelog import get_changelog_from_path
     from catkin_pkg.changelog import CHANGELOG_FILENAME
     from catkin_pkg.package import Person
 except ImportError as err:
@@ -130,44 +129,6 @@ except NameError:
 # Drop the first log prefix for this command
 enable_drop_first_log_prefix(True)
 
-TEMPLATE_EXTENSION = '.em'
-
-
-def __place_template_folder(group, src, dst, gbp=False):
-    template_files = [os.path.basename(file)
-                      for file in importlib_resources.files(f'{group}.{src.replace("/", ".")}').iterdir()]
-    # For each template, place
-    for template_file in template_files:
-        if not gbp and os.path.basename(template_file) == 'gbp.conf.em':
-            debug("Skipping template '{0}'".format(template_file))
-            continue
-        template_path = os.path.join(src, template_file)
-        template_dst = os.path.join(dst, template_file)
-        if importlib_resources.files(group).joinpath(template_path).is_dir():
-            debug("Recursing on folder '{0}'".format(template_path))
-            __place_template_folder(group, template_path, template_dst, gbp)
-        else:
-            try:
-                debug("Placing template '{0}'".format(template_path))
-                template = importlib_resources.files(group).joinpath(template_path).open().read()
-                template_abs_path = importlib_resources.files(group).joinpath(template_path)
-            except IOError as err:
-                error("Failed to load template "
-                      "'{0}': {1}".format(template_file, str(err)), exit=True)
-            if not os.path.exists(dst):
-                os.makedirs(dst)
-            if os.path.exists(template_dst):
-                debug("Not overwriting existing file '{0}'".format(template_dst))
-            else:
-                with io.open(template_dst, 'w', encoding='utf-8') as f:
-                    if not isinstance(template, str):
-                        template = template.decode('utf-8')
-                    # Python 2 API needs a `unicode` not a utf-8 string.
-                    elif sys.version_info.major == 2:
-                        template = template.decode('utf-8')
-                    f.write(template)
-                shutil.copystat(template_abs_path, template_dst)
-
 
 def place_template_files(path, build_type, gbp=False):
     info(fmt("@!@{bf}==>@| Placing templates files in the 'debian' folder."))
@@ -178,7 +139,7 @@ def place_template_files(path, build_type, gbp=False):
     # Place template files
     group = 'bloom.generators.debian'
     templates = os.path.join('templates', build_type)
-    __place_template_folder(group, templates, debian_path, gbp)
+    place_template_folder(group, templates, debian_path, gbp)
 
 
 def summarize_dependency_mapping(data, deps, build_deps, resolved_deps):
@@ -289,10 +250,9 @@ def get_changelogs(package, releaser_history=None):
     package_path = os.path.abspath(os.path.dirname(package.filename))
     changelog_path = os.path.join(package_path, CHANGELOG_FILENAME)
     if os.path.exists(changelog_path):
-        changelog = get_changelog_from_path(changelog_path)
         changelogs = []
         maintainer = (package.maintainers[0].name, package.maintainers[0].email)
-        for version, date, changes in changelog.foreach_version(reverse=True):
+        for version, date, changes in reversed(get_changelog_entries_from_path(changelog_path)):
             changes_str = []
             date_str = get_rfc_2822_date(date)
             for item in changes:
@@ -322,6 +282,31 @@ def _ensure_rfc5322_compliant(person):
     return person
 
 
+def get_package_dependencies(package, ros_distro):
+    """
+    Returns the dependencies of a package which apply to a ROS distro.
+
+    :returns: tuple of the run, build, test, replaces and conflicts dependencies
+    """
+    evaluate_package_conditions(package, ros_distro)
+    depends = [
+        dep for dep in (package.run_depends + package.buildtool_export_depends)
+        if dep.evaluated_condition is not False]
+    build_depends = [
+        dep for dep in (package.build_depends + package.buildtool_depends)
+        if dep.evaluated_condition is not False]
+    test_depends = [
+        dep for dep in (package.test_depends)
+        if dep.evaluated_condition is not False]
+    replaces = [
+        dep for dep in package.replaces
+        if dep.evaluated_condition is not False]
+    conflicts = [
+        dep for dep in package.conflicts
+        if dep.evaluated_condition is not False]
+    return depends, build_depends, test_depends, replaces, conflicts
+
+
 def generate_substitutions_from_package(
     package,
     os_name,
@@ -332,7 +317,8 @@ def generate_substitutions_from_package(
     peer_packages=None,
     releaser_history=None,
     fallback_resolver=None,
-    native=False
+    native=False,
+    resolutions=None
 ):
     peer_packages = peer_packages or []
     data = {}
@@ -361,28 +347,13 @@ def generate_substitutions_from_package(
     # Installation prefix
     data['InstallationPrefix'] = installation_prefix
     # Resolve dependencies
-    evaluate_package_conditions(package, ros_distro)
-    depends = [
-        dep for dep in (package.run_depends + package.buildtool_export_depends)
-        if dep.evaluated_condition is not False]
-    build_depends = [
-        dep for dep in (package.build_depends + package.buildtool_depends)
-        if dep.evaluated_condition is not False]
-    test_depends = [
-        dep for dep in (package.test_depends)
-        if dep.evaluated_condition is not False]
-    replaces = [
-        dep for dep in package.replaces
-        if dep.evaluated_condition is not False]
-    conflicts = [
-        dep for dep in package.conflicts
-        if dep.evaluated_condition is not False]
+    depends, build_depends, test_depends, replaces, conflicts = get_package_dependencies(package, ros_distro)
     unresolved_keys = depends + build_depends + test_depends + replaces + conflicts
     # The installer key is not considered here, but it is checked when the keys are checked before this
     resolved_deps = resolve_dependencies(unresolved_keys, os_name,
                                          os_version, ros_distro,
                                          peer_packages + [d.name for d in (replaces + conflicts)],
-                                         fallback_resolver)
+                                         fallback_resolver, resolutions)
     data['Depends'] = sorted(
         set(format_depends(depends, resolved_deps))
     )
@@ -499,124 +470,14 @@ def generate_substitutions_from_package(
             licenses.append((str(l), 'See repository for full license text'))
     data['Licenses'] = licenses
 
-    def convertToUnicode(obj):
-        if sys.version_info.major == 2:
-            if isinstance(obj, str):
-                return unicode(obj.decode('utf8'))
-            elif isinstance(obj, unicode):
-                return obj
-        else:
-            if isinstance(obj, bytes):
-                return str(obj.decode('utf8'))
-            elif isinstance(obj, str):
-                return obj
-        if isinstance(obj, list):
-            for i, val in enumerate(obj):
-                obj[i] = convertToUnicode(val)
-            return obj
-        elif isinstance(obj, type(None)):
-            return None
-        elif isinstance(obj, tuple):
-            obj_tmp = list(obj)
-            for i, val in enumerate(obj_tmp):
-                obj_tmp[i] = convertToUnicode(obj_tmp[i])
-            return tuple(obj_tmp)
-        elif isinstance(obj, int):
-            return obj
-        raise RuntimeError('need to deal with type %s' % (str(type(obj))))
-
     for item in data.items():
-        data[item[0]] = convertToUnicode(item[1])
+        data[item[0]] = convert_to_unicode(item[1])
 
     return data
 
 
-def __process_template_folder(path, subs):
-    items = os.listdir(path)
-    processed_items = []
-    for item in list(items):
-        item = os.path.abspath(os.path.join(path, item))
-        if os.path.basename(item) in ['.', '..', '.git', '.svn']:
-            continue
-        if os.path.isdir(item):
-            sub_items = __process_template_folder(item, subs)
-            processed_items.extend([os.path.join(item, s) for s in sub_items])
-        if not item.endswith(TEMPLATE_EXTENSION):
-            continue
-        with open(item, 'r') as f:
-            template = f.read()
-        # Remove extension
-        template_path = item[:-len(TEMPLATE_EXTENSION)]
-        # Expand template
-        info("Expanding '{0}' -> '{1}'".format(
-            os.path.relpath(item),
-            os.path.relpath(template_path)))
-        result = expand_template_em(template, subs)
-        # Don't write an empty file
-        if len(result) == 0 and \
-           os.path.basename(template_path) in ['copyright']:
-            processed_items.append(item)
-            continue
-        # Write the result
-        with io.open(template_path, 'w', encoding='utf-8') as f:
-            if sys.version_info.major == 2:
-                result = result.decode('utf-8')
-            f.write(result)
-        # Copy the permissions
-        shutil.copymode(item, template_path)
-        processed_items.append(item)
-    return processed_items
-
-
 def process_template_files(path, subs):
-    info(fmt("@!@{bf}==>@| In place processing templates in 'debian' folder."))
-    debian_dir = os.path.join(path, 'debian')
-    if not os.path.exists(debian_dir):
-        sys.exit("No debian directory found at '{0}', cannot process templates."
-                 .format(debian_dir))
-    return __process_template_folder(debian_dir, subs)
-
-
-def match_branches_with_prefix(prefix, get_branches, prune=False):
-    debug("match_branches_with_prefix(" + str(prefix) + ", " +
-          str(get_branches()) + ")")
-    branches = []
-    # Match branches
-    existing_branches = get_branches()
-    for branch in existing_branches:
-        if branch.startswith('remotes/origin/'):
-            branch = branch.split('/', 2)[-1]
-        if branch.startswith(prefix):
-            branches.append(branch)
-    branches = list(set(branches))
-    if prune:
-        # Prune listed branches by packages in latest upstream
-        with inbranch('upstream'):
-            pkg_names, version, pkgs_dict = get_package_data('upstream')
-            for branch in branches.copy():
-                if branch.split(prefix)[-1].strip('/') not in pkg_names:
-                    branches.remove(branch)
-    return branches
-
-
-def get_package_from_branch(branch):
-    with inbranch(branch):
-        try:
-            package_data = get_package_data(branch)
-        except SystemExit:
-            return None
-        if type(package_data) not in [list, tuple]:
-            # It is a ret code
-            DebianGenerator.exit(package_data)
-    names, version, packages = package_data
-    if type(names) is list and len(names) > 1:
-        DebianGenerator.exit(
-            "Debian generator does not support generating "
-            "from branches with multiple packages in them, use "
-            "the release generator first to split packages into "
-            "individual branches.")
-    if type(packages) is dict:
-        return list(packages.values())[0]
+    return process_template_folder(path, 'debian', subs, skip_empty=['copyright'])
 
 
 def debianize_string(value):
@@ -631,10 +492,14 @@ def sanitize_package_name(name):
     return name.replace('_', '-')
 
 
-class DebianGenerator(BloomGenerator):
+class DebianGenerator(PackagingGenerator):
     title = 'debian'
     description = "Generates debians from the catkin meta data"
+    packaging_dir = 'debian'
+    template_group = 'bloom.generators.debian'
     has_run_rosdep = os.environ.get('BLOOM_SKIP_ROSDEP_UPDATE', '0').lower() not in ['0', 'f', 'false', 'n', 'no']
+    # Resolution matrix of the keys checked in pre_modify, reused for the substitutions
+    resolutions = None
     default_install_prefix = '/usr'
     rosdistro = os.environ.get('ROS_DISTRO', 'indigo')
 
@@ -657,9 +522,13 @@ class DebianGenerator(BloomGenerator):
         add('--os-not-required', default=False, action="store_true",
             help="Do not error if this os is not in the platforms "
                  "list for rosdistro")
+        add('-j', '--jobs', type=int, default=1,
+            help="number of distros for which the debian files of a package "
+                 "are generated concurrently (1 by default)")
 
     def handle_arguments(self, args):
         self.interactive = args.interactive
+        self.jobs = max(1, args.jobs)
         self.debian_inc = args.debian_inc
         self.os_name = args.os_name
         self.distros = args.distros
@@ -690,8 +559,12 @@ class DebianGenerator(BloomGenerator):
         self.names = []
         self.branch_args = []
         self.debian_branches = []
+        self.distro_branches = {}
+        self.prepared_debians = {}
+        # Parse the package.xml of every branch at once, they are cached
+        get_packages_from_references(self.branches)
         for branch in self.branches:
-            package = get_package_from_branch(branch)
+            package = get_package_from_branch(branch, 'Debian')
             if package is None:
                 # This is an ignored package
                 continue
@@ -700,6 +573,8 @@ class DebianGenerator(BloomGenerator):
             args = self.generate_branching_arguments(package, branch)
             # First branch is debian/[<rosdistro>/]<package>
             self.debian_branches.append(args[0][0])
+            # The rest are debian/[<rosdistro>/]<distro>/<package>
+            self.distro_branches[args[0][0]] = [a[0] for a in args[1:]]
             self.branch_args.extend(args)
 
     def summarize(self):
@@ -711,7 +586,7 @@ class DebianGenerator(BloomGenerator):
         return self.branch_args
 
     def update_rosdep(self):
-        update_rosdep()
+        update_rosdep(force=False)
         self.has_run_rosdep = True
 
     def _check_all_keys_are_valid(self, peer_packages, ros_distro):
@@ -740,13 +615,14 @@ class DebianGenerator(BloomGenerator):
         os_name = self.os_name
         rosdistro = self.rosdistro
         all_keys_valid = True
+        extended_peer_packages = peer_packages + [d.name for d in keys_to_ignore]
+        targets = [(os_name, os_version) for os_version in self.distros]
+        self.resolutions = resolve_rosdep_keys(sorted(set(keys_to_resolve)), targets, rosdistro, extended_peer_packages)
         for key in sorted(set(keys_to_resolve)):
             for os_version in self.distros:
                 try:
-                    extended_peer_packages = peer_packages + [d.name for d in keys_to_ignore]
                     rule, installer_key, default_installer_key = \
-                        resolve_rosdep_key(key, os_name, os_version, rosdistro, extended_peer_packages,
-                                           retry=False)
+                        self.resolutions.resolve(key, os_name, os_version)
                     if rule is None:
                         continue
                     if installer_key != default_installer_key:
@@ -805,15 +681,6 @@ class DebianGenerator(BloomGenerator):
         # Report on this package
         self.summarize_package(package, distro)
 
-    def pre_rebase(self, destination):
-        # Get the stored configs is any
-        patches_branch = 'patches/' + destination
-        config = self.load_original_config(patches_branch)
-        if config is not None:
-            curr_config = get_patch_config(patches_branch)
-            if curr_config['parent'] == config['parent']:
-                set_patch_config(patches_branch, config)
-
     def post_rebase(self, destination):
         name = destination.split('/')[-1]
         # Retrieve the package
@@ -830,10 +697,14 @@ class DebianGenerator(BloomGenerator):
             # Determine the current package being generated
             distro = destination.split('/')[-2]
             # Create debians for each distro
-            with inbranch(destination):
-                data = self.generate_debian(package, distro)
-                # Create the tag name for later
-                self.tag_names[destination] = self.generate_tag_name(data)
+            data = None
+            if destination in self.prepared_debians:
+                data = self.commit_prepared_debian(destination, distro)
+            if data is None:
+                with inbranch(destination):
+                    data = self.generate_debian(package, distro)
+            # Create the tag name for later
+            self.tag_names[destination] = self.generate_tag_name(data)
         # Update the patch configs
         patches_branch = 'patches/' + destination
         config = get_patch_config(patches_branch)
@@ -849,6 +720,8 @@ class DebianGenerator(BloomGenerator):
 
     def post_patch(self, destination, color='bluef'):
         if destination in self.debian_branches:
+            if self.jobs > 1:
+                self.prepare_debians(destination)
             return
         # Tag after patches have been applied
         with inbranch(destination):
@@ -882,20 +755,6 @@ class DebianGenerator(BloomGenerator):
         )
         info(ansi(color) + "####\n" + ansi('reset'), use_prefix=False)
 
-    def store_original_config(self, config, patches_branch):
-        with inbranch(patches_branch):
-            with open('debian.store', 'w+') as f:
-                f.write(json.dumps(config))
-            execute_command('git add debian.store')
-            if has_changes():
-                execute_command('git commit -m "Store original patch config"')
-
-    def load_original_config(self, patches_branch):
-        config_store = show(patches_branch, 'debian.store')
-        if config_store is None:
-            return config_store
-        return json.loads(config_store)
-
     def place_template_files(self, build_type, debian_dir='debian'):
         # Create/Clean the debian folder
         if os.path.exists(debian_dir):
@@ -912,30 +771,8 @@ class DebianGenerator(BloomGenerator):
                     shutil.rmtree(debian_dir)
             else:
                 warning("Not overwriting debian directory.")
-        # Use generic place template files command
-        place_template_files('.', build_type, gbp=True)
-        # Commit results
-        execute_command('git add ' + debian_dir)
-        _, has_files, _ = execute_command('git diff --cached --name-only', return_io=True)
-        if has_files:
-            execute_command('git commit -m "Placing debian template files"')
-
-    def get_releaser_history(self):
-        # Assumes that this is called in the target branch
-        patches_branch = 'patches/' + get_current_branch()
-        raw = show(patches_branch, 'releaser_history.json')
-        return None if raw is None else json.loads(raw)
-
-    def set_releaser_history(self, history):
-        # Assumes that this is called in the target branch
-        patches_branch = 'patches/' + get_current_branch()
-        debug("Writing release history to '{0}' branch".format(patches_branch))
-        with inbranch(patches_branch):
-            with open('releaser_history.json', 'w') as f:
-                f.write(json.dumps(history))
-            execute_command('git add releaser_history.json')
-            if has_changes():
-                execute_command('git commit -m "Store releaser history"')
+        # Commit the template files which are not there yet
+        self.commit_template_files(build_type, gbp=True)
 
     def get_subs(self, package, debian_distro, releaser_history=None):
         return generate_substitutions_from_package(
@@ -947,7 +784,8 @@ class DebianGenerator(BloomGenerator):
             self.debian_inc,
             [p.name for p in self.packages.values()],
             releaser_history=releaser_history,
-            fallback_resolver=missing_dep_resolver
+            fallback_resolver=missing_dep_resolver,
+            resolutions=self.resolutions
         )
 
     def generate_debian(self, package, debian_distro):
@@ -962,17 +800,87 @@ class DebianGenerator(BloomGenerator):
         # Handle gbp.conf
         subs['release_tag'] = self.get_release_tag(subs)
         # Template files
-        template_files = process_template_files('.', subs)
-        # Remove any residual template files
-        execute_command('git rm -rf ' + ' '.join("'{}'".format(t) for t in template_files))
-        # Add changes to the debian folder
-        execute_command('git add debian')
-        # Commit changes
-        execute_command('git commit -m "Generated debian files for ' +
-                        debian_distro + '"')
+        templates = self.expand_template_files(subs, skip_empty=['copyright'])
+        self.commit_template_manifest(get_current_branch(), templates, 'Generated debian files for ' + debian_distro)
         # Return the subs for other use
         return subs
 
+    def prepare_debians(self, debian_branch):
+        """
+        Generates the debian files of every distro branch of a package concurrently.
+
+        The substitutions are computed and the templates are expanded from the
+        contents of the debian branch, for up to ``jobs`` distros at a time.
+        The results are kept until the distro branches are rebased onto the
+        debian branch, when :meth:`commit_prepared_debian` commits them one
+        after another in the usual order.
+        """
+        name = debian_branch.split('/')[-1]
+        package = self.packages[name]
+        destinations = self.distro_branches.get(debian_branch, [])
+        if not destinations:
+            return
+        info("Generating debians for {0} distros concurrently..."
+             .format(len(destinations)))
+        # Resolving a key may prompt and update rosdep, which must not happen in the workers
+        self.resolve_package_keys(package, [destination.split('/')[-2] for destination in destinations])
+        with inbranch(debian_branch):
+            tree = get_object_reader().info(debian_branch + '^{tree}')[0]
+            workers = min(self.jobs, len(destinations))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [(destination, executor.submit(self.expand_debian, package, destination))
+                           for destination in destinations]
+            for destination, future in futures:
+                subs, templates = future.result()
+                self.prepared_debians[destination] = (tree, subs, templates)
+
+    def resolve_package_keys(self, package, debian_distros):
+        """
+        Resolves the dependency keys of a package the pre-verification did not resolve.
+
+        The results are added to the resolutions, so that generating the
+        substitutions of the package for these distros does not need to
+        resolve them again, and so never reaches the interactive retry of
+        :func:`resolve_rosdep_key`.
+        """
+        dependencies = get_package_dependencies(package, self.rosdistro)
+        replaces, conflicts = dependencies[3:]
+        ignored = [p.name for p in self.packages.values()] + [d.name for d in (replaces + conflicts)]
+        for key in sorted(set(d.name for deps in dependencies for d in deps)):
+            for debian_distro in debian_distros:
+                target = (self.os_name, debian_distro)
+                result = self.resolutions.get(key, {}).get(target)
+                if isinstance(result, tuple) and result[0] is not None:
+                    continue
+                self.resolutions.setdefault(key, {})[target] = resolve_rosdep_key(
+                    key, self.os_name, debian_distro, self.rosdistro, ignored, retry=True)
+
+    def expand_debian(self, package, destination):
+        debian_distro = destination.split('/')[-2]
+        info("Generating debian for {0}...".format(debian_distro))
+        releaser_history = self.get_releaser_history(destination)
+        subs = self.get_subs(package, debian_distro, releaser_history)
+        subs['release_tag'] = self.get_release_tag(subs)
+        return subs, self.expand_template_files(subs, skip_empty=['copyright'])
+
+    def commit_prepared_debian(self, destination, debian_distro):
+        """
+        Commits the debian files made by :meth:`prepare_debians` to a distro branch.
+
+        :returns: the substitutions, or None if the branch's contents no longer
+            match the contents the debian files were generated from
+        """
+        tree, subs, templates = self.prepared_debians.pop(destination)
+        if get_object_reader().info(destination + '^{tree}')[0] != tree:
+            warning("Contents of '{0}' changed, not using the prepared debian files."
+                    .format(destination))
+            return None
+        info("Committing the prepared debian files for '{0}'.".format(destination))
+        releaser_history = [(v, (n, e)) for v, _, _, n, e in subs['changelogs']]
+        self.set_releaser_history(dict(releaser_history), destination)
+        self.commit_template_manifest(destination, templates, 'Generated debian files for ' + debian_distro)
+        return subs
+
     def get_release_tag(self, data):
         return 'release/{0}/{1}-{2}'.format(data['Name'], data['Version'],
                                             self.debian_inc)
@@ -33,8 +33,6 @@
 from __future__ import print_function
 
 import datetime
-import io
-import json
 import os
 import re
 import shutil
@@ -46,16 +44,19 @@ from dateutil import tz
 from distutils.version import LooseVersion
 from time import strptime
 
-from bloom.generators import BloomGenerator
-
 from bloom.generators.common import evaluate_package_conditions
 
+from bloom.generators.packaging import convert_to_unicode
+from bloom.generators.packaging import get_package_from_branch
+from bloom.generators.packaging import match_branches_with_prefix
+from bloom.generators.packaging import PackagingGenerator
+from bloom.generators.packaging import place_template_folder
+from bloom.generators.packaging import process_template_folder
+
 from bloom.git import inbranch
 from bloom.git import get_branches
 from bloom.git import get_commit_hash
 from bloom.git import get_current_branch
-from bloom.git import has_changes
-from bloom.git import show
 from bloom.git import tag_exists
 
 from bloom.logging import ansi
@@ -69,17 +70,11 @@ from bloom.logging import warning
 from bloom.commands.git.patch.common import get_patch_config
 from bloom.commands.git.patch.common import set_patch_config
 
-from bloom.packages import get_package_data
+from bloom.packages import get_packages_from_references
 
 from bloom.util import execute_command
-from bloom.util import expand_template_em
 from bloom.util import maybe_continue
 
-if sys.version_info[0:2] < (3, 10):
-    import importlib_resources
-else:
-    import importlib.resources as importlib_resources
-
 try:
     import rosdistro
 except ImportError as err:
@@ -89,38 +84,6 @@ except ImportError as err:
 # Drop the first log prefix for this command
 enable_drop_first_log_prefix(True)
 
-TEMPLATE_EXTENSION = '.em'
-
-
-def __place_template_folder(group, src, dst, gbp=False):
-    template_files = [os.path.basename(file)
-                      for file in importlib_resources.files(f'{group}.{src.replace("/", ".")}').iterdir()]
-    # For each template, place
-    for template_file in template_files:
-        template_path = os.path.join(src, template_file)
-        template_dst = os.path.join(dst, template_file)
-        if importlib_resources.files(group).joinpath(template_path).is_dir():
-            debug("Recursing on folder '{0}'".format(template_path))
-            __place_template_folder(group, template_path, template_dst, gbp)
-        else:
-            try:
-                debug("Placing template '{0}'".format(template_path))
-                template = importlib_resources.files(group).joinpath(template_path).open().read()
-                template_abs_path = importlib_resources.files(group).joinpath(template_path)
-            except IOError as err:
-                error("Failed to load template "
-                      "'{0}': {1}".format(template_file, str(err)), exit=True)
-            if not os.path.exists(dst):
-                os.makedirs(dst)
-            if os.path.exists(template_dst):
-                debug("Removing existing file '{0}'".format(template_dst))
-                os.remove(template_dst)
-            with open(template_dst, 'w') as f:
-                if not isinstance(template, str):
-                    template = template.decode('utf-8')
-                f.write(template)
-            shutil.copystat(template_abs_path, template_dst)
-
 
 def place_template_files(path, build_type, gbp=False):
     info(fmt("@!@{bf}==>@| Placing templates files in the 'rpm' folder."))
@@ -131,7 +94,7 @@ def place_template_files(path, build_type, gbp=False):
     # Place template files
     group = 'bloom.generators.dynrpm'
     templates = os.path.join('templates', build_type)
-    __place_template_folder(group, templates, rpm_path, gbp)
+    place_template_folder(group, templates, rpm_path, gbp, overwrite=True)
 
 
 def generate_substitutions_from_package(
@@ -216,121 +179,14 @@ def generate_substitutions_from_package(
     data['NoArch'] = 'metapackage' in exported_tags or 'architecture_independent' in exported_tags
     data['changelogs'] = changelogs
 
-    def convertToUnicode(obj):
-        if sys.version_info.major == 2:
-            if isinstance(obj, str):
-                return unicode(obj.decode('utf8'))
-            elif isinstance(obj, unicode):
-                return obj
-        else:
-            if isinstance(obj, bytes):
-                return str(obj.decode('utf8'))
-            elif isinstance(obj, str):
-                return obj
-        if isinstance(obj, list):
-            for i, val in enumerate(obj):
-                obj[i] = convertToUnicode(val)
-            return obj
-        elif isinstance(obj, type(None)):
-            return None
-        elif isinstance(obj, tuple):
-            obj_tmp = list(obj)
-            for i, val in enumerate(obj_tmp):
-                obj_tmp[i] = convertToUnicode(obj_tmp[i])
-            return tuple(obj_tmp)
-        elif isinstance(obj, int):
-            return obj
-        elif isinstance(obj, int):
-            return obj
-        raise RuntimeError('need to deal with type %s' % (str(type(obj))))
-
     for item in data.items():
-        data[item[0]] = convertToUnicode(item[1])
+        data[item[0]] = convert_to_unicode(item[1])
 
     return data
 
 
-def __process_template_folder(path, subs):
-    items = os.listdir(path)
-    processed_items = []
-    for item in list(items):
-        item = os.path.abspath(os.path.join(path, item))
-        if os.path.basename(item) in ['.', '..', '.git', '.svn']:
-            continue
-        if os.path.isdir(item):
-            sub_items = __process_template_folder(item, subs)
-            processed_items.extend([os.path.join(item, s) for s in sub_items])
-        if not item.endswith(TEMPLATE_EXTENSION):
-            continue
-        with open(item, 'r') as f:
-            template = f.read()
-        # Remove extension
-        template_path = item[:-len(TEMPLATE_EXTENSION)]
-        # Expand template
-        info("Expanding '{0}' -> '{1}'".format(
-            os.path.relpath(item),
-            os.path.relpath(template_path)))
-        result = expand_template_em(template, subs)
-        # Write the result
-        with io.open(template_path, 'w', encoding='utf-8') as f:
-            if sys.version_info.major == 2:
-                result = result.decode('utf-8')
-            f.write(result)
-        # Copy the permissions
-        shutil.copymode(item, template_path)
-        processed_items.append(item)
-    return processed_items
-
-
 def process_template_files(path, subs):
-    info(fmt("@!@{bf}==>@| In place processing templates in 'rpm' folder."))
-    rpm_dir = os.path.join(path, 'rpm')
-    if not os.path.exists(rpm_dir):
-        sys.exit("No rpm directory found at '{0}', cannot process templates."
-                 .format(rpm_dir))
-    return __process_template_folder(rpm_dir, subs)
-
-
-def match_branches_with_prefix(prefix, get_branches, prune=False):
-    debug("match_branches_with_prefix(" + str(prefix) + ", " +
-          str(get_branches()) + ")")
-    branches = []
-    # Match branches
-    existing_branches = get_branches()
-    for branch in existing_branches:
-        if branch.startswith('remotes/origin/'):
-            branch = branch.split('/', 2)[-1]
-        if branch.startswith(prefix):
-            branches.append(branch)
-    branches = list(set(branches))
-    if prune:
-        # Prune listed branches by packages in latest upstream
-        with inbranch('upstream'):
-            pkg_names, version, pkgs_dict = get_package_data('upstream')
-            for branch in branches.copy():
-                if branch.split(prefix)[-1].strip('/') not in pkg_names:
-                    branches.remove(branch)
-    return branches
-
-
-def get_package_from_branch(branch):
-    with inbranch(branch):
-        try:
-            package_data = get_package_data(branch)
-        except SystemExit:
-            return None
-        if type(package_data) not in [list, tuple]:
-            # It is a ret code
-            DynRpmGenerator.exit(package_data)
-    names, version, packages = package_data
-    if type(names) is list and len(names) > 1:
-        DynRpmGenerator.exit(
-            "RPM generator does not support generating "
-            "from branches with multiple packages in them, use "
-            "the release generator first to split packages into "
-            "individual branches.")
-    if type(packages) is dict:
-        return list(packages.values())[0]
+    return process_template_folder(path, 'rpm', subs)
 
 
 def rpmify_string(value):
@@ -346,10 +202,12 @@ def sanitize_package_name(name):
     return name.replace('_', '-')
 
 
-class DynRpmGenerator(BloomGenerator):
+class DynRpmGenerator(PackagingGenerator):
     title = 'dynrpm'
     description = "Generates RPMs from the catkin meta data"
     default_install_prefix = '/usr'
+    packaging_dir = 'rpm'
+    template_group = 'bloom.generators.dynrpm'
     rosdistro = os.environ.get('ROS_DISTRO', 'indigo')
 
     def prepare_arguments(self, parser):
@@ -393,8 +251,10 @@ class DynRpmGenerator(BloomGenerator):
         self.tag_names = {}
         self.names = []
         self.branch_args = []
+        # Parse the package.xml of every branch at once, they are cached
+        get_packages_from_references(self.branches)
         for branch in self.branches:
-            package = get_package_from_branch(branch)
+            package = get_package_from_branch(branch, 'RPM')
             if package is None:
                 # This is an ignored package
                 continue
@@ -425,15 +285,6 @@ class DynRpmGenerator(BloomGenerator):
         # Report on this package
         self.summarize_package(package)
 
-    def pre_rebase(self, destination):
-        # Get the stored configs is any
-        patches_branch = 'patches/' + destination
-        config = self.load_original_config(patches_branch)
-        if config is not None:
-            curr_config = get_patch_config(patches_branch)
-            if curr_config['parent'] == config['parent']:
-                set_patch_config(patches_branch, config)
-
     def post_rebase(self, destination):
         name = destination.split('/')[-1]
         # Retrieve the package
@@ -494,20 +345,6 @@ class DynRpmGenerator(BloomGenerator):
         )
         info(ansi(color) + "####\n" + ansi('reset'), use_prefix=False)
 
-    def store_original_config(self, config, patches_branch):
-        with inbranch(patches_branch):
-            with open('rpm.store', 'w+') as f:
-                f.write(json.dumps(config))
-            execute_command('git add rpm.store')
-            if has_changes():
-                execute_command('git commit -m "Store original patch config"')
-
-    def load_original_config(self, patches_branch):
-        config_store = show(patches_branch, 'rpm.store')
-        if config_store is None:
-            return config_store
-        return json.loads(config_store)
-
     def place_template_files(self, build_type, rpm_dir='rpm'):
         # Create/Clean the rpm folder
         if os.path.exists(rpm_dir):
@@ -522,28 +359,8 @@ class DynRpmGenerator(BloomGenerator):
             execute_command('git commit -m "Clearing previous rpm folder"')
             if os.path.exists(rpm_dir):
                 shutil.rmtree(rpm_dir)
-        # Use generic place template files command
-        place_template_files('.', build_type, gbp=True)
-        # Commit results
-        execute_command('git add ' + rpm_dir)
-        execute_command('git commit -m "Placing rpm template files"')
-
-    def get_releaser_history(self):
-        # Assumes that this is called in the target branch
-        patches_branch = 'patches/' + get_current_branch()
-        raw = show(patches_branch, 'releaser_history.json')
-        return None if raw is None else json.loads(raw)
-
-    def set_releaser_history(self, history):
-        # Assumes that this is called in the target branch
-        patches_branch = 'patches/' + get_current_branch()
-        debug("Writing release history to '{0}' branch".format(patches_branch))
-        with inbranch(patches_branch):
-            with open('releaser_history.json', 'w') as f:
-                f.write(json.dumps(history))
-            execute_command('git add releaser_history.json')
-            if has_changes():
-                execute_command('git commit -m "Store releaser history"')
+        # Commit the template files
+        self.commit_template_files(build_type, gbp=True)
 
     def get_subs(self, package, releaser_history=None):
         return generate_substitutions_from_package(
@@ -564,19 +381,7 @@ class DynRpmGenerator(BloomGenerator):
         # Use subs to create and store releaser history
         self.set_releaser_history(dict(subs['changelogs']))
         # Template files
-        template_files = process_template_files('.', subs)
-        # Remove any residual template files
-        execute_command('git rm -rf ' + ' '.join("'{}'".format(t) for t in template_files))
-        # Add marker file to tell mock to archive the sources
-        open('.write_tar', 'a').close()
-        # Add marker file changes to the rpm folder
-        execute_command('git add .write_tar ' + rpm_dir)
-        # Commit changes
-        execute_command('git commit -m "Generated dynamic RPM files"')
-        # Rename the template spec file
-        execute_command('git mv ' + rpm_dir + '/template.spec ' + rpm_dir + '/' + subs['Package'] + '.spec')
-        # Commit changes
-        execute_command('git commit -m "Renamed dynamic RPM spec file"')
+        self.commit_spec_files(rpm_dir, subs, 'dynamic RPM files')
         # Return the subs for other use
         return subs
 
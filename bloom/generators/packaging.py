@@ -0,0 +1,334 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2026, Open Source Robotics Foundation, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Open Source Robotics Foundation, Inc. nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Shared core of the packaging generators (debian, rpm and dynrpm).
+
+The per-format generators supply their substitutions and templates, the
+discovery of the packages, storing of the generation metadata in the patches
+branches and committing of the templates and their expansions are done here.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import stat
+import sys
+
+from bloom.generators.common import add_template_manifest
+from bloom.generators.common import BloomGenerator
+from bloom.generators.common import expand_template_folder
+from bloom.generators.common import GeneratorError
+from bloom.generators.common import write_template_manifest
+
+from bloom.git import commit_files
+from bloom.git import CommitBuilder
+from bloom.git import get_current_branch
+from bloom.git import show
+
+from bloom.logging import debug
+from bloom.logging import error
+from bloom.logging import fmt
+from bloom.logging import info
+
+from bloom.commands.git.patch.common import get_patch_config
+from bloom.commands.git.patch.common import set_patch_config
+
+from bloom.packages import get_package_data_from_reference
+
+from bloom.util import code
+
+if sys.version_info[0:2] < (3, 10):
+    import importlib_resources
+else:
+    import importlib.resources as importlib_resources
+
+
+def get_template_folder(group, src, dst, gbp=False):
+    """
+    Loads the packaging templates shipped in a python package.
+
+    :param group: python package containing the templates, e.g. 'bloom.generators.debian'
+    :param src: folder of the templates in group, e.g. 'templates/catkin'
+    :param dst: folder the templates are to be placed in
+    :param gbp: if False the gbp.conf template is skipped
+    :returns: list of (destination, template, resource) tuples
+    """
+    template_files = [os.path.basename(file)
+                      for file in importlib_resources.files(f'{group}.{src.replace("/", ".")}').iterdir()]
+    templates = []
+    # For each template, load
+    for template_file in template_files:
+        if not gbp and os.path.basename(template_file) == 'gbp.conf.em':
+            debug("Skipping template '{0}'".format(template_file))
+            continue
+        template_path = os.path.join(src, template_file)
+        template_dst = os.path.join(dst, template_file)
+        if importlib_resources.files(group).joinpath(template_path).is_dir():
+            debug("Recursing on folder '{0}'".format(template_path))
+            templates.extend(get_template_folder(group, template_path, template_dst, gbp))
+        else:
+            try:
+                debug("Placing template '{0}'".format(template_path))
+                template = importlib_resources.files(group).joinpath(template_path).open().read()
+                template_abs_path = importlib_resources.files(group).joinpath(template_path)
+            except IOError as err:
+                error("Failed to load template "
+                      "'{0}': {1}".format(template_file, str(err)), exit=True)
+            if not isinstance(template, str):
+                template = template.decode('utf-8')
+            templates.append((template_dst, template, template_abs_path))
+    return templates
+
+
+def place_template_folder(group, src, dst, gbp=False, overwrite=False):
+    """
+    Writes the templates of :func:`get_template_folder` to dst.
+
+    :param overwrite: if True existing files are replaced, otherwise they are kept
+    """
+    for template_dst, template, template_abs_path in get_template_folder(group, src, dst, gbp):
+        if not os.path.exists(os.path.dirname(template_dst)):
+            os.makedirs(os.path.dirname(template_dst))
+        if os.path.exists(template_dst):
+            if not overwrite:
+                debug("Not overwriting existing file '{0}'".format(template_dst))
+                continue
+            debug("Removing existing file '{0}'".format(template_dst))
+            os.remove(template_dst)
+        with open(template_dst, 'w', encoding='utf-8') as f:
+            f.write(template)
+        shutil.copystat(template_abs_path, template_dst)
+
+
+def process_template_folder(path, folder, subs, skip_empty=()):
+    """
+    Expands the templates of a packaging folder in place.
+
+    :param path: path containing the packaging folder
+    :param folder: name of the packaging folder, e.g. 'debian'
+    :param subs: substitutions for the templates
+    :param skip_empty: names of outputs which should not be written if empty
+    :returns: list of the template paths
+    """
+    info(fmt("@!@{bf}==>@| In place processing templates in '" + folder + "' folder."))
+    folder_path = os.path.join(path, folder)
+    if not os.path.exists(folder_path):
+        sys.exit("No {0} directory found at '{1}', cannot process templates."
+                 .format(folder, folder_path))
+    return write_template_manifest(expand_template_folder(folder_path, subs, skip_empty))
+
+
+def match_branches_with_prefix(prefix, get_branches, prune=False):
+    debug("match_branches_with_prefix(" + str(prefix) + ", " +
+          str(get_branches()) + ")")
+    branches = []
+    # Match branches
+    existing_branches = get_branches()
+    for branch in existing_branches:
+        if branch.startswith('remotes/origin/'):
+            branch = branch.split('/', 2)[-1]
+        if branch.startswith(prefix):
+            branches.append(branch)
+    branches = list(set(branches))
+    if prune:
+        # Prune listed branches by packages in latest upstream
+        pkg_names, version, pkgs_dict = get_package_data_from_reference('upstream')
+        for branch in branches.copy():
+            if branch.split(prefix)[-1].strip('/') not in pkg_names:
+                branches.remove(branch)
+    return branches
+
+
+def get_package_from_branch(branch, generator_name):
+    try:
+        package_data = get_package_data_from_reference(branch)
+    except SystemExit:
+        return None
+    if type(package_data) not in [list, tuple]:
+        # It is a ret code
+        BloomGenerator.exit(package_data)
+    names, version, packages = package_data
+    if type(names) is list and len(names) > 1:
+        BloomGenerator.exit(
+            generator_name + " generator does not support generating "
+            "from branches with multiple packages in them, use "
+            "the release generator first to split packages into "
+            "individual branches.")
+    if type(packages) is dict:
+        return list(packages.values())[0]
+
+
+def convert_to_unicode(obj):
+    """Converts the str values of substitutions, recursively, to unicode"""
+    if sys.version_info.major == 2:
+        if isinstance(obj, str):
+            return unicode(obj.decode('utf8'))
+        elif isinstance(obj, unicode):
+            return obj
+    else:
+        if isinstance(obj, bytes):
+            return str(obj.decode('utf8'))
+        elif isinstance(obj, str):
+            return obj
+    if isinstance(obj, list):
+        for i, val in enumerate(obj):
+            obj[i] = convert_to_unicode(val)
+        return obj
+    elif isinstance(obj, type(None)):
+        return None
+    elif isinstance(obj, tuple):
+        obj_tmp = list(obj)
+        for i, val in enumerate(obj_tmp):
+            obj_tmp[i] = convert_to_unicode(obj_tmp[i])
+        return tuple(obj_tmp)
+    elif isinstance(obj, int):
+        return obj
+    raise RuntimeError('need to deal with type %s' % (str(type(obj))))
+
+
+class PackagingGenerator(BloomGenerator):
+    """
+    Base of the generators which place packaging files into branches.
+
+    Subclasses set :attr:`packaging_dir` and :attr:`template_group` and
+    provide the substitutions, this class stores the generation metadata and
+    commits the templates and their expansions, without checkouts.
+    """
+    # Folder of the packaging files in the generated branches, e.g. 'debian'
+    packaging_dir = None
+    # Python package holding the templates, in a 'templates/<build type>' folder
+    template_group = None
+
+    def store_original_config(self, config, patches_branch):
+        commit_files(patches_branch, {self.packaging_dir + '.store': json.dumps(config)},
+                     "Store original patch config")
+
+    def load_original_config(self, patches_branch):
+        config_store = show(patches_branch, self.packaging_dir + '.store')
+        if config_store is None:
+            return config_store
+        return json.loads(config_store)
+
+    def pre_rebase(self, destination):
+        # Get the stored configs is any
+        patches_branch = 'patches/' + destination
+        config = self.load_original_config(patches_branch)
+        if config is not None:
+            curr_config = get_patch_config(patches_branch)
+            if curr_config['parent'] == config['parent']:
+                set_patch_config(patches_branch, config)
+
+    def get_releaser_history(self, branch=None):
+        # Assumes that this is called in the target branch, unless given
+        patches_branch = 'patches/' + (branch or get_current_branch())
+        raw = show(patches_branch, 'releaser_history.json')
+        return None if raw is None else json.loads(raw)
+
+    def set_releaser_history(self, history, branch=None):
+        # Assumes that this is called in the target branch, unless given
+        patches_branch = 'patches/' + (branch or get_current_branch())
+        debug("Writing release history to '{0}' branch".format(patches_branch))
+        commit_files(patches_branch, {'releaser_history.json': json.dumps(history)}, "Store releaser history")
+
+    def commit_template_files(self, build_type, gbp=False):
+        """
+        Commits the templates which are missing from the current branch.
+
+        :returns: hash of the new commit, or None if nothing was missing
+        """
+        info(fmt("@!@{bf}==>@| Placing templates files in the '" + self.packaging_dir + "' folder."))
+        builder = CommitBuilder(get_current_branch())
+        templates = os.path.join('templates', build_type)
+        for template_dst, template, template_abs_path in \
+                get_template_folder(self.template_group, templates, self.packaging_dir, gbp):
+            if os.path.exists(template_dst):
+                debug("Not overwriting existing file '{0}'".format(template_dst))
+                continue
+            executable = bool(os.stat(str(template_abs_path)).st_mode & stat.S_IXUSR)
+            builder.add(template_dst, template, executable=executable)
+        return builder.commit("Placing " + self.packaging_dir + " template files")
+
+    def expand_template_files(self, subs, skip_empty=()):
+        """
+        Expands the templates in the packaging folder of the current branch.
+
+        :returns: template manifest, see :func:`bloom.generators.expand_template_folder`
+        """
+        info(fmt("@!@{bf}==>@| Processing templates in '" + self.packaging_dir + "' folder."))
+        if not os.path.exists(self.packaging_dir):
+            sys.exit("No {0} directory found, cannot process templates.".format(self.packaging_dir))
+        return expand_template_folder(self.packaging_dir, subs, skip_empty)
+
+    def commit_template_manifest(self, branch, manifest, message, files=None):
+        """
+        Replaces the templates of a manifest with their expansions in a single commit.
+
+        :param branch: branch to commit to
+        :param manifest: template manifest with paths relative to the repository root
+        :param message: commit message
+        :param files: dict of additional files to commit, paths to contents
+        :returns: hash of the new commit, or None if nothing changed
+        """
+        builder = CommitBuilder(branch)
+        add_template_manifest(builder, manifest)
+        for path, data in (files or {}).items():
+            builder.add(path, data)
+        return builder.commit(message)
+
+    def commit_spec_files(self, spec_dir, subs, description):
+        """
+        Commits the expanded templates of the current branch and names the spec file after the package.
+
+        :param spec_dir: folder of the ``template.spec`` template, e.g. 'rpm'
+        :param subs: substitutions, ``subs['Package']`` names the spec file
+        :param description: what was generated, e.g. 'RPM files for fedora'
+        :raises: :exc:`GeneratorError` if no ``template.spec`` was generated
+        """
+        branch = get_current_branch()
+        # Add marker file to tell mock to archive the sources
+        files = {} if os.path.exists('.write_tar') else {'.write_tar': ''}
+        self.commit_template_manifest(branch, self.expand_template_files(subs), 'Generated ' + description, files)
+        # Rename the template spec file
+        template_spec = spec_dir + '/template.spec'
+        spec = show(branch, template_spec)
+        if not isinstance(spec, str):
+            raise GeneratorError("The RPM spec file '{0}' was not generated in '{1}'."
+                                 .format(template_spec, branch),
+                                 returncode=code.GENERATOR_FAILED_TO_LOAD_TEMPLATE)
+        builder = CommitBuilder(branch)
+        builder.remove(template_spec)
+        builder.add(spec_dir + '/' + subs['Package'] + '.spec', spec)
+        builder.commit('Renamed ' + description.replace(' files', ' spec file'))
@@ -85,7 +85,8 @@ class RosRpmGenerator(RpmGenerator):
             [p.name for p in self.packages.values()],
             releaser_history=releaser_history,
             fallback_resolver=fallback_resolver,
-            skip_keys=self.skip_keys
+            skip_keys=self.skip_keys,
+            resolutions=self.resolutions
         )
         subs['Rosdistro'] = self.rosdistro
         subs['Package'] = rosify_package_name(subs['Package'], self.rosdistro)
@@ -34,15 +34,19 @@
 
 from __future__ import print_function
 
+import atexit
 import os
 import functools
 import re
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 
 from subprocess import PIPE
 from subprocess import CalledProcessError
+from subprocess import Popen
 
 from bloom.logging import debug
 from bloom.logging import error
@@ -50,17 +54,34 @@ from bloom.logging import fmt
 from bloom.logging import info
 from bloom.logging import warning
 
-from bloom.util import change_directory
 from bloom.util import check_output
 from bloom.util import execute_command
 from bloom.util import get_git_clone_state
+from bloom.util import get_git_env
 from bloom.util import get_git_clone_state_quiet
 from bloom.util import pdb_hook
 import bloom.util
 
 
 class GitClone(object):
-    def __init__(self, directory=None, track_all=True):
+    """
+    Transactional safety mechanism for commands which modify a repository.
+
+    The repository is cloned into a temporary directory, the command runs
+    in the clone (see :meth:`__enter__`), and :meth:`commit` brings the
+    changes back into the working repository.
+
+    By default a full clone is made. With ``shared=True`` the clone borrows
+    the objects of the working repository (``git clone --shared``) rather
+    than copying them. Either way :meth:`commit` publishes the changed refs
+    of the clone in a single atomic push, so either every ref is updated or
+    none is.
+
+    :param directory: working repository, defaults to the current directory
+    :param track_all: if True, track all remote branches before cloning
+    :param shared: if True, borrow the objects of the working repository
+    """
+    def __init__(self, directory=None, track_all=True, shared=False):
         self.disabled = get_git_clone_state()
         self.disabled_quiet = get_git_clone_state_quiet()
         if self.disabled:
@@ -73,14 +94,20 @@ class GitClone(object):
             raise RuntimeError("Provided directory, '" + str(directory) +
                                "', is not a git repository")
         self.track_all = track_all
+        self.shared = shared
         if self.track_all:
             track_branches(directory=directory)
-        self.current_branches = get_branches()
         self.tmp_dir = tempfile.mkdtemp()
         self.clone_dir = os.path.join(self.tmp_dir, 'clone')
-        self.repo_url = 'file://' + os.path.abspath(self.directory)
         info(fmt("@!@{gf}+++@| Cloning working copy for safety"))
-        execute_command('git clone ' + self.repo_url + ' ' + self.clone_dir)
+        if self.shared:
+            # Borrow the objects of the working copy instead of copying them
+            self.repo_url = os.path.abspath(self.directory)
+            execute_command('git clone --shared --quiet "{0}" "{1}"'
+                            .format(self.repo_url, self.clone_dir))
+        else:
+            self.repo_url = 'file://' + os.path.abspath(self.directory)
+            execute_command('git clone ' + self.repo_url + ' ' + self.clone_dir)
 
     def __del__(self):
         if self.disabled:
@@ -109,44 +136,247 @@ class GitClone(object):
         if self.disabled:
             return
         if self.tmp_dir is not None and os.path.exists(self.tmp_dir):
+            close_object_readers(self.tmp_dir)
             shutil.rmtree(self.tmp_dir)
             self.tmp_dir = None
 
+    def get_ref_delta(self):
+        """
+        Returns the refs which differ between the clone and the working copy.
+
+        Branches and tags which only exist in the working copy are left alone.
+
+        :returns: list of ``(ref, sha, force)`` tuples, where ``force`` is
+            True for existing tags which point somewhere else in the clone and
+            for existing branches which the clone rewrote, i.e. which can not
+            be fast-forwarded
+        """
+        clone = RefSnapshot(self.clone_dir)
+        working = RefSnapshot(self.directory)
+        delta = []
+        for branch, sha in sorted(clone.heads.items()):
+            working_sha = working.heads.get(branch)
+            if working_sha != sha:
+                force = working_sha is not None and not self._is_ancestor(working_sha, sha)
+                delta.append(('refs/heads/' + branch, sha, force))
+        for tag, sha in sorted(clone.tags.items()):
+            if working.tags.get(tag) != sha:
+                delta.append(('refs/tags/' + tag, sha, tag in working.tags))
+        return delta
+
+    def _is_ancestor(self, ancestor, sha):
+        try:
+            check_output(['git', 'merge-base', '--is-ancestor', ancestor, sha], cwd=self.clone_dir, stderr=PIPE)
+        except CalledProcessError:
+            # Not an ancestor, or not even known to the clone
+            return False
+        return True
+
     def commit(self):
         if self.disabled:
             return
         info(fmt("@{bf}<==@| Command successful, committing changes to working copy"))
-        current_branch = get_current_branch()
+        start = time.time()
+        current_branch = get_current_branch(self.directory)
         if current_branch is None:
             error("Could not determine current branch.", exit=True)
-        with inbranch(get_commit_hash(get_current_branch())):
-            with change_directory(self.clone_dir):
-                new_branches = get_branches()
-                for branch in self.current_branches:
-                    if branch in new_branches:
-                        new_branches.remove(branch)
-                for branch in get_branches(local_only=True):
-                    if branch not in new_branches:
-                        with inbranch(branch):
-                            cmd = 'git pull --rebase origin ' + branch
-                            execute_command(cmd)
-                execute_command('git push --all', silent=False)
-                try:
-                    execute_command('git push --tags', silent=False)
-                except subprocess.CalledProcessError:
-                    warning("Force pushing tags from clone to working repository, "
-                            "you will have to force push back to origin...")
-                    execute_command('git push --force --tags', silent=False)
-
+        delta = self.get_ref_delta()
+        refspecs = []
+        for ref, sha, force in delta:
+            if force and ref.startswith('refs/tags/'):
+                warning("Force pushing tag '{0}' from clone to working repository, "
+                        "you will have to force push back to origin..."
+                        .format(ref[len('refs/tags/'):]))
+            elif force:
+                warning("Force pushing branch '{0}', which was rewritten in the clone, "
+                        "to the working repository...".format(ref[len('refs/heads/'):]))
+            refspecs.append('{0}{1}:{1}'.format('+' if force else '', ref))
+        if refspecs:
+            cmd = ['git', 'push', '--atomic', '--quiet', 'origin'] + refspecs
+            if 'refs/heads/' + current_branch in [ref for ref, _, _ in delta]:
+                # Detach HEAD so that the current branch of the working copy can be updated
+                with inbranch(get_commit_hash(current_branch, self.directory), directory=self.directory):
+                    execute_command(cmd, shell=False, cwd=self.clone_dir, silent=False)
+            else:
+                execute_command(cmd, shell=False, cwd=self.clone_dir, silent=False)
+        info(fmt("@{bf}<==@| Updated ") + "{0} refs in the working copy in {1:.2f} seconds"
+             .format(len(refspecs), time.time() - start))
         self.clean_up()
 
 
+class GitObjectReader(object):
+    """
+    Reads objects from a repository through long running ``git cat-file``
+    processes.
+
+    One ``git cat-file --batch-check`` process answers object lookups and one
+    ``git cat-file --batch`` process returns object contents, each is started
+    on first use and kept alive until :meth:`close` is called.
+
+    :param directory: directory in which to run the ``git cat-file`` processes
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def _get_process(self, option):
+        process = self._processes.get(option)
+        if process is None or process.poll() is not None:
+            process = Popen(['git', 'cat-file', option], cwd=self.directory, env=get_git_env(),
+                            stdin=PIPE, stdout=PIPE, stderr=subprocess.DEVNULL)
+            self._processes[option] = process
+        return process
+
+    def _request(self, option, rev):
+        if '\n' in rev:
+            return None, None
+        process = self._get_process(option)
+        try:
+            process.stdin.write(rev.encode('utf-8') + b'\n')
+            process.stdin.flush()
+            header = process.stdout.readline()
+        except (IOError, OSError):
+            header = b''
+        if not header:
+            self._close_process(option)
+            raise CalledProcessError(process.poll() or 1, 'git cat-file ' + option)
+        header = header.decode('utf-8').rstrip('\n')
+        if header.endswith(' missing') or header.endswith(' ambiguous'):
+            return None, None
+        sha, kind, size = header.split()
+        if option != '--batch':
+            return (sha, kind, int(size)), None
+        data = process.stdout.read(int(size))
+        process.stdout.read(1)  # Trailing newline
+        return (sha, kind, int(size)), data
+
+    def info(self, rev):
+        """
+        Returns the ``(sha, type, size)`` of the given revision, or None.
+
+        :param rev: any revision git understands, e.g. ``master:tracks.yaml``
+        :raises: subprocess.CalledProcessError if git could not be queried
+        """
+        with self._lock:
+            return self._request('--batch-check', rev)[0]
+
+    def read(self, rev):
+        """
+        Returns the ``(sha, type, data)`` of the given revision, or None.
+
+        :param rev: any revision git understands, e.g. ``master:tracks.yaml``
+        :raises: subprocess.CalledProcessError if git could not be queried
+        """
+        with self._lock:
+            info, data = self._request('--batch', rev)
+        if info is None:
+            return None
+        return info[0], info[1], data
+
+    def _close_process(self, option):
+        process = self._processes.pop(option, None)
+        if process is None:
+            return
+        for stream in (process.stdin, process.stdout):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        process.wait()
+
+    def close(self):
+        with self._lock:
+            for option in list(self._processes.keys()):
+                self._close_process(option)
+
+
+_object_readers = {}
+_object_readers_lock = threading.Lock()
+
+
+def get_object_reader(directory=None):
+    """
+    Returns the shared :class:`GitObjectReader` for the given directory.
+
+    :param directory: directory of the repository, the cwd if None
+    """
+    directory = os.path.abspath(directory or os.getcwd())
+    with _object_readers_lock:
+        if directory not in _object_readers:
+            _object_readers[directory] = GitObjectReader(directory)
+        return _object_readers[directory]
+
+
+@atexit.register
+def close_object_readers(directory=None):
+    """
+    Stops the ``git cat-file`` processes at or below the given directory.
+
+    :param directory: directory to close readers for, all readers if None
+    """
+    prefix = None if directory is None else os.path.abspath(directory)
+    with _object_readers_lock:
+        for path in list(_object_readers.keys()):
+            if prefix is None or path == prefix or path.startswith(prefix + os.sep):
+                _object_readers.pop(path).close()
+
+
+def _parse_tree(data, hash_length=20):
+    items = {}
+    index = 0
+    while index < len(data):
+        space = data.index(b' ', index)
+        nul = data.index(b'\0', space)
+        mode = data[index:space]
+        name = data[space + 1:nul].decode('utf-8')
+        if mode == b'160000':
+            raise RuntimeError("item not a blob or tree")
+        if name in items:
+            raise RuntimeError("duplicate name in ls tree")
+        items[name] = 'directory' if mode == b'40000' else 'file'
+        # Skip over the raw object name which follows the name
+        index = nul + 1 + hash_length
+    return items
+
+
+def _parse_tree_entries(data, hash_length=20):
+    entries = {}
+    index = 0
+    while index < len(data):
+        space = data.index(b' ', index)
+        nul = data.index(b'\0', space)
+        mode = data[index:space].decode('utf-8')
+        name = data[space + 1:nul].decode('utf-8')
+        sha = data[nul + 1:nul + 1 + hash_length]
+        entries[name] = (mode, ''.join('{0:02x}'.format(c) for c in bytearray(sha)))
+        index = nul + 1 + hash_length
+    return entries
+
+
+def _read_object(reference, path, directory):
+    """Reads 'reference:path', tracking reference as a branch if needed"""
+    reader = get_object_reader(directory)
+    rev = reference if not path else reference + ':' + path
+    if not path:
+        rev += '^{tree}'
+    try:
+        obj = reader.read(rev)
+        if obj is None and reader.info(reference) is None:
+            # Try to track the reference as a branch
+            track_branches(reference, directory=directory)
+            obj = reader.read(rev)
+    except CalledProcessError:
+        return None
+    return obj
+
+
 def ls_tree(reference, path=None, directory=None):
     """
     Returns a dictionary of files and folders for a given reference and path.
 
-    Implemented using ``git ls-tree``. If an invalid reference and/or path
-    None is returned.
+    Implemented using ``git cat-file --batch``. If an invalid reference and/or
+    path None is returned.
 
     :param reference: git reference to pull from (branch, tag, or commit)
     :param path: tree to list
@@ -157,26 +387,30 @@ def ls_tree(reference, path=None, directory=None):
     :raises: subprocess.CalledProcessError if any git calls fail
     :raises: RuntimeError if the output from git is not what we expected
     """
-    # Try to track the reference as a branch
-    track_branches(reference, directory=directory)
-    cmd = 'git ls-tree ' + reference
-    if path is not None and path != '':
-        cmd += ':' + path
-    retcode, out, err = execute_command(cmd, autofail=False, silent_error=True,
-                                        cwd=directory, return_io=True)
-    if retcode != 0:
+    obj = _read_object(reference, path, directory)
+    if obj is None or obj[1] != 'tree':
         return None
-    items = {}
-    for line in out.splitlines():
-        tokens = line.split()
-        if len(tokens) != 4:
-            return None
-        if tokens[1] not in ['blob', 'tree']:
-            raise RuntimeError("item not a blob or tree")
-        if tokens[3] in items:
-            raise RuntimeError("duplicate name in ls tree")
-        items[tokens[3]] = 'file' if tokens[1] == 'blob' else 'directory'
-    return items
+    return _parse_tree(obj[2], len(obj[0]) // 2)
+
+
+def get_tree_entries(reference, path=None, directory=None):
+    """
+    Returns the entries of a tree with their modes and object names.
+
+    Like :func:`ls_tree`, but submodules are listed too, and each name maps to
+    a ``(mode, sha)`` tuple, e.g. ``('100644', '<sha>')``, so the objects can
+    be read without checking out the reference.
+
+    :param reference: git reference to pull from (branch, tag, or commit)
+    :param path: tree to list
+    :param directory: directory in which to run this command
+
+    :returns: dict if a directory (or a reference) or None if it does not exist
+    """
+    obj = _read_object(reference, path, directory)
+    if obj is None or obj[1] != 'tree':
+        return None
+    return _parse_tree_entries(obj[2], len(obj[0]) // 2)
 
 
 def show(reference, path, directory=None):
@@ -197,20 +431,17 @@ def show(reference, path, directory=None):
 
     :raises: subprocess.CalledProcessError if any git calls fail
     """
-    # Check to see if this is a directory
-    dirs = ls_tree(reference, path, directory)
-    if dirs is not None:
-        return dirs
-    # Otherwise a file or does not exist, check for the file
-    cmd = 'git show {0}:{1}'.format(reference, path)
-    # Check to see if it is a directory
-    retcode, out, err = execute_command(cmd, autofail=False, silent_error=True,
-                                        cwd=directory, return_io=True)
-    if retcode != 0:
+    obj = _read_object(reference, path, directory)
+    if obj is None:
         # Does not exist
         return None
-    # It is a file that exists, return the output
-    return out
+    sha, kind, data = obj
+    if kind == 'tree':
+        return _parse_tree(data, len(sha) // 2)
+    if kind != 'blob':
+        return None
+    # It is a file that exists, return the contents
+    return data.decode('utf-8')
 
 
 def ensure_clean_working_env(force=False, git_status=True, directory=None):
@@ -302,8 +533,11 @@ def checkout(reference, raise_exc=False, directory=None, show_git_status=True):
         fail_msg = "has untracked files"
     try:
         if not changes and not untracked:
+            snapshot = _get_cached_ref_snapshot(directory)
             execute_command('git checkout "{0}"'.format(str(reference)),
                             cwd=directory)
+            if snapshot is not None:
+                snapshot.checked_out(str(reference))
 
     except CalledProcessError as err:
         fail_msg = "CalledProcessError: " + str(err)
@@ -360,23 +594,187 @@ class inbranch(ContextDecorator):
             warning("Could not determine branch to return to.")
 
 
+class RefSnapshot(object):
+    """
+    Snapshot of the branches, tags and HEAD of a repository.
+
+    The snapshot is built from a single ``git for-each-ref`` call and is
+    answered from dictionaries afterwards. bloom's own ref changing helpers
+    update cached snapshots in place, any other git command which might
+    change refs invalidates them, see :func:`bloom.util.get_git_state_generation`.
+
+    :param directory: directory in which to run ``git for-each-ref``
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.generation = bloom.util.get_git_state_generation()
+        cmd = ['git', 'for-each-ref', '--format=%(HEAD)%(refname) %(objectname) %(symref)']
+        out = check_output(cmd, cwd=directory)
+        self.head = None
+        self.heads = {}
+        self.remotes = {}
+        self.tags = {}
+        self._untracked = None
+        for line in out.splitlines():
+            tokens = line[1:].split(' ')
+            if len(tokens) != 3:
+                continue
+            ref, sha, symref = tokens
+            if ref.startswith('refs/heads/'):
+                self.heads[ref[len('refs/heads/'):]] = sha
+                if line.startswith('*'):
+                    self.head = ref[len('refs/heads/'):]
+            elif ref.startswith('refs/remotes/') and not symref:
+                self.remotes[ref[len('refs/remotes/'):]] = sha
+            elif ref.startswith('refs/tags/'):
+                self.tags[ref[len('refs/tags/'):]] = sha
+
+    def get_untracked_branches(self):
+        """
+        Returns the remote branches which have no local branch of the same name.
+
+        The index is computed once per snapshot and kept up to date by the
+        snapshot's update methods.
+
+        :returns: dict of local branch names to lists of remote branches,
+            e.g. ``{'foo': ['remotes/origin/foo']}``
+        """
+        if self._untracked is None:
+            self._untracked = {}
+            for remote_branch in self.remotes:
+                if remote_branch.count('/') < 1:
+                    continue
+                local_name = remote_branch.split('/', 1)[1]
+                if local_name not in self.heads:
+                    self._untracked.setdefault(local_name, []).append('remotes/' + remote_branch)
+        return self._untracked
+
+    def remote_branch_exists(self, branch_name):
+        for remote_branch in self.remotes:
+            if remote_branch.count('/') >= 1 and remote_branch.split('/', 1)[1] == branch_name:
+                return True
+        return False
+
+    def _refresh(self):
+        # Called after a change made through bloom.git was applied to this snapshot
+        self.generation = bloom.util.get_git_state_generation()
+
+    def _add_head(self, branch, sha):
+        self.heads[branch] = sha
+        if self._untracked is not None:
+            self._untracked.pop(branch, None)
+
+    def branch_created(self, branch):
+        sha = get_object_reader(self.directory).info('refs/heads/' + branch)
+        if sha is not None:
+            self._add_head(branch, sha[0])
+        self._refresh()
+
+    def branches_tracked(self, branches):
+        for branch, remote_branch in branches.items():
+            self._add_head(branch, self.remotes[remote_branch[len('remotes/'):]])
+        self._refresh()
+
+    def tag_created(self, tag):
+        sha = get_object_reader(self.directory).info('refs/tags/' + tag)
+        if sha is not None:
+            self.tags[tag] = sha[0]
+        self._refresh()
+
+    def tag_deleted(self, tag):
+        self.tags.pop(tag, None)
+        self._refresh()
+
+    def checked_out(self, reference):
+        if reference not in self.heads:
+            remote_branches = [r for r in self.remotes
+                               if r.count('/') >= 1 and r.split('/', 1)[1] == reference]
+            if len(remote_branches) != 1:
+                # Detached HEAD, or something git might have guessed differently
+                self.generation = None
+                return
+            # git checkout creates a tracking branch for a unique remote branch
+            self._add_head(reference, self.remotes[remote_branches[0]])
+        self.head = reference
+        self._refresh()
+
+
+_ref_snapshots = {}
+_ref_cache_depth = 0
+
+
+class ref_cache(ContextDecorator):
+    """
+    Reuses ref snapshots of repositories while the context is active.
+
+    Only use this around code which is the sole writer of the repository,
+    like a generator running in a :class:`GitClone`, as changes made by other
+    processes are not noticed.
+
+    Combination decorator/context manager, like :class:`inbranch`.
+    """
+    def __enter__(self):
+        global _ref_cache_depth
+        _ref_cache_depth += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _ref_cache_depth
+        _ref_cache_depth -= 1
+        if _ref_cache_depth == 0:
+            _ref_snapshots.clear()
+
+
+def _get_cached_ref_snapshot(directory):
+    if not _ref_cache_depth:
+        return None
+    snapshot = _ref_snapshots.get(os.path.abspath(directory or os.getcwd()))
+    if snapshot is None or snapshot.generation != bloom.util.get_git_state_generation():
+        return None
+    return snapshot
+
+
+def get_ref_snapshot(directory=None):
+    """
+    Returns a :class:`RefSnapshot` of the given repository.
+
+    Inside of a :class:`ref_cache` context, snapshots are reused until a git
+    command which might change the refs is run.
+
+    :param directory: directory in which to preform this action
+    :returns: RefSnapshot of the repository
+
+    :raises: subprocess.CalledProcessError if any git calls fail
+    """
+    snapshot = _get_cached_ref_snapshot(directory)
+    if snapshot is None:
+        snapshot = RefSnapshot(directory)
+        if _ref_cache_depth:
+            _ref_snapshots[os.path.abspath(directory or os.getcwd())] = snapshot
+    return snapshot
+
+
 def get_commit_hash(reference, directory=None):
     """
-    Returns the SHA-1 commit hash for the given reference.
+    Returns the full commit hash for the given reference.
 
     :param reference: any git reference (branch or tag) to resolve to SHA-1
     :param directory: directory in which to preform this action
-    :returns: SHA-1 commit hash for the given reference
+    :returns: commit hash for the given reference
 
     :raises: subprocess.CalledProcessError if any git calls fail
     """
-    # Track remote branch
-    if branch_exists(reference, local_only=False, directory=directory):
-        if not branch_exists(reference, local_only=True, directory=directory):
-            track_branches(reference, directory)
-    cmd = 'git show-branch --sha1-name ' + reference
-    out = check_output(cmd, shell=True, cwd=directory)
-    return out.split('[')[1].split(']')[0]
+    reader = get_object_reader(directory)
+    rev = reference + '^{commit}'
+    obj = reader.info(rev)
+    if obj is None:
+        # Track remote branch
+        if branch_exists(reference, local_only=False, directory=directory):
+            if not branch_exists(reference, local_only=True, directory=directory):
+                track_branches(reference, directory)
+        obj = reader.info(rev)
+    if obj is None:
+        raise CalledProcessError(128, 'git cat-file --batch-check ' + rev)
+    return obj[0]
 
 
 def has_untracked_files(directory=None):
@@ -415,6 +813,27 @@ def has_changes(directory=None):
     return True
 
 
+def get_clean_tree_hash(directory=None):
+    """
+    Returns the sha of the committed tree of a directory if it is clean.
+
+    The directory is clean if nothing in it has local changes and there are no
+    untracked files in it, so the tree identifies its contents. Ignored files
+    are not looked at, listing them can take longer than reading the tree.
+
+    :param directory: directory to get the tree of, the cwd if None
+    :returns: sha of the tree of the directory in HEAD, or None if the
+        directory is not clean or not in a git repository
+    """
+    try:
+        tree_hash = check_output('git rev-parse HEAD:./', shell=True, cwd=directory, stderr=PIPE).strip()
+        out = check_output('git status --porcelain --untracked-files=normal -- .', shell=True,
+                           cwd=directory, stderr=PIPE)
+    except CalledProcessError:
+        return None
+    return None if out.strip() else tree_hash
+
+
 def tag_exists(tag, directory=None):
     """
     Returns True if the given tag exists, False otherwise
@@ -425,7 +844,7 @@ def tag_exists(tag, directory=None):
 
     :raises: subprocess.CalledProcessError if any git calls fail
     """
-    return tag in get_tags(directory)
+    return tag in get_ref_snapshot(directory).tags
 
 
 def create_tag(tag, directory=None):
@@ -437,7 +856,10 @@ def create_tag(tag, directory=None):
 
     :raises: subprocess.CalledProcessError if any git calls fail
     """
+    snapshot = _get_cached_ref_snapshot(directory)
     execute_command('git tag {0}'.format(tag), shell=True, cwd=directory)
+    if snapshot is not None:
+        snapshot.tag_created(tag)
 
 
 def delete_tag(tag, directory=None):
@@ -449,7 +871,10 @@ def delete_tag(tag, directory=None):
 
     :raises: subprocess.CalledProcessError if any git calls fail
     """
+    snapshot = _get_cached_ref_snapshot(directory)
     execute_command('git tag -d {0}'.format(tag), shell=True, cwd=directory)
+    if snapshot is not None:
+        snapshot.tag_deleted(tag)
 
 
 def delete_remote_tag(tag, remote='origin', directory=None):
@@ -475,8 +900,7 @@ def get_tags(directory=None):
 
     :raises: subprocess.CalledProcessError if any git calls fail
     """
-    out = check_output('git tag -l', shell=True, cwd=directory)
-    return [l.strip() for l in out.splitlines()]
+    return list(get_ref_snapshot(directory).tags)
 
 
 def branch_exists(branch_name, local_only=False, directory=None):
@@ -491,17 +915,10 @@ def branch_exists(branch_name, local_only=False, directory=None):
 
     :raises: subprocess.CalledProcessError if any git calls fail
     """
-    for branch in get_branches(local_only, directory):
-        if branch.startswith('remotes/'):
-            branch = branch.split('/')
-            if len(branch) > 2:
-                branch = '/'.join(branch[2:])
-                if branch_name == branch:
-                    return True
-        else:
-            if branch_name == branch:
-                return True
-    return False
+    snapshot = get_ref_snapshot(directory)
+    if branch_name in snapshot.heads:
+        return True
+    return not local_only and snapshot.remote_branch_exists(branch_name)
 
 
 def get_branches(local_only=False, directory=None):
@@ -514,18 +931,10 @@ def get_branches(local_only=False, directory=None):
 
     :raises: subprocess.CalledProcessError if any git calls fail
     """
-    cmd = 'git branch --no-color'
+    snapshot = get_ref_snapshot(directory)
+    branches = list(snapshot.heads)
     if not local_only:
-        cmd += ' -a'
-    out = check_output(cmd, shell=True, cwd=directory)
-    branches = []
-    for line in out.splitlines():
-        if line.count('HEAD -> ') > 0:
-            continue
-        if line.count('(no branch)') > 0:
-            continue
-        line = line.strip('*').strip()
-        branches.append(line)
+        branches.extend('remotes/' + b for b in snapshot.remotes)
     return branches
 
 
@@ -556,7 +965,10 @@ def create_branch(branch, orphaned=False, changeto=False, directory=None):
             if changeto:
                 current_branch = None
         else:
+            snapshot = _get_cached_ref_snapshot(directory)
             execute_command('git branch {0}'.format(branch), cwd=directory)
+            if snapshot is not None:
+                snapshot.branch_created(branch)
             if changeto:
                 checkout(branch, directory=directory)
             current_branch = None
@@ -565,6 +977,208 @@ def create_branch(branch, orphaned=False, changeto=False, directory=None):
             checkout(current_branch, directory=directory)
 
 
+def commit_tree(branch, tree, message, parent=None, allow_empty=False, directory=None):
+    """
+    Commits an existing tree object on top of a branch.
+
+    The commit is made with ``git commit-tree``, with the tip of the branch
+    as its parent, and the branch is moved with ``git update-ref``. If the
+    branch is checked out, the index and the working tree are moved to the
+    new commit with ``git read-tree -m -u``, which only touches the paths
+    which differ, before the branch is moved.
+
+    :param branch: name of an existing local branch to commit to
+    :param tree: hash of the tree to commit, or any revision naming a tree
+        or a commit, e.g. ``upstream:src/foo``
+    :param message: commit message
+    :param parent: hash of the tip of the branch, if already known
+    :param allow_empty: if True the tree is committed even if it is the branch's
+    :param directory: directory in which to preform this action
+    :returns: hash of the new commit, or None if the tree is the branch's
+
+    :raises: subprocess.CalledProcessError if any git calls fail, e.g. when
+        local changes or untracked files are in the way of the new commit
+    """
+    reader = get_object_reader(directory)
+    parent = parent or get_commit_hash(branch, directory)
+    sha, kind, size = reader.info(tree)
+    tree = sha if kind == 'tree' else reader.info(sha + '^{tree}')[0]
+    if not allow_empty and tree == reader.info(parent + '^{tree}')[0]:
+        return None
+    cmd = ['git', 'commit-tree', tree, '-p', parent, '-m', message]
+    commit = check_output(cmd, cwd=directory).strip()
+    if branch == get_current_branch(directory):
+        check_output(['git', 'read-tree', '-m', '-u', parent, commit], cwd=directory, stderr=PIPE)
+    snapshot = _get_cached_ref_snapshot(directory)
+    cmd = ['git', 'update-ref', '-m', 'bloom: ' + message, 'refs/heads/' + branch, commit, parent]
+    check_output(cmd, cwd=directory)
+    if snapshot is not None:
+        snapshot.branch_created(branch)
+    return commit
+
+
+class CommitBuilder(object):
+    """
+    Builds a single commit on a branch from in memory file contents.
+
+    Files are staged with :meth:`add` and committed with :meth:`commit`.
+    The commit is built with git plumbing in a temporary index: the blobs
+    are written with ``git hash-object``, the tree with ``git write-tree``
+    and the commit with ``git commit-tree``, and the branch is moved with
+    ``git update-ref``. The working tree and the real index are untouched,
+    unless the branch is currently checked out, in which case they are moved
+    to the new commit with ``git read-tree -m -u``, which only touches the
+    changed paths. Should that fail, e.g. because untracked files are in the
+    way, the files are written, added and committed in the working tree
+    instead, unless that would overwrite or remove local changes, in which
+    case nothing is committed and a RuntimeError is raised.
+
+    No commit is made if the resulting tree is the same as the branch's.
+
+    :param branch: name of an existing local or remote branch to commit to
+    :param directory: directory in which to preform this action
+    """
+    def __init__(self, branch, directory=None):
+        self.branch = branch
+        self.directory = directory
+        self.files = {}
+        self.modes = {}
+        self.removed = set()
+
+    def add(self, path, data, executable=False):
+        """
+        Stages the contents of a file.
+
+        :param path: path relative to the repository root
+        :param data: file contents as str or bytes
+        :param executable: if True the file is committed with mode 755
+        """
+        self.files[path] = data if isinstance(data, bytes) else data.encode('utf-8')
+        self.modes[path] = '100755' if executable else '100644'
+        self.removed.discard(path)
+
+    def remove(self, path):
+        """
+        Stages the removal of a file.
+
+        :param path: path relative to the repository root
+        """
+        self.files.pop(path, None)
+        self.modes.pop(path, None)
+        self.removed.add(path)
+
+    def commit(self, message):
+        """
+        Commits the staged files.
+
+        :param message: commit message
+        :returns: hash of the new commit, or None if nothing changed
+
+        :raises: subprocess.CalledProcessError if any git calls fail
+        :raises: RuntimeError if the branch is checked out and the commit
+            would overwrite local changes to the committed paths
+        """
+        if not self.files and not self.removed:
+            return None
+        parent = get_commit_hash(self.branch, self.directory)
+        tree = self._write_tree(parent)
+        try:
+            return commit_tree(self.branch, tree, message, parent=parent, directory=self.directory)
+        except CalledProcessError:
+            if self.branch != get_current_branch(self.directory):
+                raise
+            debug("Could not update the working tree to the new commit, committing in the working tree.")
+            return self._commit_in_working_tree(message)
+
+    def _write_blobs(self):
+        # Write all of the blobs with a single process
+        tmp_dir = tempfile.mkdtemp(prefix='bloom_blobs_')
+        try:
+            paths = []
+            for index, data in enumerate(self.files.values()):
+                paths.append(os.path.join(tmp_dir, str(index)))
+                with open(paths[-1], 'wb') as f:
+                    f.write(data)
+            cmd = ['git', 'hash-object', '-w', '--no-filters', '--stdin-paths']
+            out = check_output(cmd, cwd=self.directory, input='\n'.join(paths) + '\n')
+        finally:
+            shutil.rmtree(tmp_dir)
+        return dict(zip(self.files.keys(), out.split()))
+
+    def _write_tree(self, parent):
+        fd, index_file = tempfile.mkstemp(prefix='bloom_index_')
+        os.close(fd)
+        env = {'GIT_INDEX_FILE': index_file}
+        try:
+            check_output(['git', 'read-tree', parent], cwd=self.directory, env=env)
+            index_info = ''.join('{0} {1}\t{2}\n'.format(self.modes[path], sha, path)
+                                 for path, sha in self._write_blobs().items())
+            # A null sha removes the entry from the index
+            index_info += ''.join('0 {0}\t{1}\n'.format('0' * 40, path) for path in sorted(self.removed))
+            check_output(['git', 'update-index', '--index-info'], cwd=self.directory, env=env, input=index_info)
+            return check_output(['git', 'write-tree'], cwd=self.directory, env=env).strip()
+        finally:
+            os.remove(index_file)
+
+    def _get_overwritten_changes(self, root):
+        # Local changes are lost unless the working file already has the new contents
+        paths = sorted(set(self.files) | self.removed)
+        cmd = ['git', 'status', '--porcelain', '-z', '--untracked-files=all', '--'] + paths
+        changed = [entry[3:] for entry in check_output(cmd, cwd=root).split('\0') if entry[2:3] == ' ']
+        overwritten = []
+        for path in changed:
+            file_path = os.path.join(root, path)
+            if path in self.files and os.path.isfile(file_path):
+                with open(file_path, 'rb') as f:
+                    if f.read() == self.files[path]:
+                        continue
+            overwritten.append(path)
+        return overwritten
+
+    def _commit_in_working_tree(self, message):
+        root = get_root(self.directory)
+        overwritten = self._get_overwritten_changes(root)
+        if overwritten:
+            raise RuntimeError("Refusing to commit to '{0}', it would overwrite the local changes to: {1}"
+                               .format(self.branch, ', '.join(overwritten)))
+        if self.removed:
+            check_output(['git', 'rm', '-r', '-q', '-f', '--ignore-unmatch', '--'] + sorted(self.removed), cwd=root)
+        for path, data in self.files.items():
+            file_path = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'wb') as f:
+                f.write(data)
+            os.chmod(file_path, 0o755 if self.modes[path] == '100755' else 0o644)
+        if self.files:
+            check_output(['git', 'add', '--'] + list(self.files.keys()), cwd=root)
+        if not has_changes(root):
+            return None
+        execute_command(['git', 'commit', '-m', message], shell=False, cwd=root)
+        return get_commit_hash(self.branch, root)
+
+
+def commit_files(branch, files, message, directory=None):
+    """
+    Commits the given file contents to a branch without checking it out.
+
+    See :class:`CommitBuilder`.
+
+    :param branch: name of an existing local or remote branch to commit to
+    :param files: dict of paths, relative to the repository root, to file
+        contents as str or bytes
+    :param message: commit message
+    :param directory: directory in which to preform this action
+    :returns: hash of the new commit, or None if nothing changed
+
+    :raises: subprocess.CalledProcessError if any git calls fail
+    """
+    builder = CommitBuilder(branch, directory=directory)
+    for path, data in files.items():
+        builder.add(path, data)
+    return builder.commit(message)
+
+
 def ensure_git_root():
     """
     Checks that you are in the root of the git repository, else exit.
@@ -580,26 +1194,100 @@ def ensure_git_root():
               exit=True)
 
 
+class Repository(object):
+    """
+    Lazily resolved information about a git repository.
+
+    The root and git directory are resolved once, the current branch and the
+    remotes are cached until bloom runs a git command which might change them,
+    see :func:`bloom.util.get_git_state_generation`.
+
+    A Repository is path-like, so it can be passed in place of ``directory``
+    to the functions of this module, which then use its cached information.
+
+    :param directory: directory in the repository, if None the cwd is used
+    """
+    def __init__(self, directory=None):
+        self.directory = os.path.abspath(directory or os.getcwd())
+        self._head = None
+        self._remotes = None
+
+    def __fspath__(self):
+        return self.directory
+
+    def __str__(self):
+        return self.directory
+
+    def __repr__(self):
+        return 'Repository({0!r})'.format(self.directory)
+
+    def _resolve(self):
+        locations = _repository_locations.get(self.directory)
+        if locations is not None and os.path.isdir(locations[1]):
+            return locations
+        cmd = ['git', 'rev-parse', '--show-toplevel', '--absolute-git-dir']
+        try:
+            output = check_output(cmd, cwd=self.directory, stderr=PIPE)
+        except (CalledProcessError, OSError):
+            return None, None
+        locations = tuple(output.splitlines()[:2])
+        _repository_locations[self.directory] = locations
+        return locations
+
+    @property
+    def root(self):
+        """Root of the working tree, or None if this is not a git repository"""
+        return self._resolve()[0]
+
+    @property
+    def git_dir(self):
+        """Absolute path of the .git directory, or None if this is not a git repository"""
+        return self._resolve()[1]
+
+    def _cached(self, cache, fn):
+        generation = bloom.util.get_git_state_generation()
+        if cache is None or cache[0] != generation:
+            cache = (generation, fn())
+        return cache
+
+    @property
+    def head(self):
+        """Current branch, or None if HEAD is detached"""
+        self._head = self._cached(self._head, lambda: _get_head_branch(self.directory))
+        return self._head[1]
+
+    @property
+    def remotes(self):
+        """List of remote names"""
+        self._remotes = self._cached(self._remotes, lambda: _list_remotes(self.root))
+        return list(self._remotes[1])
+
+
+# Root and git directory by directory, these only change if the repository is removed
+_repository_locations = {}
+
+
 def get_root(directory=None):
     """
     Returns the git root directory above the given dir.
 
     If the given dir is not in a git repository, None is returned.
+    The result is memoized for each directory.
 
     :param directory: directory to query from, if None the cwd is used
     :returns: root of git repository or None if not a git repository
     """
-    cmd = 'git rev-parse --show-toplevel'
-    try:
-        output = check_output(cmd, shell=True, cwd=directory, stderr=PIPE)
-    except CalledProcessError:
-        return None
-    return output.strip()
+    if not isinstance(directory, Repository):
+        directory = Repository(directory)
+    return directory.root
 
 
 def get_current_branch(directory=None):
     """
-    Returns the current git branch by parsing the output of `git branch`
+    Returns the current git branch
+
+    Inside of a :class:`ref_cache` context it is answered from the ref
+    snapshot of the repository, otherwise ``git symbolic-ref`` is asked.
 
     This will raise a RuntimeError if the current working directory is not
     a git repository.  If no branch could be determined it will return None,
@@ -610,16 +1298,22 @@ def get_current_branch(directory=None):
 
     :raises: subprocess.CalledProcessError if git command fails
     """
-    cmd = 'git branch --no-color'
-    output = check_output(cmd, shell=True, cwd=directory)
-    output = output.splitlines()
-    for token in output:
-        if token.strip().startswith('*'):
-            token = token[2:]
-            if token == '(no branch)':
-                return None
-            return token
-    return None
+    if isinstance(directory, Repository):
+        return directory.head
+    return _get_head_branch(directory)
+
+
+def _get_head_branch(directory):
+    if _ref_cache_depth:
+        return get_ref_snapshot(directory).head
+    # Without a ref cache a snapshot of every ref is not worth making just for HEAD
+    try:
+        return check_output(['git', 'symbolic-ref', '-q', '--short', 'HEAD'], cwd=directory).strip() or None
+    except CalledProcessError as exc:
+        if exc.returncode == 1:
+            # Detached HEAD
+            return None
+        raise
 
 
 def track_branches(branches=None, directory=None):
@@ -637,46 +1331,91 @@ def track_branches(branches=None, directory=None):
     debug("track_branches(" + str(branches) + ", " + str(directory) + ")")
     if branches == []:
         return
-    # Get the local branches
-    local_branches = get_branches(local_only=True, directory=directory)
-    # Get the remote and local branches
-    all_branches = get_branches(local_only=False, directory=directory)
-    # Calculate the untracked branches
-    untracked_branches = {}
-    ambiguous_branches = {}
-    for branch in all_branches:
-        if branch.startswith('remotes/') and branch.count('/') >= 2:
-            local_name = '/'.join(branch.split('/')[2:])
-            if local_name not in local_branches:
-                if local_name in untracked_branches:
-                    if local_name not in ambiguous_branches:
-                        ambiguous_branches[local_name] = [untracked_branches[local_name]]
-                    ambiguous_branches[local_name].append(branch)
-                else:
-                    untracked_branches[local_name] = branch
+    snapshot = get_ref_snapshot(directory)
+    untracked_branches = snapshot.get_untracked_branches()
+    if branches is None:
+        branches = list(untracked_branches.keys())
     # Prune any untracked branches by specified branches
     branches_to_track = {}
-    if branches is not None:
-        for untracked, remote_ref in untracked_branches.items():
-            if untracked in branches:
-                if untracked in ambiguous_branches:
-                    raise RuntimeError(
-                        "Ambiguous tracking branch for '{0}'. Found on multiple remotes: {1}"
-                        .format(untracked, ambiguous_branches[untracked])
-                    )
-                branches_to_track[untracked] = remote_ref
-    else:
-        for untracked, remote_ref in untracked_branches.items():
-            if untracked in ambiguous_branches:
-                raise RuntimeError(
-                    "Ambiguous tracking branch for '{0}'. Found on multiple remotes: {1}"
-                    .format(untracked, ambiguous_branches[untracked])
-                )
-            branches_to_track[untracked] = remote_ref
+    for branch in branches:
+        remote_refs = untracked_branches.get(branch)
+        if not remote_refs:
+            continue
+        if len(remote_refs) > 1:
+            raise RuntimeError(
+                "Ambiguous tracking branch for '{0}'. Found on multiple remotes: {1}"
+                .format(branch, remote_refs)
+            )
+        branches_to_track[branch] = remote_refs[0]
     # Track branches
     debug("Tracking branches: " + str(list(branches_to_track.keys())))
-    for branch, remote_ref in branches_to_track.items():
-        execute_command('git branch --track {0} {1}'.format(branch, remote_ref), cwd=directory)
+    if not branches_to_track:
+        return
+    # Create all of the branches in a single transaction
+    commands = ''.join(
+        'create refs/heads/{0} {1}\n'.format(branch, snapshot.remotes[remote_ref[len('remotes/'):]])
+        for branch, remote_ref in branches_to_track.items())
+    check_output(['git', 'update-ref', '--stdin'], cwd=directory, input=commands)
+    snapshot.branches_tracked(branches_to_track)
+    # Set the upstream of the new branches, like 'git branch --track' does
+    _set_branch_upstreams(dict(
+        (branch, (remote_ref[len('remotes/'):].split('/', 1)[0], 'refs/heads/' + branch))
+        for branch, remote_ref in branches_to_track.items()), directory)
+
+
+def _set_branch_upstreams(upstreams, directory=None):
+    """
+    Writes ``branch.<name>.remote`` and ``branch.<name>.merge`` of new branches.
+
+    git config sets one key per process, so the sections of all of the
+    branches are appended to the repository's config in a single locked
+    write, the way git updates it. If any of the branches already has a
+    section, e.g. left over from a deleted branch, ``git config`` is used to
+    replace the values instead.
+
+    :param upstreams: dict of branch names to ``(remote, merge ref)`` tuples
+    :param directory: directory in the repository
+    """
+    repository = directory if isinstance(directory, Repository) else Repository(directory)
+    git_dir = repository.git_dir
+    if os.path.isfile(os.path.join(git_dir, 'commondir')):
+        # The config of a worktree is shared with the main repository
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            git_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    config_path = os.path.join(git_dir, 'config')
+    lock_path = config_path + '.lock'
+    sections = []
+    headers = []
+    for branch, (remote, merge) in sorted(upstreams.items()):
+        quoted = '"' + branch.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        sections.append('[branch {0}]\n\tremote = {1}\n\tmerge = {2}\n'.format(quoted, remote, merge))
+        headers.append(r'branch\s+' + re.escape(quoted) + r'|branch\.' + re.escape(branch))
+    existing_section = re.compile(r'^\s*\[(' + '|'.join(headers) + r')\]', re.MULTILINE | re.IGNORECASE)
+    try:
+        lock = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except OSError:
+        # Locked by another process, let git config report it
+        lock = None
+    if lock is not None:
+        try:
+            with os.fdopen(lock, 'w') as f:
+                with open(config_path) as config_file:
+                    config = config_file.read()
+                if not existing_section.search(config):
+                    if config and not config.endswith('\n'):
+                        config += '\n'
+                    f.write(config + ''.join(sections))
+                    config = None
+            if config is None:
+                shutil.copymode(config_path, lock_path)
+                os.replace(lock_path, config_path)
+                return
+        finally:
+            if os.path.exists(lock_path):
+                os.remove(lock_path)
+    for branch, (remote, merge) in sorted(upstreams.items()):
+        check_output(['git', 'config', 'branch.{0}.remote'.format(branch), remote], cwd=directory)
+        check_output(['git', 'config', 'branch.{0}.merge'.format(branch), merge], cwd=directory)
 
 
 def get_last_tag_by_version(directory=None):
@@ -728,10 +1467,14 @@ def get_remotes(directory=None):
 
     :raises: RuntimeError if directory is not a git repository
     """
-    root = get_root(directory)
-    checked_dir = directory or os.getcwd()
-    if root is None:
-        raise RuntimeError("Directory '{0}' is not in a git repository.".format(checked_dir))
+    if not isinstance(directory, Repository):
+        directory = Repository(directory)
+    if directory.root is None:
+        raise RuntimeError("Directory '{0}' is not in a git repository.".format(directory))
+    return directory.remotes
+
+
+def _list_remotes(root):
     cmd = "git remote -v"
     output = check_output(cmd, shell=True, cwd=root, stderr=PIPE)
     return list(set([x.split()[0].strip() for x in output.splitlines() if x.strip()]))
@@ -42,6 +42,7 @@ from platform import mac_ver
 import re
 import string
 import sys
+import uuid
 
 import functools
 
@@ -282,6 +283,10 @@ def error(msg, file=None, end='\n', use_prefix=True, exit=False):
         print(msg, file=file, end=end)
     return msg
 
+# Identifies one bloom command and the processes it starts, unlike the
+# logging id, which defaults to a pid, it is never reused by a later command
+os.environ.setdefault('BLOOM_COMMAND_ID', uuid.uuid4().hex)
+
 try:
     _log_id = os.environ.get('BLOOM_LOGGING_ID', str(os.getpid()))
     os.environ['BLOOM_LOGGING_ID'] = _log_id  # Store in env for subprocess
@@ -307,6 +312,11 @@ def _get_summary_file_path():
     return _summary_file
 
 
+def _get_command_report_file_path():
+    global _file_log_prefix, _log_id
+    return os.path.join(_file_log_prefix, '{0}.{1}.commands.json'.format(_log_id, os.getpid()))
+
+
 @atexit.register
 def close_logging():
     global _file_log, _summary_file
@@ -37,10 +37,16 @@ Provides common utility functions for bloom.
 
 from __future__ import print_function
 
+import concurrent.futures
+import hashlib
 import os
 import sys
+import threading
 import traceback
 
+from bloom.git import get_clean_tree_hash
+from bloom.git import get_object_reader
+from bloom.git import get_tree_entries
 from bloom.git import show
 
 from bloom.config import BLOOM_CONFIG_BRANCH
@@ -51,7 +57,12 @@ from bloom.logging import info
 from bloom.logging import warning
 
 try:
-    from catkin_pkg.packages import find_packages
+    from catkin_pkg.changelog import Changelog
+    from catkin_pkg.changelog import CHANGELOG_FILENAME
+    from catkin_pkg.changelog import populate_changelog_from_rst
+    from catkin_pkg.package import PACKAGE_MANIFEST_FILENAME
+    from catkin_pkg.package import parse_package_string
+    from catkin_pkg.packages import find_package_paths
     from catkin_pkg.packages import verify_equal_package_versions
 except ImportError:
     debug(traceback.format_exc())
@@ -59,18 +70,246 @@ except ImportError:
           file=sys.stderr, exit=True)
 
 
+# Parsed changelog entries by the sha1 of the changelog contents
+_changelog_entries = {}
+
+# Parsed packages by the (blob sha, filename) of their package.xml
+_package_blobs = {}
+_package_blobs_lock = threading.Lock()
+
+# Files which stop the search for packages in a folder, as in catkin_pkg
+_IGNORE_MARKERS = set(['AMENT_IGNORE', 'CATKIN_IGNORE', 'COLCON_IGNORE'])
+
+# More package.xml files than this are parsed in a pool of processes
+PARALLEL_PARSE_THRESHOLD = 16
+
+# Results of get_package_data by the (folder, tree hash, ignored packages) of clean folders
+_package_data = {}
+
+
+def get_changelog_entries(data):
+    """
+    Parses the contents of a CHANGELOG.rst.
+
+    The result is cached by the hash of the contents, so a changelog which is
+    read for several branches or distros is only parsed once.
+
+    :param data: contents of the changelog as str or bytes
+    :returns: tuple of (version, date, changes) entries, from the oldest version
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    key = hashlib.sha1(data).hexdigest()
+    if key not in _changelog_entries:
+        changelog = Changelog()
+        populate_changelog_from_rst(changelog, data.decode('utf-8'))
+        _changelog_entries[key] = tuple(changelog.foreach_version())
+    return _changelog_entries[key]
+
+
+def get_changelog_entries_from_path(path):
+    """
+    Parses a CHANGELOG.rst file, see :func:`get_changelog_entries`.
+
+    :param path: path of the changelog, or of the folder containing it
+    :returns: tuple of (version, date, changes) entries, or None if the
+        changelog could not be read
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, CHANGELOG_FILENAME)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    return get_changelog_entries(data)
+
+
 def get_ignored_packages(release_directory=None):
     prefix = os.environ.get('BLOOM_TRACK', 'packages')
     data = show(BLOOM_CONFIG_BRANCH, '{0}.ignored'.format(prefix), directory=release_directory) or ''
     return [p.strip() for p in data.split() if p.strip()]
 
 
+def _parse_package_xml(xml_and_filename):
+    xml, filename = xml_and_filename
+    return parse_package_string(xml, filename=filename)
+
+
+def parse_package_xmls(xmls):
+    """
+    Parses the contents of several package.xml files.
+
+    When there are more than :data:`PARALLEL_PARSE_THRESHOLD` of them they are
+    parsed in a pool of processes, one per cpu at most.
+
+    :param xmls: list of (xml, filename) tuples
+    :returns: list of parsed packages, in the order of xmls
+    """
+    if len(xmls) > PARALLEL_PARSE_THRESHOLD:
+        workers = min(len(xmls), os.cpu_count() or 1)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                chunksize = max(1, len(xmls) // (workers * 4))
+                return list(executor.map(_parse_package_xml, xmls, chunksize=chunksize))
+        except (OSError, concurrent.futures.BrokenExecutor):
+            # Processes are not available in some environments, e.g. chroots
+            debug(traceback.format_exc())
+    return [_parse_package_xml(xml) for xml in xmls]
+
+
+def find_package_blobs(reference, directory=None):
+    """
+    Finds the package.xml files of a reference without checking it out.
+
+    The trees are read from the object database and searched like catkin_pkg
+    searches a folder: folders with an ignore marker (e.g. ``CATKIN_IGNORE``)
+    are skipped, hidden folders are skipped and folders which contain a
+    package.xml are not searched any further.
+
+    :param reference: git reference to search (branch, tag, or commit)
+    :param directory: directory of the repository
+    :returns: dict of package folders, relative to the root of the tree, to
+        the sha of their package.xml, or None if the reference does not exist
+    """
+    blobs = {}
+    folders = ['']
+    while folders:
+        folder = folders.pop()
+        entries = get_tree_entries(reference, folder or None, directory=directory)
+        if entries is None:
+            if not folder:
+                return None
+            continue
+        if set(entries) & _IGNORE_MARKERS:
+            continue
+        mode, sha = entries.get(PACKAGE_MANIFEST_FILENAME, ('', None))
+        if mode.startswith('100'):
+            blobs[os.path.normpath(folder)] = sha
+            continue
+        for name, (mode, sha) in entries.items():
+            if mode == '40000' and not name.startswith('.'):
+                folders.append(folder + '/' + name if folder else name)
+    return blobs
+
+
+def _check_duplicate_packages(packages):
+    # Raises the error catkin_pkg's find_packages raises for duplicates
+    paths_by_name = {}
+    for path, package in packages.items():
+        paths_by_name.setdefault(package.name, set()).add(path)
+    duplicates = ['Multiple packages found with the same name "%s":%s'
+                  % (name, ''.join(['\n- %s' % path for path in sorted(paths_by_name[name])]))
+                  for name in sorted(paths_by_name) if len(paths_by_name[name]) > 1]
+    if duplicates:
+        raise RuntimeError('\n'.join(duplicates))
+
+
+def get_packages_from_references(references, directory=None):
+    """
+    Parses the packages of several references without checking them out.
+
+    The package.xml files are read from the object database and the ones
+    which were not parsed before are parsed together, see
+    :func:`parse_package_xmls`. Parsed packages are cached by the sha of
+    their package.xml, so a package which is unchanged between branches, or
+    between calls, is only parsed once.
+
+    :param references: list of git references (branch, tag, or commit)
+    :param directory: directory of the repository
+    :returns: dict of each reference to a dict of package folders to
+        packages, like the one of catkin_pkg's find_packages, or to None if
+        the reference does not exist
+    :raises: RuntimeError if a reference has several packages with the same name
+    """
+    repo_dir = directory or os.getcwd()
+    reader = get_object_reader(directory)
+    blobs = dict((reference, find_package_blobs(reference, directory)) for reference in references)
+    missing = {}
+    with _package_blobs_lock:
+        for reference_blobs in blobs.values():
+            for path, sha in (reference_blobs or {}).items():
+                key = (sha, os.path.join(repo_dir, path, PACKAGE_MANIFEST_FILENAME))
+                if key not in _package_blobs and key not in missing:
+                    missing[key] = reader.read(sha)[2].decode('utf-8')
+    if missing:
+        keys = sorted(missing)
+        parsed = parse_package_xmls([(missing[key], key[1]) for key in keys])
+        with _package_blobs_lock:
+            _package_blobs.update(zip(keys, parsed))
+    packages = {}
+    for reference, reference_blobs in blobs.items():
+        if reference_blobs is None:
+            packages[reference] = None
+            continue
+        packages[reference] = dict(
+            (path, _package_blobs[(sha, os.path.join(repo_dir, path, PACKAGE_MANIFEST_FILENAME))])
+            for path, sha in reference_blobs.items())
+        _check_duplicate_packages(packages[reference])
+    return packages
+
+
+def _check_package_data(packages, log, ignored_packages):
+    if len(packages) > 1:
+        log("found " + str(len(packages)) + " packages.",
+            use_prefix=False)
+    else:
+        log("found '" + list(packages.values())[0].name + "'.",
+            use_prefix=False)
+    for k, v in dict(packages).items():
+        # Check for packages with upper case names
+        if v.name.lower() != v.name:
+            error("Cowardly refusing to release packages with uppercase characters in the name: " + v.name)
+            error("See:")
+            error("  https://github.com/ros-infrastructure/bloom/issues/191")
+            error("  https://github.com/ros-infrastructure/bloom/issues/76")
+            error("Invalid package names, aborting.", exit=True)
+        # Check for ignored packages
+        if v.name in ignored_packages:
+            warning("Explicitly ignoring package '{0}' because it is in the `{1}.ignored` file."
+                    .format(v.name, os.environ.get('BLOOM_TRACK', 'packages')))
+            del packages[k]
+    if packages == {}:
+        error("All packages that were found were also ignored, aborting.",
+              exit=True)
+    version = verify_equal_package_versions(packages.values())
+    return [p.name for p in packages.values()], version, packages
+
+
+def find_packages(basepath):
+    """
+    Crawls a folder for packages like catkin_pkg's find_packages.
+
+    The package.xml files are parsed with :func:`parse_package_xmls`, so
+    folders with many packages are parsed in a pool of processes.
+
+    :param basepath: the path to search in
+    :returns: dict of package folders, relative to basepath, to packages
+    :raises: RuntimeError if several packages have the same name
+    """
+    paths = find_package_paths(basepath)
+    xmls = []
+    for path in paths:
+        filename = os.path.join(basepath, path, PACKAGE_MANIFEST_FILENAME)
+        with open(filename, 'rb') as f:
+            xmls.append((f.read().decode('utf-8'), filename))
+    packages = dict(zip(paths, parse_package_xmls(xmls)))
+    _check_duplicate_packages(packages)
+    return packages
+
+
 def get_package_data(branch_name=None, directory=None, quiet=True, release_directory=None):
     """
     Gets package data about the package(s) in the current branch.
 
     It also ignores the packages in the `packages.ignore` file in the master branch.
 
+    When the folder is clean, i.e. it has no local or untracked changes, the
+    packages are read from its git tree, like
+    :func:`get_package_data_from_reference` does, so files ignored by git are
+    not looked at. The result is remembered for the tree and the ignored
+    packages, so later calls for the same tree only check that it is clean.
+
     :param branch_name: name of the branch you are searching on (log use only)
     """
     log = debug if quiet else info
@@ -79,35 +318,43 @@ def get_package_data(branch_name=None, directory=None, quiet=True, release_direc
         log("Looking for packages in '{0}' branch... ".format(branch_name), end='')
     else:
         log("Looking for packages in '{0}'... ".format(directory or os.getcwd()), end='')
+    ignored_packages = get_ignored_packages(release_directory=release_directory)
+    tree_hash = get_clean_tree_hash(repo_dir)
+    key = (os.path.abspath(repo_dir), tree_hash, tuple(sorted(ignored_packages)))
+    if tree_hash is not None and key in _package_data:
+        names, version, packages = _package_data[key]
+        log("found " + str(len(packages)) + " packages (cached).", use_prefix=False)
+        return list(names), version, dict(packages)
     # Check for package.xml(s)
-    packages = find_packages(repo_dir)
+    if tree_hash is not None:
+        packages = get_packages_from_references([tree_hash], repo_dir)[tree_hash]
+    else:
+        packages = find_packages(repo_dir)
     if type(packages) == dict and packages != {}:
-        if len(packages) > 1:
-            log("found " + str(len(packages)) + " packages.",
-                use_prefix=False)
-        else:
-            log("found '" + list(packages.values())[0].name + "'.",
-                use_prefix=False)
-        ignored_packages = get_ignored_packages(release_directory=release_directory)
-        for k, v in dict(packages).items():
-            # Check for packages with upper case names
-            if v.name.lower() != v.name:
-                error("Cowardly refusing to release packages with uppercase characters in the name: " + v.name)
-                error("See:")
-                error("  https://github.com/ros-infrastructure/bloom/issues/191")
-                error("  https://github.com/ros-infrastructure/bloom/issues/76")
-                error("Invalid package names, aborting.", exit=True)
-            # Check for ignored packages
-            if v.name in ignored_packages:
-                warning("Explicitly ignoring package '{0}' because it is in the `{1}.ignored` file."
-                        .format(v.name, os.environ.get('BLOOM_TRACK', 'packages')))
-                del packages[k]
-        if packages == {}:
-            error("All packages that were found were also ignored, aborting.",
-                  exit=True)
-        version = verify_equal_package_versions(packages.values())
-        return [p.name for p in packages.values()], version, packages
+        package_data = _check_package_data(packages, log, ignored_packages)
+        if tree_hash is not None:
+            _package_data[key] = package_data[0], package_data[1], dict(package_data[2])
+        return package_data
     # Otherwise we have a problem
     log("failed.", use_prefix=False)
     error("No package.xml(s) found, and '--package-name' not given, aborting.",
           use_prefix=False, exit=True)
+
+
+def get_package_data_from_reference(reference, directory=None, quiet=True, release_directory=None):
+    """
+    Gets package data about the package(s) in a reference without checking it out.
+
+    Like :func:`get_package_data`, but the packages are read from the object
+    database, see :func:`get_packages_from_references`.
+
+    :param reference: git reference to search (branch, tag, or commit)
+    """
+    log = debug if quiet else info
+    log("Looking for packages in '{0}' branch... ".format(reference), end='')
+    packages = get_packages_from_references([reference], directory)[reference]
+    if packages:
+        return _check_package_data(packages, log, get_ignored_packages(release_directory=release_directory))
+    log("failed.", use_prefix=False)
+    error("No package.xml(s) found, and '--package-name' not given, aborting.",
+          use_prefix=False, exit=True)
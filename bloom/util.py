@@ -37,11 +37,16 @@ Provides common utility functions for bloom.
 from __future__ import print_function
 
 import argparse
+import atexit
+import hashlib
+import json
 import os
+import shlex
 import shutil
 import socket
 import sys
 import tempfile
+import threading
 import time
 
 try:
@@ -57,6 +62,8 @@ except ImportError:
 
 from email.utils import formatdate
 
+from types import MappingProxyType
+
 from subprocess import CalledProcessError
 from subprocess import PIPE
 from subprocess import STDOUT
@@ -69,6 +76,7 @@ except ImportError:
     # Python3
     from io import StringIO
 
+from bloom.logging import _get_command_report_file_path
 from bloom.logging import debug
 from bloom.logging import disable_ANSI_colors
 from bloom.logging import enable_debug
@@ -84,11 +92,43 @@ except NameError:
     to_unicode = str
 
 
+# Scanned EmPy 4 templates by the hash of their source
+_em_template_tokens = {}
+
+
+def _get_em_template_tokens(em, interpreter, template):
+    key = hashlib.sha1(template.encode('utf-8')).hexdigest()
+    tokens = _em_template_tokens.get(key)
+    if tokens is None:
+        scanner = em.Scanner(interpreter.config, interpreter.getContext(), interpreter.currents, template)
+        tokens = []
+        terminated = False
+        while True:
+            try:
+                token = scanner.one()
+            except em.TransientParseError:
+                if terminated or template.endswith(interpreter.config.prefix):
+                    raise
+                # Like EmPy, terminate greedy markup at the end of the template
+                scanner.feed(interpreter.config.prefix + '\n')
+                terminated = True
+                continue
+            if token is None:
+                break
+            tokens.append(token)
+            scanner.accumulate()
+        _em_template_tokens[key] = tokens
+    return tokens
+
+
 def expand_template_em(template, subs):
     """
     Compatibility function for EmPy 3 and 4.
     EmPy 3: em.expand(template, **kwargs)
     EmPy 4: em.expand(template, locals=dict)
+
+    With EmPy 4 each template source is only scanned once, the scanned tokens
+    are cached by the hash of the source and run against new substitutions.
     """
     try:
         import em
@@ -97,8 +137,15 @@ def expand_template_em(template, subs):
 
     if em.__version__.startswith('3'):
         return em.expand(template, **subs)
-    else:
-        return em.expand(template, locals=subs)
+    config = em.Configuration()
+    config.useProxy = False
+    interpreter = em.Interpreter(config=config, dispatcher=False)
+    try:
+        tokens = _get_em_template_tokens(em, interpreter, template)
+        return interpreter.tokens(tokens, subs or None)
+    finally:
+        interpreter.shutdown()
+        interpreter.unfixGlobals()
 
 
 def flush_stdin():
@@ -357,6 +404,33 @@ def pdb_hook():
         pdb.set_trace()
 
 
+_git_env = None
+
+
+def get_git_env():
+    """
+    Returns the environment used for all git commands run by bloom.
+
+    It is built once per process from the environment at the time of the
+    first git command, with ``LC_ALL=C`` so that the output of git can be
+    parsed, ``GIT_OPTIONAL_LOCKS=0`` so that read only commands do not take
+    the index lock, and ``GIT_TERMINAL_PROMPT=0`` if there is no terminal to
+    prompt on. ``os.environ`` is not modified.
+
+    :returns: read only mapping of the environment variables
+    """
+    global _git_env
+    if _git_env is None:
+        env = dict(os.environ)
+        # If the output is from git, force lang to C to prevent output in different languages.
+        env['LC_ALL'] = 'C'
+        env['GIT_OPTIONAL_LOCKS'] = '0'
+        if not sys.stdin or not sys.stdin.isatty():
+            env['GIT_TERMINAL_PROMPT'] = '0'
+        _git_env = MappingProxyType(env)
+    return _git_env
+
+
 def __get_env_for_cmd(cmd):
     executable = None
     if isinstance(cmd, list) or isinstance(cmd, tuple):
@@ -365,18 +439,199 @@ def __get_env_for_cmd(cmd):
         executable = cmd.split()[0]
     env = None
     if executable is not None and executable.startswith('git'):
-        env = os.environ
-        # If the output is from git, force lang to C to prevent output in different languages.
-        env['LC_ALL'] = 'C'
+        env = get_git_env()
     return env
 
 
-def check_output(cmd, cwd=None, stdin=None, stderr=None, shell=False):
-    """Backwards compatible check_output"""
+# Characters which need a shell to be interpreted
+_shell_metacharacters = frozenset('|&;<>()$`\\*?[]{}~!#\n')
+_executables = {}
+
+
+def __get_argv_for_cmd(cmd):
+    """Returns cmd as an argv list if it can be run without a shell, otherwise None"""
+    if not isinstance(cmd, str) or _shell_metacharacters.intersection(cmd):
+        return None
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not argv or '=' in argv[0]:
+        return None
+    if argv[0] not in _executables:
+        # Shell builtins and missing commands are left to the shell
+        _executables[argv[0]] = shutil.which(argv[0]) is not None
+    return argv if _executables[argv[0]] else None
+
+
+# git sub commands which never change refs, HEAD, or the remotes
+_ref_neutral_git_commands = frozenset([
+    'add', 'cat-file', 'check-ignore', 'check-ref-format', 'clean', 'commit-tree',
+    'describe', 'diff', 'diff-index', 'diff-tree', 'for-each-ref', 'format-patch',
+    'hash-object', 'log', 'ls-files', 'ls-remote', 'ls-tree', 'merge-base', 'mktree', 'read-tree',
+    'rev-list', 'rev-parse', 'show', 'show-branch', 'show-ref', 'status', 'var',
+    'update-index', 'version', 'write-tree',
+])
+_git_state_generation = 0
+
+
+def get_git_state_generation():
+    """
+    Returns a counter which is incremented by every git command run through
+    :func:`execute_command` or :func:`check_output` which may have changed
+    refs, HEAD, or the remotes of a repository.
+
+    Caches of repository state compare this value to know when to refresh.
+    """
+    return _git_state_generation
+
+
+def invalidate_git_state():
+    """
+    Invalidates caches of repository state, see :func:`get_git_state_generation`.
+
+    Call this after running git outside of bloom, e.g. in a user shell.
+    """
+    global _git_state_generation
+    _git_state_generation += 1
+
+
+def _update_git_state_generation(cmd):
+    global _git_state_generation
+    tokens = cmd if isinstance(cmd, (list, tuple)) else cmd.split()
+    if not tokens or not tokens[0].startswith('git'):
+        return
+    if tokens[0] == 'git' and len(tokens) > 1 and tokens[1] in _ref_neutral_git_commands:
+        return
+    if tokens[0] == 'git' and tokens[1:] in (['remote'], ['remote', '-v']):
+        return
+    if tokens[0] == 'git' and _is_ref_neutral_git_query(list(tokens[1:])):
+        return
+    _git_state_generation += 1
+
+
+def _is_ref_neutral_git_query(args):
+    # 'git symbolic-ref HEAD' reads HEAD, with a second argument it would write it
+    if args[:1] == ['symbolic-ref']:
+        return args.count('HEAD') == 1 and set(args[1:]) <= set(['-q', '--quiet', '--short', 'HEAD'])
+    # 'git config --get*' only reads the configuration
+    if args[:1] == ['config']:
+        return any(arg.startswith('--get') for arg in args[1:])
+    return False
+
+
+# Opt-in record of every command run by execute_command and check_output
+_command_records = [] if 'BLOOM_PROFILE_COMMANDS' in os.environ else None
+_command_report_top = 20
+
+
+def _get_call_site():
+    # First frame outside of bloom.util and bloom.git, i.e. the code that needed the command
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if os.path.dirname(filename) != this_dir or os.path.basename(filename) not in ['util.py', 'git.py']:
+            break
+        frame = frame.f_back
+    if frame is None:
+        return None
+    filename = os.path.abspath(frame.f_code.co_filename)
+    if filename.startswith(os.path.dirname(this_dir) + os.sep):
+        filename = os.path.relpath(filename, os.path.dirname(this_dir))
+    return '{0}:{1} ({2})'.format(filename, frame.f_lineno, frame.f_code.co_name)
+
+
+def _record_command(cmd, cwd, start, returncode, out, err):
+    if _command_records is None:
+        return
+    tokens = cmd if isinstance(cmd, (list, tuple)) else cmd.split()
+    _command_records.append({
+        'command': cmd if isinstance(cmd, str) else ' '.join(cmd),
+        'program': ' '.join(tokens[:2] if tokens and tokens[0] == 'git' else tokens[:1]),
+        'cwd': str(cwd if cwd else os.getcwd()),
+        'duration': time.time() - start,
+        'returncode': returncode,
+        'output_bytes': len(out or '') + len(err or ''),
+        'call_site': _get_call_site(),
+    })
+
+
+def get_command_report():
+    """
+    Returns an aggregated report of the commands run by this process.
+
+    Commands are only recorded if ``BLOOM_PROFILE_COMMANDS`` is set in the
+    environment, otherwise None is returned.
+
+    :returns: dict with the totals, the top commands by count and by total
+        time, the top call sites by total time, and every recorded command
+    """
+    if _command_records is None:
+        return None
+
+    def aggregate(key):
+        groups = {}
+        for record in _command_records:
+            group = groups.setdefault(record[key], {key: record[key], 'count': 0, 'total_time': 0.0})
+            group['count'] += 1
+            group['total_time'] += record['duration']
+        return list(groups.values())
+
+    programs = aggregate('program')
+    call_sites = aggregate('call_site')
+    return {
+        'argv': sys.argv,
+        'pid': os.getpid(),
+        'total_count': len(_command_records),
+        'total_time': sum(r['duration'] for r in _command_records),
+        'top_by_count': sorted(programs, key=lambda g: -g['count'])[:_command_report_top],
+        'top_by_time': sorted(programs, key=lambda g: -g['total_time'])[:_command_report_top],
+        'top_call_sites_by_time': sorted(call_sites, key=lambda g: -g['total_time'])[:_command_report_top],
+        'commands': _command_records,
+    }
+
+
+@atexit.register
+def write_command_report():
+    report = get_command_report()
+    if not report or not report['commands']:
+        return
+    try:
+        path = _get_command_report_file_path()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    except Exception as exc:
+        warning("Failed to write the command report: {0}: {1}".format(exc.__class__.__name__, exc))
+        return
+    debug("Wrote report of {0} commands to '{1}'".format(report['total_count'], path))
+
+
+def check_output(cmd, cwd=None, stdin=None, stderr=None, shell=False, input=None, env=None):
+    """
+    Backwards compatible check_output
+
+    :param input: data to send to the command's stdin
+    :param env: dict of additional environment variables for the command
+    """
+    extra_env = env
     env = __get_env_for_cmd(cmd)
-    p = Popen(cmd, cwd=cwd, stdin=stdin, stderr=stderr, shell=shell,
+    if extra_env:
+        env = dict(env if env is not None else os.environ)
+        env.update(extra_env)
+    if input is not None:
+        stdin = PIPE
+        if not isinstance(input, bytes):
+            input = input.encode('utf-8')
+    args = __get_argv_for_cmd(cmd) if shell else None
+    if args is not None:
+        shell = False
+    start = time.time()
+    p = Popen(args or cmd, cwd=cwd, stdin=stdin, stderr=stderr, shell=shell,
               stdout=PIPE, env=env)
-    out, err = p.communicate()
+    out, err = p.communicate(input)
+    _record_command(cmd, cwd, start, p.returncode, out, err)
+    _update_git_state_generation(cmd)
     if p.returncode:
         raise CalledProcessError(p.returncode, cmd)
     if not isinstance(out, str):
@@ -390,6 +645,10 @@ def create_temporary_directory(prefix_dir=None):
     return mkdtemp(prefix='bloom_', dir=prefix_dir)
 
 
+# Serializes prompts made from concurrently running generator steps
+_prompt_lock = threading.Lock()
+
+
 def maybe_continue(default='y', msg='Continue'):
     """Prompts the user for continuation"""
     default = default.lower()
@@ -400,18 +659,19 @@ def maybe_continue(default='y', msg='Continue'):
         msg += "@{yf}[y/N]? @|"
     msg = fmt(msg)
 
-    while True:
-        response = safe_input(msg)
-        if not response:
-            response = default
+    with _prompt_lock:
+        while True:
+            response = safe_input(msg)
+            if not response:
+                response = default
 
-        response = response.lower()
-        if response not in ['y', 'n', 'q']:
-            error_msg = 'Response `' + response + '` was not recognized, ' \
-                        'please use one of y, Y, n, N.'
-            error(error_msg)
-        else:
-            break
+            response = response.lower()
+            if response not in ['y', 'n', 'q']:
+                error_msg = 'Response `' + response + '` was not recognized, ' \
+                            'please use one of y, Y, n, N.'
+                error(error_msg)
+            else:
+                break
 
     if response in ['n', 'q']:
         return False
@@ -448,10 +708,16 @@ def execute_command(cmd, shell=True, autofail=True, silent=True,
     if silent:
         out_io = PIPE
         err_io = STDOUT
-    debug(((cwd) if cwd else os.getcwd()) + ":$ " + str(cmd))
+    debug(str(cwd if cwd else os.getcwd()) + ":$ " + str(cmd))
     env = __get_env_for_cmd(cmd)
-    p = Popen(cmd, shell=shell, cwd=cwd, stdout=out_io, stderr=err_io, env=env)
+    args = __get_argv_for_cmd(cmd) if shell else None
+    if args is not None:
+        shell = False
+    start = time.time()
+    p = Popen(args or cmd, shell=shell, cwd=cwd, stdout=out_io, stderr=err_io, env=env)
     out, err = p.communicate()
+    _record_command(cmd, cwd, start, p.returncode, out, err)
+    _update_git_state_generation(cmd)
     if out is not None and not isinstance(out, str):
         out = out.decode('utf-8')
     if err is not None and not isinstance(err, str):
@@ -6,6 +6,7 @@ from __future__ import print_function
 
 import os
 import re
+import subprocess
 import sys
 
 try:
@@ -382,6 +383,39 @@ def test_multi_package_repository(directory=None):
                     assert (format_version <= 2) ^ (pkg + ' license' in f.read()), \
                         "debian/copyright does not include right license text"
 
+        ###
+        ### ROSDebian Generator, generating the distros concurrently
+        ###
+        controls = {}
+        for pkg in pkgs:
+            with inbranch('debian/melodic/bionic/' + pkg):
+                with open(os.path.join('debian', 'control'), 'r') as f:
+                    controls[pkg] = f.read()
+        # In a new process, so that BLOOM_SKIP_ROSDEP_UPDATE is honored
+        cmd = 'git-bloom-generate -y rosdebian --prefix release/melodic melodic -i 2 -j 2 --distros bionic focal'
+        proc = subprocess.run(cmd.split(), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.stdout.decode('utf-8')
+        assert proc.returncode == code.OK, "actually returned ({0}): {1}".format(proc.returncode, output)
+        # The debian files generated concurrently were used, none were generated again
+        assert 'not using the prepared debian files' not in output
+        for pkg in pkgs:
+            for distro in ['bionic', 'focal']:
+                branch = 'debian/melodic/' + distro + '/' + pkg
+                assert "Committing the prepared debian files for '" + branch + "'" in output, output
+        ret, out, err = user('git tag', return_io=True)
+        for pkg in pkgs:
+            for distro in ['bionic', 'focal']:
+                tag = 'debian/ros-melodic-' + sanitize_package_name(pkg) + '_0.1.0-2_' + distro
+                assert out.count(tag) == 1, "no '" + tag + "'' tag created for '" + pkg + "'"
+                with inbranch('debian/melodic/' + distro + '/' + pkg):
+                    assert not os.path.exists(os.path.join('debian', 'control.em'))
+                    with open(os.path.join('debian', 'control'), 'r') as f:
+                        assert f.read() == controls[pkg]
+                    with open(os.path.join('debian', 'changelog'), 'r') as f:
+                        assert '(0.1.0-2' + distro + ')' in f.read()
+                    assert os.access(os.path.join('debian', 'rules'), os.X_OK)
+
+
 @in_temporary_directory
 def test_upstream_tag_special_tag(directory=None):
     """
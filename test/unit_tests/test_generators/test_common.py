@@ -0,0 +1,228 @@
+import json
+import os
+import time
+
+from catkin_pkg.package import Dependency
+from rosdep2.lookup import RosdepDefinition
+from rosdep2.lookup import ResolutionError
+
+import bloom.generators.common
+from bloom.generators.common import add_template_manifest
+from bloom.generators.common import expand_template_folder
+from bloom.generators.common import GeneratorError
+from bloom.generators.common import invalidate_view_cache
+from bloom.generators.common import load_views
+from bloom.generators.common import ResolutionCache
+from bloom.generators.common import resolve_dependencies
+from bloom.generators.common import resolve_rosdep_keys
+from bloom.generators.common import rosdep_update_is_fresh
+from bloom.generators.common import ROSDEP_UPDATE_COMMAND_MAX_AGE
+from bloom.generators.common import write_template_manifest
+
+from bloom.git import CommitBuilder
+from bloom.git import show
+
+from ...utils.common import AssertRaisesContext
+from ...utils.common import in_temporary_directory
+from ...utils.common import redirected_stdio
+from ...utils.common import user
+
+
+class FakeView(object):
+    def __init__(self, data):
+        self.data = data
+        self.lookups = []
+
+    def lookup(self, key):
+        self.lookups.append(key)
+        return RosdepDefinition(key, self.data[key], 'fake')
+
+
+def test_resolve_rosdep_keys():
+    data = {
+        'boost': {'ubuntu': {'focal': ['libboost-dev'], 'jammy': ['libboost-all-dev']}},
+        'only_focal': {'ubuntu': {'focal': ['only-focal']}},
+    }
+    os.environ['BLOOM_NO_ROSDEP_CACHE'] = '1'
+    views = {}
+    for os_version in ['focal', 'jammy']:
+        views[os_version] = FakeView(data)
+        bloom.generators.common.view_cache['ubuntu' + os_version + 'noetic'] = views[os_version]
+    try:
+        targets = [('ubuntu', 'focal'), ('ubuntu', 'jammy')]
+        keys = ['boost', 'only_focal', 'missing']
+        matrix = resolve_rosdep_keys(keys, targets, 'noetic')
+        assert views['focal'].lookups == keys
+        assert matrix.resolve('boost', 'ubuntu', 'focal') == (['libboost-dev'], 'apt', 'apt')
+        assert matrix.resolve('boost', 'ubuntu', 'jammy') == (['libboost-all-dev'], 'apt', 'apt')
+        assert matrix.resolve('only_focal', 'ubuntu', 'focal') == (['only-focal'], 'apt', 'apt')
+        assert isinstance(matrix['only_focal'][('ubuntu', 'jammy')], ResolutionError)
+        assert isinstance(matrix['missing'][('ubuntu', 'focal')], KeyError)
+        with redirected_stdio():
+            for key, os_version in [('only_focal', 'jammy'), ('missing', 'focal')]:
+                try:
+                    matrix.resolve(key, 'ubuntu', os_version)
+                    assert False, "GeneratorError not raised"
+                except GeneratorError:
+                    pass
+        matrix = resolve_rosdep_keys(keys, targets, 'noetic', ignored=['missing'])
+        assert matrix.resolve('missing', 'ubuntu', 'jammy') == (None, None, None)
+        # Resolved keys are taken from the matrix without another lookup
+        views['focal'].lookups = []
+        deps = [Dependency('boost'), Dependency('only_focal')]
+        resolved = resolve_dependencies(deps, 'ubuntu', 'focal', 'noetic', resolutions=matrix)
+        assert resolved == {'boost': ['libboost-dev'], 'only_focal': ['only-focal']}
+        assert views['focal'].lookups == []
+    finally:
+        del os.environ['BLOOM_NO_ROSDEP_CACHE']
+        invalidate_view_cache()
+
+
+def test_load_views():
+    loaded = []
+
+    def get_catkin_view(ros_distro, os_name, os_version, update):
+        loaded.append((os_name, os_version))
+        if os_version in ['jammy', 'noble']:
+            raise RuntimeError("No view for " + os_version)
+        return FakeView({})
+
+    orig_get_catkin_view = bloom.generators.common.get_catkin_view
+    bloom.generators.common.get_catkin_view = get_catkin_view
+    invalidate_view_cache()
+    try:
+        targets = [('ubuntu', 'focal'), ('debian', 'bookworm'), ('ubuntu', 'focal')]
+        views = load_views(targets, 'noetic')
+        assert sorted(views) == [('debian', 'bookworm'), ('ubuntu', 'focal')]
+        assert all(isinstance(v, FakeView) for v in views.values())
+        assert sorted(loaded) == [('debian', 'bookworm'), ('ubuntu', 'focal')]
+        # Cached views are not loaded again
+        loaded[:] = []
+        assert load_views(targets, 'noetic') == views
+        assert loaded == []
+        # The error of the first failing target, in the order given, is raised
+        for targets, message in [
+            ([('ubuntu', 'noble'), ('ubuntu', 'focal'), ('ubuntu', 'jammy')], 'No view for noble'),
+            ([('ubuntu', 'jammy'), ('ubuntu', 'noble')], 'No view for jammy'),
+        ]:
+            loaded[:] = []
+            with AssertRaisesContext(RuntimeError, message):
+                load_views(targets, 'noetic')
+            # Failing views were loaded by the pool and again to raise the error
+            assert ('ubuntu', 'focal') not in loaded
+            assert loaded.count(targets[0]) == 2
+        # A single failing view among views loaded by the pool still raises
+        loaded[:] = []
+        with AssertRaisesContext(RuntimeError, 'No view for jammy'):
+            load_views([('debian', 'bullseye'), ('ubuntu', 'jammy'), ('debian', 'trixie')], 'noetic')
+        assert ('debian', 'bullseye') in loaded and ('debian', 'trixie') in loaded
+    finally:
+        bloom.generators.common.get_catkin_view = orig_get_catkin_view
+        invalidate_view_cache()
+
+
+@in_temporary_directory
+def test_resolution_cache():
+    cache = ResolutionCache('cache.json')
+    assert cache.get('boost', 'ubuntu', 'focal', 'noetic') is None
+    cache.set('boost', 'ubuntu', 'focal', 'noetic', (['libboost-dev'], 'apt', 'apt'))
+    cache.save()
+    cache = ResolutionCache('cache.json')
+    assert cache.get('boost', 'ubuntu', 'focal', 'noetic') == (['libboost-dev'], 'apt', 'apt')
+    assert cache.get('boost', 'ubuntu', 'jammy', 'noetic') is None
+
+
+def _write_rosdep_update_stamp(command_id, age):
+    stamp_path = os.path.join(os.getcwd(), 'rosdep', 'bloom_update_stamp')
+    if not os.path.isdir(os.path.dirname(stamp_path)):
+        os.makedirs(os.path.dirname(stamp_path))
+    with open(stamp_path, 'w') as f:
+        json.dump({'command_id': command_id, 'time': time.time() - age}, f)
+
+
+@in_temporary_directory
+def test_rosdep_update_is_fresh(directory=None):
+    env = dict((k, os.environ.get(k)) for k in ['ROS_HOME', 'BLOOM_COMMAND_ID', 'BLOOM_ROSDEP_UPDATE_MAX_AGE'])
+    os.environ['ROS_HOME'] = directory
+    os.environ['BLOOM_COMMAND_ID'] = 'this-command'
+    os.environ.pop('BLOOM_ROSDEP_UPDATE_MAX_AGE', None)
+    try:
+        # No stamp
+        assert not rosdep_update_is_fresh()
+        # Updated by this command
+        _write_rosdep_update_stamp('this-command', 10)
+        assert rosdep_update_is_fresh()
+        # Updated by this command, but too long ago
+        _write_rosdep_update_stamp('this-command', ROSDEP_UPDATE_COMMAND_MAX_AGE + 10)
+        assert not rosdep_update_is_fresh()
+        # Updated by another command, e.g. an earlier one with a reused pid
+        _write_rosdep_update_stamp('other-command', 10)
+        assert not rosdep_update_is_fresh()
+        # Unless the update is younger than the given max age
+        os.environ['BLOOM_ROSDEP_UPDATE_MAX_AGE'] = '60'
+        assert rosdep_update_is_fresh()
+        _write_rosdep_update_stamp('other-command', 120)
+        assert not rosdep_update_is_fresh()
+        # Stamps from the future are not trusted
+        _write_rosdep_update_stamp('this-command', -120)
+        assert not rosdep_update_is_fresh()
+        # Nor are broken ones
+        with open(os.path.join('rosdep', 'bloom_update_stamp'), 'w') as f:
+            f.write('not json')
+        assert not rosdep_update_is_fresh()
+    finally:
+        for key, value in env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def _create_templates():
+    os.makedirs(os.path.join('debian', 'source'))
+    with open(os.path.join('debian', 'rules.em'), 'w') as f:
+        f.write('#!/usr/bin/make -f\n# @(Name)\n')
+    os.chmod(os.path.join('debian', 'rules.em'), 0o755)
+    with open(os.path.join('debian', 'copyright.em'), 'w') as f:
+        f.write('@[if False]@(Name)@[end if]')
+    with open(os.path.join('debian', 'source', 'format.em'), 'w') as f:
+        f.write('3.0 (@(Format))\n')
+    with open(os.path.join('debian', 'README'), 'w') as f:
+        f.write('not a template')
+
+
+@in_temporary_directory
+def test_expand_template_folder():
+    _create_templates()
+    subs = {'Name': 'foo', 'Format': 'quilt'}
+    with redirected_stdio():
+        manifest = expand_template_folder('debian', subs, skip_empty=['copyright'])
+    assert [(e.source, e.output, e.data) for e in manifest] == [
+        (os.path.join('debian', 'copyright.em'), os.path.join('debian', 'copyright'), None),
+        (os.path.join('debian', 'rules.em'), os.path.join('debian', 'rules'), b'#!/usr/bin/make -f\n# foo\n'),
+        (os.path.join('debian', 'source', 'format.em'), os.path.join('debian', 'source', 'format'), b'3.0 (quilt)\n'),
+    ]
+    assert manifest[1].mode == 0o755
+    assert write_template_manifest(manifest) == [e.source for e in manifest]
+    assert not os.path.exists(os.path.join('debian', 'copyright'))
+    assert os.access(os.path.join('debian', 'rules'), os.X_OK)
+    with open(os.path.join('debian', 'source', 'format')) as f:
+        assert f.read() == '3.0 (quilt)\n'
+
+
+@in_temporary_directory
+def test_add_template_manifest():
+    user('git init .')
+    _create_templates()
+    user('git add debian')
+    user('git commit -m "Add templates"')
+    user('git branch other')
+    with redirected_stdio():
+        manifest = expand_template_folder('debian', {'Name': 'foo', 'Format': 'quilt'}, skip_empty=['copyright'])
+    builder = CommitBuilder('other')
+    add_template_manifest(builder, manifest)
+    builder.commit('Expand templates')
+    assert show('other', 'debian') == {'README': 'file', 'rules': 'file', 'source': 'directory'}
+    assert show('other', 'debian/source/format') == '3.0 (quilt)\n'
+    ret, out, err = user('git ls-tree other debian/rules', return_io=True)
+    assert out.startswith('100755 ')
@@ -43,3 +43,9 @@ def test_format_description():
     assert 'v1.2.3 with v5.3.7 and ! Split after this.\n Long description here.' == format_description('v1.2.3 with v5.3.7 and ! Split after this. Long description here.\n\n')
     # no whitespace between <p>'s, no split
     assert 'some embedded html markup.the other sentence.' == format_description('<h1>some embedded</h1>\n<p>html markup.</p><p>the other sentence.</p>')
+
+
+def test_cached_templating():
+    template = "@[for dep in depends]@(dep), @[end for]@(name)"
+    assert 'a, b, pkg' == expand_template_em(template, {'depends': ['a', 'b'], 'name': 'pkg'})
+    assert 'other' == expand_template_em(template, {'depends': [], 'name': 'other'})
@@ -0,0 +1,76 @@
+import os
+
+from bloom.generators import GeneratorError
+from bloom.generators.packaging import convert_to_unicode
+from bloom.generators.packaging import get_template_folder
+from bloom.generators.packaging import match_branches_with_prefix
+from bloom.generators.packaging import PackagingGenerator
+from bloom.generators.packaging import place_template_folder
+
+from bloom.git import show
+
+from ...utils.common import AssertRaisesContext
+from ...utils.common import in_temporary_directory
+from ...utils.common import user
+
+
+def test_get_template_folder():
+    templates = get_template_folder('bloom.generators.debian', 'templates/catkin', 'debian')
+    destinations = [dst for dst, template, resource in templates]
+    assert os.path.join('debian', 'control.em') in destinations
+    assert os.path.join('debian', 'source', 'format.em') in destinations
+    assert os.path.join('debian', 'gbp.conf.em') not in destinations
+    templates = get_template_folder('bloom.generators.debian', 'templates/catkin', 'debian', gbp=True)
+    assert os.path.join('debian', 'gbp.conf.em') in [dst for dst, template, resource in templates]
+
+
+@in_temporary_directory
+def test_place_template_folder():
+    os.makedirs('rpm')
+    with open(os.path.join('rpm', 'template.spec.em'), 'w') as f:
+        f.write('existing')
+    place_template_folder('bloom.generators.rpm', 'templates/catkin', 'rpm')
+    assert open(os.path.join('rpm', 'template.spec.em')).read() == 'existing'
+    place_template_folder('bloom.generators.rpm', 'templates/catkin', 'rpm', overwrite=True)
+    assert open(os.path.join('rpm', 'template.spec.em')).read() != 'existing'
+
+
+def test_match_branches_with_prefix():
+    branches = ['debian/foo', 'remotes/origin/debian/bar', 'rpm/foo', 'debian/foo']
+    assert sorted(match_branches_with_prefix('debian', lambda: branches)) == ['debian/bar', 'debian/foo']
+
+
+def test_convert_to_unicode():
+    subs = {'Name': b'foo', 'Depends': [b'bar', 'baz'], 'Maintainers': ('a', b'b'), 'Epoch': 0}
+    assert {k: convert_to_unicode(v) for k, v in subs.items()} == \
+        {'Name': 'foo', 'Depends': ['bar', 'baz'], 'Maintainers': ('a', 'b'), 'Epoch': 0}
+
+
+class SpecGenerator(PackagingGenerator):
+    packaging_dir = 'rpm'
+
+
+def _create_spec_branch(spec_template):
+    user('git init .')
+    os.makedirs('rpm')
+    with open(os.path.join('rpm', spec_template), 'w') as f:
+        f.write('Name: @(Package)\n')
+    user('git add rpm')
+    user('git commit -m "Add rpm templates"')
+
+
+@in_temporary_directory
+def test_commit_spec_files():
+    _create_spec_branch('template.spec.em')
+    SpecGenerator().commit_spec_files('rpm', {'Package': 'foo'}, 'RPM files for fedora')
+    assert show('HEAD', 'rpm') == {'foo.spec': 'file'}
+    assert show('HEAD', 'rpm/foo.spec') == 'Name: foo\n'
+    assert show('HEAD', '.write_tar') == ''
+    assert show('HEAD^', 'rpm/template.spec') == 'Name: foo\n'
+
+
+@in_temporary_directory
+def test_commit_spec_files_without_spec_template():
+    _create_spec_branch('other.spec.em')
+    with AssertRaisesContext(GeneratorError, "rpm/template.spec' was not generated"):
+        SpecGenerator().commit_spec_files('rpm', {'Package': 'foo'}, 'RPM files for fedora')
@@ -0,0 +1,328 @@
+import os
+
+from ..utils.common import AssertRaisesContext
+from ..utils.common import in_temporary_directory
+from ..utils.common import redirected_stdio
+from ..utils.common import user
+
+from bloom.git import branch_exists
+from bloom.git import checkout
+from bloom.git import commit_files
+from bloom.git import CommitBuilder
+from bloom.git import commit_tree
+from bloom.git import create_branch
+from bloom.git import create_tag
+from bloom.git import delete_tag
+from bloom.git import get_branches
+from bloom.git import GitClone
+from bloom.git import has_changes
+from bloom.git import get_commit_hash
+from bloom.git import get_current_branch
+from bloom.git import get_root
+from bloom.git import ls_tree
+from bloom.git import ref_cache
+from bloom.git import Repository
+from bloom.git import show
+from bloom.git import tag_exists
+from bloom.git import track_branches
+
+import bloom.util
+from bloom.util import check_output
+from bloom.util import execute_command
+
+
+def _create_repository():
+    user('git init .')
+    user('mkdir -p foo/bar')
+    user('echo "hello world" > "foo/white space.txt"')
+    user('echo "baz" > foo/bar/baz.txt')
+    user('git add foo')
+    user('git commit -m "Initial commit"')
+    user('git branch other')
+
+
+@in_temporary_directory
+def test_show_and_ls_tree():
+    _create_repository()
+    assert show('other', 'foo/white space.txt') == 'hello world'
+    assert show('other', 'foo') == {'white space.txt': 'file', 'bar': 'directory'}
+    assert show('other', 'missing.txt') is None
+    assert show('missing_branch', 'foo') is None
+    assert ls_tree('other') == {'foo': 'directory'}
+    assert ls_tree('other', 'foo/bar') == {'baz.txt': 'file'}
+    assert ls_tree('other', 'foo/bar/baz.txt') is None
+
+
+@in_temporary_directory
+def test_get_commit_hash():
+    _create_repository()
+    ret, out, err = user('git rev-parse other', return_io=True)
+    assert get_commit_hash('other') == out.strip()
+
+
+@in_temporary_directory
+def test_show_tracks_remote_branches(directory=None):
+    os.mkdir('upstream')
+    user('cd upstream')
+    _create_repository()
+    user('cd ..')
+    user('git clone upstream clone')
+    clone = os.path.join(directory, 'clone')
+    assert not branch_exists('other', local_only=True, directory=clone)
+    assert show('other', 'foo/bar/baz.txt', directory=clone) == 'baz'
+    assert branch_exists('other', local_only=True, directory=clone)
+
+
+@in_temporary_directory
+def test_ref_cache():
+    _create_repository()
+    with ref_cache():
+        assert get_current_branch() in ['master', 'main']
+        assert branch_exists('other')
+        create_branch('new_branch')
+        create_tag('new_tag')
+        assert 'new_branch' in get_branches()
+        assert tag_exists('new_tag')
+        checkout('new_branch')
+        assert get_current_branch() == 'new_branch'
+        delete_tag('new_tag')
+        assert not tag_exists('new_tag')
+        # Changes made through bloom.util are noticed
+        execute_command('git branch other_branch')
+        assert branch_exists('other_branch')
+    # Outside of the context changes made by other processes are noticed
+    user('git branch yet_another_branch')
+    assert branch_exists('yet_another_branch')
+
+
+@in_temporary_directory
+def test_track_branches(directory=None):
+    os.mkdir('upstream')
+    user('cd upstream')
+    _create_repository()
+    user('git branch another')
+    user('cd ..')
+    user('git clone upstream clone')
+    clone = os.path.join(directory, 'clone')
+    with ref_cache():
+        track_branches('other', directory=clone)
+        assert branch_exists('other', local_only=True, directory=clone)
+        assert not branch_exists('another', local_only=True, directory=clone)
+        track_branches(directory=clone)
+        assert branch_exists('another', local_only=True, directory=clone)
+    user('cd upstream')
+    ret, out, err = user('git rev-parse another', return_io=True)
+    assert get_commit_hash('another', directory=clone) == out.strip()
+    # The new branches track their remote branch, like 'git branch --track' does
+    config = check_output(['git', 'config', '--get-regexp', r'^branch\.'], cwd=clone).splitlines()
+    for branch in ['other', 'another']:
+        assert 'branch.{0}.remote origin'.format(branch) in config
+        assert 'branch.{0}.merge refs/heads/{0}'.format(branch) in config
+    assert check_output(['git', 'rev-parse', '--abbrev-ref', 'another@{upstream}'], cwd=clone).strip() == \
+        'origin/another'
+    # Values left over from a deleted branch are replaced
+    user('git branch newer')
+    check_output(['git', 'fetch', '-q', 'origin'], cwd=clone)
+    check_output(['git', 'config', 'branch.newer.remote', 'stale'], cwd=clone)
+    check_output(['git', 'config', 'branch.newer.merge', 'refs/heads/stale'], cwd=clone)
+    track_branches('newer', directory=clone)
+    assert check_output(['git', 'config', '--get-all', 'branch.newer.remote'], cwd=clone).strip() == 'origin'
+    assert check_output(['git', 'config', '--get-all', 'branch.newer.merge'], cwd=clone).strip() == \
+        'refs/heads/newer'
+
+
+@in_temporary_directory
+def test_shared_git_clone(directory=None):
+    _create_repository()
+    git_clone = GitClone(shared=True)
+    with git_clone as clone_dir:
+        assert clone_dir != directory
+        create_branch('new_branch')
+        checkout('other')
+        user('git commit --allow-empty -m "Commit in the clone"')
+        create_tag('new_tag')
+        assert not branch_exists('new_branch', directory=directory)
+    assert [ref for ref, sha, force in git_clone.get_ref_delta()] == \
+        ['refs/heads/new_branch', 'refs/heads/other', 'refs/tags/new_tag']
+    git_clone.commit()
+    assert branch_exists('new_branch')
+    assert tag_exists('new_tag')
+    assert get_commit_hash('other') == get_commit_hash('new_tag')
+
+
+@in_temporary_directory
+def test_git_clone_rewritten_branch(directory=None):
+    _create_repository()
+    user('git branch recreated')
+    user('git commit --allow-empty -m "Only in the working copy"')
+    head = get_current_branch()
+    git_clone = GitClone(shared=True)
+    with git_clone:
+        # One branch moves forward, one is recreated from another commit
+        checkout('other')
+        user('git commit --allow-empty -m "Fast-forward"')
+        user('git branch -D recreated')
+        user('git checkout --orphan recreated')
+        user('git commit --allow-empty -m "Recreated"')
+        checkout(head)
+        user('git commit --amend --allow-empty -m "Rewritten"')
+    delta = dict((ref, force) for ref, sha, force in git_clone.get_ref_delta())
+    assert delta == {'refs/heads/' + head: True, 'refs/heads/other': False, 'refs/heads/recreated': True}
+    shas = dict((ref, sha) for ref, sha, force in git_clone.get_ref_delta())
+    with redirected_stdio():
+        git_clone.commit()
+    for ref, sha in shas.items():
+        assert get_commit_hash(ref[len('refs/heads/'):]) == sha
+    assert get_current_branch() == head
+    assert not has_changes()
+
+
+@in_temporary_directory
+def test_commit_files():
+    _create_repository()
+    user('echo "local change" > "foo/white space.txt"')
+    parent = get_commit_hash('other')
+    commit = commit_files('other', {'foo/new.txt': 'new file'}, 'Add new.txt')
+    assert commit == get_commit_hash('other')
+    assert show('other', 'foo/new.txt') == 'new file'
+    assert show('other', 'foo/bar/baz.txt') == 'baz'
+    assert show('other^', 'foo/new.txt') is None
+    assert get_commit_hash('other^') == parent
+    # The working tree was not touched
+    assert not os.path.exists(os.path.join('foo', 'new.txt'))
+    assert open(os.path.join('foo', 'white space.txt')).read().strip() == 'local change'
+    # Nothing is committed if the tree does not change
+    assert commit_files('other', {'foo/new.txt': b'new file'}, 'Add new.txt again') is None
+    assert commit == get_commit_hash('other')
+
+
+@in_temporary_directory
+def test_commit_builder():
+    _create_repository()
+    builder = CommitBuilder('other')
+    builder.add('foo/bar/baz.txt', 'changed')
+    builder.add('README', b'readme')
+    commit = builder.commit('Update two files')
+    assert commit == get_commit_hash('other')
+    assert show('other', 'foo/bar/baz.txt') == 'changed'
+    assert show('other', 'README') == 'readme'
+    # Committing to the checked out branch uses the working tree
+    checkout('other')
+    builder = CommitBuilder('other')
+    builder.add('README', 'new readme')
+    assert builder.commit('Update README') == get_commit_hash('other')
+    assert open('README').read() == 'new readme'
+
+
+@in_temporary_directory
+def test_repository(directory=None):
+    assert get_root() is None
+    _create_repository()
+    repository = Repository(os.path.join(directory, 'foo'))
+    assert repository.root == get_root() == get_root(repository)
+    assert repository.git_dir == os.path.join(repository.root, '.git')
+    assert repository.remotes == []
+    head = repository.head
+    assert head in ['master', 'main']
+    # Changes of HEAD made through bloom are noticed
+    checkout('other', directory=repository)
+    assert get_current_branch(repository) == repository.head == 'other'
+
+
+@in_temporary_directory
+def test_repository_memoization(directory=None):
+    _create_repository()
+    user('git remote add origin ' + directory)
+    repository = Repository(directory)
+    records = bloom.util._command_records
+    bloom.util._command_records = []
+    try:
+        for _ in range(3):
+            assert repository.head in ['master', 'main']
+            assert repository.remotes == ['origin']
+            assert get_current_branch(repository) == repository.head
+        # Read only queries do not invalidate the cached information
+        check_output(['git', 'config', '--get', 'remote.origin.url'])
+        assert repository.head in ['master', 'main']
+        programs = [r['program'] for r in bloom.util._command_records]
+        assert programs.count('git symbolic-ref') == 1
+        assert programs.count('git remote') == 1
+        assert programs.count('git rev-parse') <= 1
+        # Commands which may change HEAD invalidate it
+        checkout('other', directory=repository)
+        assert repository.head == 'other'
+        programs = [r['program'] for r in bloom.util._command_records]
+        assert programs.count('git symbolic-ref') == 2
+    finally:
+        bloom.util._command_records = records
+
+
+@in_temporary_directory
+def test_commit_builder_remove_and_mode():
+    _create_repository()
+    builder = CommitBuilder('other')
+    builder.remove('foo/bar/baz.txt')
+    builder.add('run.sh', '#!/bin/sh\n', executable=True)
+    builder.commit('Replace baz.txt with run.sh')
+    assert show('other', 'foo/bar') is None
+    assert ls_tree('other') == {'foo': 'directory', 'run.sh': 'file'}
+    ret, out, err = user('git ls-tree other run.sh', return_io=True)
+    assert out.startswith('100755 ')
+    # The same in the working tree
+    checkout('other')
+    builder = CommitBuilder('other')
+    builder.remove('run.sh')
+    builder.add('foo/new/new.txt', 'new')
+    builder.commit('Replace run.sh')
+    assert not os.path.exists('run.sh')
+    assert show('other', 'foo/new/new.txt') == 'new'
+    assert open(os.path.join('foo', 'new', 'new.txt')).read() == 'new'
+    assert not has_changes()
+    # Local changes to the committed files are not overwritten
+    user('echo "local change" > "foo/new/new.txt"')
+    parent = get_commit_hash('other')
+    builder = CommitBuilder('other')
+    builder.add('foo/new/new.txt', 'newer')
+    with AssertRaisesContext(RuntimeError, "would overwrite the local changes to: foo/new/new.txt"):
+        builder.commit('Update new.txt')
+    assert get_commit_hash('other') == parent
+    assert open(os.path.join('foo', 'new', 'new.txt')).read().strip() == 'local change'
+    # Local changes which match the committed contents are kept as they are
+    user('echo "newer" > "foo/new/new.txt"')
+    builder = CommitBuilder('other')
+    builder.add('foo/new/new.txt', 'newer')
+    builder.commit('Update new.txt')
+    assert show('other', 'foo/new/new.txt') == 'newer'
+    assert not has_changes()
+
+
+@in_temporary_directory
+def test_commit_tree():
+    _create_repository()
+    parent = get_commit_hash('other')
+    commit = commit_tree('other', 'other:foo', 'Move foo to the root')
+    assert commit == get_commit_hash('other')
+    assert get_commit_hash('other^') == parent
+    assert ls_tree('other') == {'white space.txt': 'file', 'bar': 'directory'}
+    # Nothing is committed if the tree does not change
+    assert commit_tree('other', commit, 'Again') is None
+    empty = commit_tree('other', commit, 'Again', allow_empty=True)
+    assert get_commit_hash('other^') == commit and empty == get_commit_hash('other')
+    # The checked out branch moves the working tree along
+    checkout('other')
+    commit_tree('other', 'other:bar', 'Move bar to the root')
+    assert sorted(os.listdir('.')) == ['.git', 'baz.txt']
+    assert not has_changes()
+
+
+@in_temporary_directory
+def test_get_current_branch():
+    _create_repository()
+    checkout('other')
+    assert get_current_branch() == 'other'
+    checkout(get_commit_hash('other'))
+    assert get_current_branch() is None
+    with ref_cache():
+        assert get_current_branch() is None
+        checkout('other')
+        assert get_current_branch() == 'other'
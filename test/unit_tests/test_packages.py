@@ -5,7 +5,14 @@ from ..utils.common import in_temporary_directory
 from ..utils.common import redirected_stdio
 from ..utils.common import user
 
+from bloom.packages import get_changelog_entries
+from bloom.packages import get_changelog_entries_from_path
 from bloom.packages import get_package_data
+from bloom.packages import get_package_data_from_reference
+from bloom.packages import get_packages_from_references
+from bloom.packages import parse_package_xmls
+
+from catkin_pkg.packages import find_packages
 
 test_data_dir = os.path.join(os.path.dirname(__file__), 'test_packages_data')
 
@@ -17,3 +24,128 @@ def test_get_package_data_fails_on_uppercase():
     with AssertRaisesContext(SystemExit, "Invalid package names, aborting."):
         with redirected_stdio():
             get_package_data(directory=test_data_dir)
+
+
+CHANGELOG = u"""\
+^^^^^^^^^^^^^^^^^^^^^^^^^
+Changelog for package foo
+^^^^^^^^^^^^^^^^^^^^^^^^^
+
+0.1.1 (2024-02-01)
+------------------
+* Fixed a bug
+
+0.1.0 (2024-01-01)
+------------------
+* Initial release
+"""
+
+
+@in_temporary_directory
+def test_get_changelog_entries():
+    entries = get_changelog_entries(CHANGELOG)
+    assert [version for version, date, changes in entries] == ['0.1.0', '0.1.1']
+    assert [str(change) for change in entries[1][2]] == ['* Fixed a bug']
+    # The same contents are parsed once
+    assert get_changelog_entries(CHANGELOG.encode('utf-8')) is entries
+    with open('CHANGELOG.rst', 'w') as f:
+        f.write(CHANGELOG)
+    assert get_changelog_entries_from_path(os.getcwd()) is entries
+    assert get_changelog_entries_from_path('missing') is None
+
+
+PACKAGE_XML = u"""\
+<?xml version="1.0"?>
+<package format="2">
+  <name>{0}</name>
+  <version>{1}</version>
+  <description>The {0} package</description>
+  <maintainer email="foo@example.com">Foo</maintainer>
+  <license>BSD</license>
+  <buildtool_depend>catkin</buildtool_depend>
+</package>
+"""
+
+
+def _write_package(path, name, version='0.1.0'):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, 'package.xml'), 'w') as f:
+        f.write(PACKAGE_XML.format(name, version))
+
+
+@in_temporary_directory
+def test_get_packages_from_references():
+    user('git init .')
+    _write_package(os.path.join('src', 'foo'), 'foo')
+    _write_package(os.path.join('src', 'foo', 'nested'), 'nested')
+    _write_package(os.path.join('src', 'ignored', 'bar'), 'bar')
+    open(os.path.join('src', 'ignored', 'CATKIN_IGNORE'), 'w').close()
+    _write_package(os.path.join('.hidden', 'baz'), 'baz')
+    _write_package('qux', 'qux')
+    user('git add -A')
+    user('git commit -m "Add packages"')
+    user('git branch other')
+    _write_package('qux', 'qux', '0.2.0')
+    user('git commit -am "Bump qux"')
+    packages = get_packages_from_references(['other', 'missing'])
+    assert packages['missing'] is None
+    expected = find_packages(os.getcwd())
+    assert sorted(packages['other']) == sorted(expected) == ['qux', os.path.join('src', 'foo')]
+    assert packages['other']['qux'].filename == expected['qux'].filename
+    # Unchanged packages are only parsed once
+    head = get_packages_from_references(['HEAD'])['HEAD']
+    assert head[os.path.join('src', 'foo')] is packages['other'][os.path.join('src', 'foo')]
+    assert head['qux'].version == '0.2.0'
+    with redirected_stdio():
+        names, version, _ = get_package_data_from_reference('other')
+        assert sorted(names) == ['foo', 'qux']
+        assert version == '0.1.0'
+        with AssertRaisesContext(SystemExit, "No package.xml"):
+            get_package_data_from_reference('missing')
+    # Packages with the same name are refused like catkin_pkg does
+    _write_package(os.path.join('src', 'copy'), 'foo')
+    user('git add -A')
+    user('git commit -m "Copy foo"')
+    with AssertRaisesContext(RuntimeError, 'Multiple packages found with the same name "foo"'):
+        get_packages_from_references(['HEAD'])
+    with AssertRaisesContext(RuntimeError, 'Multiple packages found with the same name "foo"'):
+        find_packages(os.getcwd())
+
+
+def test_parse_package_xmls():
+    xmls = [(PACKAGE_XML.format('pkg{0}'.format(i), '0.1.0'), 'package.xml') for i in range(20)]
+    assert [p.name for p in parse_package_xmls(xmls)] == ['pkg{0}'.format(i) for i in range(20)]
+
+
+@in_temporary_directory
+def test_get_package_data_is_remembered_for_clean_trees():
+    user('git init .')
+    _write_package('foo', 'foo')
+    _write_package('bar', 'bar')
+    user('git add -A')
+    user('git commit -m "Add packages"')
+    names, version, packages = get_package_data()
+    assert sorted(names) == ['bar', 'foo']
+    assert get_package_data()[2]['foo'] is packages['foo']
+    # Local changes are noticed
+    _write_package('foo', 'foo', '0.2.0')
+    _write_package('bar', 'bar', '0.2.0')
+    names, version, changed_packages = get_package_data()
+    assert version == '0.2.0'
+    assert get_package_data()[2]['foo'] is not changed_packages['foo']
+    # Ignored files are not part of a clean tree
+    user('git checkout -- .')
+    with open('.gitignore', 'w') as f:
+        f.write('ignored/\n')
+    user('git add .gitignore')
+    user('git commit -m "Ignore a folder"')
+    names, version, packages = get_package_data()
+    assert sorted(names) == ['bar', 'foo']
+    _write_package('ignored', 'baz')
+    names, version, cached_packages = get_package_data()
+    assert sorted(names) == ['bar', 'foo']
+    assert cached_packages['foo'] is packages['foo']
+    # Untracked files are noticed
+    _write_package('untracked', 'qux')
+    assert 'qux' in get_package_data()[0]
@@ -0,0 +1,44 @@
+import os
+
+from ..utils.common import in_temporary_directory
+from ..utils.common import user
+
+from bloom.commands.git.patch.rebase_cmd import non_git_rebase
+
+from bloom.git import checkout
+from bloom.git import get_commit_hash
+from bloom.git import has_changes
+from bloom.git import ls_tree
+
+
+@in_temporary_directory
+def test_non_git_rebase():
+    user('git init .')
+    user('echo "release" > README')
+    user('git add README')
+    user('git commit -m "Release branch"')
+    user('git branch release')
+    user('mkdir sub')
+    user('echo "source" > sub/source.c')
+    user('echo "build" > .gitignore')
+    user('echo "build" > sub/.gitignore')
+    user('echo "notes" > sub/notes.bak')
+    user('git add -f .gitignore sub')
+    # A submodule, which is not checked out
+    user('mkdir lib')
+    user('git update-index --add --cacheinfo 160000,' + get_commit_hash('release') + ',lib')
+    user('git commit -m "Upstream"')
+    user('git branch -m upstream')
+    with open(os.path.join('.git', 'info', 'exclude'), 'a') as f:
+        f.write('*.bak\n')
+    checkout('release')
+    parent = get_commit_hash('release')
+    non_git_rebase('upstream')
+    assert get_commit_hash('release^') == parent
+    assert ls_tree('release') == {'README': 'file', 'sub': 'directory'}
+    assert ls_tree('release', 'sub') == {'source.c': 'file'}
+    assert sorted(os.listdir('.')) == ['.git', 'README', 'sub']
+    assert not has_changes()
+    # Rebasing again makes an empty commit
+    non_git_rebase('upstream')
+    assert get_commit_hash('release^^') == parent
@@ -0,0 +1,39 @@
+import os
+
+from ..utils.common import in_temporary_directory
+from ..utils.common import user
+
+from bloom.commands.git.patch.trim_cmd import _trim
+
+from bloom.git import get_commit_hash
+from bloom.git import has_changes
+from bloom.git import ls_tree
+
+
+@in_temporary_directory
+def test_trim():
+    user('git init .')
+    os.makedirs(os.path.join('sub', 'build'))
+    os.makedirs(os.path.join('sub', 'src'))
+    user('echo "*.log" > .gitignore')
+    user('echo "build/" > sub/.gitignore')
+    user('echo "*.pyc" > sub/src/.gitignore')
+    user('echo "source" > sub/src/source.c')
+    user('echo "compiled" > sub/src/source.pyc')
+    user('echo "object" > sub/build/source.o')
+    user('echo "log" > sub/changes.log')
+    user('echo "notes" > sub/notes.bak')
+    user('echo "other" > other.txt')
+    user('git add -f .gitignore other.txt sub')
+    user('git commit -m "Upstream"')
+    with open(os.path.join('.git', 'info', 'exclude'), 'a') as f:
+        f.write('*.bak\n')
+    parent = get_commit_hash('HEAD')
+    config = _trim({'trim': 'sub', 'trimbase': '', 'base': ''}, False, None)
+    assert config['trimbase'] == parent
+    assert config['base'] == get_commit_hash('HEAD')
+    assert get_commit_hash('HEAD^') == parent
+    # Tracked files ignored in the trimmed tree are dropped, like 'git add' dropped them when copying
+    assert ls_tree('HEAD') == {'.gitignore': 'file', 'changes.log': 'file', 'src': 'directory'}
+    assert ls_tree('HEAD', 'src') == {'.gitignore': 'file', 'source.c': 'file'}
+    assert not has_changes()
@@ -0,0 +1,119 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+
+from subprocess import CalledProcessError
+
+from ..utils.common import AssertRaisesContext
+from ..utils.common import in_temporary_directory
+
+import bloom.util
+from bloom.util import check_output
+from bloom.util import get_command_report
+from bloom.util import get_git_env
+
+PROFILED_SCRIPT = """\
+from bloom.util import check_output, execute_command
+check_output('git --version', shell=True)
+check_output(['git', '--version'])
+execute_command('git init -q .')
+"""
+
+
+def test_get_command_report():
+    records = bloom.util._command_records
+    bloom.util._command_records = []
+    try:
+        check_output(['git', '--version'])
+        check_output('git --version', shell=True)
+        check_output(['python', '-c', 'pass'])
+        report = get_command_report()
+    finally:
+        bloom.util._command_records = records
+    assert report['total_count'] == 3
+    assert [r['command'] for r in report['commands']] == ['git --version', 'git --version', 'python -c pass']
+    assert [(g['program'], g['count']) for g in report['top_by_count']] == [('git --version', 2), ('python', 1)]
+    assert report['total_time'] == sum(g['total_time'] for g in report['top_by_time'])
+    call_sites = [g['call_site'] for g in report['top_call_sites_by_time']]
+    assert len(call_sites) == 3
+    assert all(c.endswith(' (test_get_command_report)') and 'test_util.py:' in c for c in call_sites)
+    assert all(r['returncode'] == 0 for r in report['commands'])
+
+
+@in_temporary_directory
+def test_write_command_report(directory=None):
+    env = dict(os.environ)
+    env.update({
+        'HOME': directory,
+        'BLOOM_PROFILE_COMMANDS': '1',
+        'BLOOM_LOGGING_ID': 'profiled',
+        'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.abspath(bloom.util.__file__))),
+    })
+    subprocess.check_call([sys.executable, '-c', PROFILED_SCRIPT], env=env)
+    reports = glob.glob(os.path.join(directory, '.bloom_logs', 'profiled.*.commands.json'))
+    assert len(reports) == 1, reports
+    with open(reports[0]) as f:
+        report = json.load(f)
+    assert report['total_count'] == 3
+    assert [r['command'] for r in report['commands']] == ['git --version', 'git --version', 'git init -q .']
+    assert [(g['program'], g['count']) for g in report['top_by_count']] == [('git --version', 2), ('git init', 1)]
+    assert all(r['cwd'] == directory for r in report['commands'])
+    assert [r['call_site'] for r in report['commands']] == \
+        [os.path.join(directory, '<string>') + ':{0} (<module>)'.format(n) for n in (2, 3, 4)]
+    assert all(r['returncode'] == 0 and r['duration'] >= 0 for r in report['commands'])
+    # Nothing is recorded without BLOOM_PROFILE_COMMANDS
+    del env['BLOOM_PROFILE_COMMANDS']
+    env['BLOOM_LOGGING_ID'] = 'not_profiled'
+    subprocess.check_call([sys.executable, '-c', PROFILED_SCRIPT], env=env)
+    assert glob.glob(os.path.join(directory, '.bloom_logs', 'not_profiled.*.commands.json')) == []
+
+
+def test_get_argv_for_cmd():
+    get_argv_for_cmd = getattr(bloom.util, '__get_argv_for_cmd')
+    # Simple commands are run without a shell
+    assert get_argv_for_cmd('git status') == ['git', 'status']
+    assert get_argv_for_cmd("git commit -m 'a message'") == ['git', 'commit', '-m', 'a message']
+    # Anything the shell has to interpret is left to the shell
+    assert get_argv_for_cmd('git log | head') is None
+    assert get_argv_for_cmd('git status > out.txt') is None
+    assert get_argv_for_cmd('git add *.py') is None
+    assert get_argv_for_cmd('echo $HOME') is None
+    assert get_argv_for_cmd('git status && git log') is None
+    assert get_argv_for_cmd('FOO=bar git status') is None
+    assert get_argv_for_cmd("git commit -m 'unterminated") is None
+    assert get_argv_for_cmd('') is None
+    # Shell builtins and missing executables are left to the shell
+    assert get_argv_for_cmd('cd /tmp') is None
+    assert get_argv_for_cmd('bloom-command-which-does-not-exist --flag') is None
+    # Only strings are converted
+    assert get_argv_for_cmd(['git', 'status']) is None
+
+
+@in_temporary_directory
+def test_check_output_shell_fallback(directory=None):
+    # Shell syntax still works when check_output is given a shell string
+    assert check_output('echo foo | tr o a', shell=True).strip() == 'faa'
+    check_output('echo foo > out.txt', shell=True)
+    assert open('out.txt').read().strip() == 'foo'
+    assert check_output('cd .. && pwd', shell=True).strip() == os.path.dirname(directory)
+    assert check_output("echo 'a  b'", shell=True).strip() == 'a  b'
+
+
+def test_check_output_env_does_not_leak():
+    git_env = dict(get_git_env())
+    extra_env = {'GIT_CONFIG_PARAMETERS': "'bloom.test=leaked'", 'BLOOM_TEST_VAR': 'leaked'}
+    assert check_output(['git', 'config', '--get', 'bloom.test'], env=extra_env).strip() == 'leaked'
+    assert check_output('git config --get bloom.test', shell=True, env=extra_env).strip() == 'leaked'
+    # The shared git environment and later commands are not affected
+    assert dict(get_git_env()) == git_env
+    assert 'BLOOM_TEST_VAR' not in get_git_env()
+    assert 'BLOOM_TEST_VAR' not in os.environ
+    with AssertRaisesContext(CalledProcessError):
+        check_output(['git', 'config', '--get', 'bloom.test'])
+    with AssertRaisesContext(CalledProcessError):
+        check_output('git config --get bloom.test', shell=True)
+    assert check_output('echo "[$BLOOM_TEST_VAR]"', shell=True).strip() == '[]'
+    assert check_output(['git', 'var', 'GIT_EDITOR'], env={'GIT_EDITOR': 'bloom-editor'}).strip() == 'bloom-editor'
+    assert check_output(['git', 'var', 'GIT_EDITOR']).strip() != 'bloom-editor'